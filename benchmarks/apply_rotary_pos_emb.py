@@ -2,7 +2,7 @@
 import torch
 import triton
 
-from dlblas.kernels.apply_rotary_pos_emb import apply_rotary_pos_emb
+from dlblas.kernels.apply_rotary_pos_emb import apply_rotary_pos_emb, apply_rotary_pos_emb_contiguous
 from dlblas.utils.device_utils import infer_device
 
 
@@ -32,11 +32,19 @@ def test():
     # position_ids_1d = torch.randint(0, s, (b * s,), device=device_)
     position_ids_1d = torch.arange(0, s, device=device_)
     q_embed, k_embed = torch_rotary_pos_emb(q_states, k_states, cached_cos, cached_sin, position_ids_1d)
-    q_embed_tri, k_embed_tri = apply_rotary_pos_emb(q_states, k_states, cached_cos, cached_sin)
+    q_embed_tri, k_embed_tri = apply_rotary_pos_emb(q_states,
+                                                    k_states,
+                                                    cached_cos,
+                                                    cached_sin,
+                                                    position_ids=position_ids_1d)
     print('max abs diff: ', torch.max(abs(q_embed - q_embed_tri)))
     print('max abs diff: ', torch.max(abs(k_embed - k_embed_tri)))
     assert torch.allclose(q_embed, q_embed_tri, atol=1e-2, rtol=1e-1)
     assert torch.allclose(k_embed, k_embed_tri, atol=1e-2, rtol=1e-1)
+    # position_ids_1d is arange(s): the contiguous path must match without any gather
+    q_embed_tri, k_embed_tri = apply_rotary_pos_emb_contiguous(q_states, k_states, cached_cos, cached_sin)
+    assert torch.allclose(q_embed, q_embed_tri, atol=1e-2, rtol=1e-1)
+    assert torch.allclose(k_embed, k_embed_tri, atol=1e-2, rtol=1e-1)
 
     configs = []
     configs.append(
@@ -44,8 +52,8 @@ def test():
             x_names=['op'],
             x_vals=['fwd'],
             line_arg='provider',
-            line_vals=['triton', 'pytorch'],
-            line_names=['Triton', 'PyTorch'],
+            line_vals=['triton', 'triton_contiguous', 'pytorch'],
+            line_names=['Triton', 'Triton contiguous', 'PyTorch'],
             ylabel='ms',
             plot_name='',
             args={},
@@ -56,10 +64,16 @@ def test():
         warmup = 100
         rep = 200
 
-        if 'triton' in provider:
-            ms = triton.testing.do_bench(lambda: apply_rotary_pos_emb(q_states, k_states, cached_cos, cached_sin),
+        if provider == 'triton':
+            ms = triton.testing.do_bench(lambda: apply_rotary_pos_emb(
+                q_states, k_states, cached_cos, cached_sin, position_ids=position_ids_1d),
                                          warmup=warmup,
                                          rep=rep)
+        if provider == 'triton_contiguous':
+            ms = triton.testing.do_bench(
+                lambda: apply_rotary_pos_emb_contiguous(q_states, k_states, cached_cos, cached_sin),
+                warmup=warmup,
+                rep=rep)
         if 'pytorch' in provider:
             ms = triton.testing.do_bench(
                 lambda: torch_rotary_pos_emb(q_states, k_states, cached_cos, cached_sin, position_ids_1d),
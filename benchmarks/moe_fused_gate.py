@@ -2,12 +2,22 @@
 import torch
 import triton
 
-import dlblas
-from dlblas.kernels.moe import biased_grouped_topk
+from dlblas.kernels.moe import biased_grouped_topk, biased_grouped_topk_torch
 from dlblas.utils.device_utils import infer_device
 
 
 def biased_grouped_topk_org(scores, bias, num_expert_group, topk_group, topk):
+    return biased_grouped_topk_torch(scores,
+                                     scores,
+                                     bias,
+                                     topk=topk,
+                                     renormalize=True,
+                                     num_expert_group=num_expert_group,
+                                     topk_group=topk_group,
+                                     routed_scaling_factor=2.5)
+
+
+def biased_grouped_topk_org_kernel(scores, bias, num_expert_group, topk_group, topk):
     return biased_grouped_topk(scores,
                                scores,
                                bias,
@@ -18,10 +28,6 @@ def biased_grouped_topk_org(scores, bias, num_expert_group, topk_group, topk):
                                routed_scaling_factor=2.5)
 
 
-def biased_grouped_topk_org_kernel(scores, bias, num_expert_group, topk_group, topk):
-    return dlblas.moe_fused_gate(scores, bias, num_expert_group, topk_group, topk, routed_scaling_factor=2.5)
-
-
 seq_length_range = [5000, 10000, 15000, 20000, 25000, 30000, 35000, 40000]
 configs = [(sq, ) for sq in seq_length_range]
 
@@ -48,14 +54,16 @@ def benchmark(seq_length, provider):
 
     quantiles = [0.5, 0.2, 0.8]
 
+    # both providers treat scores/bias as read-only, so no per-iteration clone is needed: it would only measure
+    # the allocator and a seq_length x num_experts copy
     if provider == 'torch':
         ms, min_ms, max_ms = triton.testing.do_bench(
-            lambda: biased_grouped_topk_org(scores.clone(), bias.clone(), num_expert_group, topk_group, topk),
+            lambda: biased_grouped_topk_org(scores, bias, num_expert_group, topk_group, topk),
             quantiles=quantiles,
         )
     elif provider == 'kernel':
         ms, min_ms, max_ms = triton.testing.do_bench(
-            lambda: biased_grouped_topk_org_kernel(scores.clone(), bias.clone(), num_expert_group, topk_group, topk),
+            lambda: biased_grouped_topk_org_kernel(scores, bias, num_expert_group, topk_group, topk),
             quantiles=quantiles,
         )
 
@@ -11,6 +11,24 @@ from dlblas.utils import get_op
 __version__ = "0.0.7"
 
 
+def warmup(device=None):
+    """Compile the common fill_kv_cache specializations, autotune cross entropy and jit the eplb rebalance ahead of
+    the first request.
+
+    Runs synchronously on ``device``, the current device if None, so call it after ``torch.cuda.set_device``.
+    """
+    from dlblas.kernels.cross_entropy import warmup_cross_entropy
+    from dlblas.kernels.fill_kv_cache import warmup_fill_kv_cache
+    from dlblas.layers.moe.eplb import warmup_eplb
+
+    if device is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    # host only, runs first so a failing device warmup can not skip it
+    warmup_eplb()
+    warmup_fill_kv_cache(device=device)
+    warmup_cross_entropy(device=device)
+
+
 # output: l_aux, token_rearranged_ec_idx, token_exp_weights, expert_select_token_idx
 def topk_gating(
     logits: Tensor,
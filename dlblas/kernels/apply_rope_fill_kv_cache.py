@@ -0,0 +1,272 @@
+# Copyright (c) 2025, DeepLink.
+import triton
+import triton.language as tl
+from torch import Tensor
+
+from dlblas.kernels.apply_rotary_pos_emb import apply_rotary_pos_emb
+from dlblas.kernels.fill_kv_cache import _get_block_sizes, fill_kv_cache
+from dlblas.utils.device_utils import is_muxi
+from dlblas.utils.utils import next_power_of_2
+
+
+@triton.jit
+def _div_up(val, other):
+    return (val + other - 1) // other
+
+
+@triton.jit
+def _rotate_tile(x_l, x_h, cos_l, cos_h, sin_l, sin_h):
+    """rotary embedding on the low/high halves of a [BLOCK_T, BLOCK_H, BLOCK_N] tile."""
+    x_l = x_l.to(tl.float32)
+    x_h = x_h.to(tl.float32)
+    xe_l = x_l * cos_l[:, None, :] - x_h * sin_l[:, None, :]
+    xe_h = x_h * cos_h[:, None, :] + x_l * sin_h[:, None, :]
+    return xe_l, xe_h
+
+
+@triton.jit
+def apply_rope_fill_kv_cache_kernel(
+    Q,
+    KStates,
+    VStates,
+    COS,
+    SIN,
+    KCaches,
+    VCaches,
+    QStartLoc,
+    QSeqLens,
+    KVSeqLens,
+    BlockOffsets,
+    num_heads_q: tl.constexpr,
+    num_heads: tl.constexpr,
+    head_dim_v: tl.constexpr,
+    half_size: tl.constexpr,
+    stride_qs,
+    stride_qh,
+    stride_qd,
+    stride_kss,
+    stride_ksh,
+    stride_ksd,
+    stride_vss,
+    stride_vsh,
+    stride_vsd,
+    stride_cs,
+    stride_cd,
+    stride_kcn: tl.constexpr,
+    stride_kcb: tl.constexpr,
+    stride_kch: tl.constexpr,
+    stride_kcd: tl.constexpr,
+    stride_vcn: tl.constexpr,
+    stride_vcb: tl.constexpr,
+    stride_vch: tl.constexpr,
+    stride_vcd: tl.constexpr,
+    stride_boff,
+    BLOCK: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+    BLOCK_DV: tl.constexpr,
+    BLOCK_QH: tl.constexpr,
+    BLOCK_H: tl.constexpr,
+    BLOCK_T: tl.constexpr,
+):
+    """rotary embedding + fill kv cache kernel.
+
+    Each program owns the tokens of one cache block. Key states are rotated on the fly and written to the cache,
+    value states are copied, and the query states of the same tokens are rotated in place.
+    """
+    batch_id = tl.program_id(0)
+    block_id = tl.program_id(1)
+
+    h_off = tl.arange(0, BLOCK_H)
+    qh_off = tl.arange(0, BLOCK_QH)
+    n_off = tl.arange(0, BLOCK_N)
+    n_mask = n_off < half_size
+
+    q_startloc = tl.load(QStartLoc + batch_id)
+    q_seqlen = tl.load(QSeqLens + batch_id)
+    kv_seqlen = tl.load(KVSeqLens + batch_id)
+    history_seqlen = kv_seqlen - q_seqlen
+
+    block0_first_tokenloc = history_seqlen % BLOCK
+
+    state_token_offset = tl.maximum(block_id * BLOCK - block0_first_tokenloc, 0)
+    kv_block_id = _div_up(history_seqlen + 1, BLOCK) - 1 + block_id
+    kv_block_id = min(kv_block_id, stride_boff - 1)
+    block_off = tl.load(BlockOffsets + batch_id * stride_boff + kv_block_id)
+
+    cur_startloc = q_startloc + state_token_offset
+    q_ptr = Q + cur_startloc * stride_qs
+    ks_ptr = KStates + cur_startloc * stride_kss
+    vs_ptr = VStates + cur_startloc * stride_vss
+    cs_start = cur_startloc * stride_cs
+
+    kc_ptr = KCaches + block_off * stride_kcn
+    vc_ptr = VCaches + block_off * stride_vcn
+
+    c_first_tokenloc = block0_first_tokenloc
+    if block_id != 0:
+        c_first_tokenloc *= 0
+    c_last_tokenloc = tl.minimum(BLOCK, q_seqlen + block0_first_tokenloc - block_id * BLOCK)
+
+    mask_hn = (h_off[:, None] < num_heads) & n_mask[None, :]
+    mask_qhn = (qh_off[:, None] < num_heads_q) & n_mask[None, :]
+    if BLOCK_DV > 0:
+        dv_off = tl.arange(0, BLOCK_DV)
+        mask_hdv = (h_off[:, None] < num_heads) & (dv_off[None, :] < head_dim_v)
+    # only the tiles holding this program's tokens are visited: one for a decode token, none past the sequence end
+    for t_start in range(c_first_tokenloc // BLOCK_T * BLOCK_T, c_last_tokenloc, BLOCK_T):
+        t_off = t_start + tl.arange(0, BLOCK_T)
+        t_mask = (t_off >= c_first_tokenloc) & (t_off < c_last_tokenloc)
+        s_off = t_off - c_first_tokenloc
+
+        # cos/sin of the tokens, low and high half of the rotary dim
+        cs_off = cs_start + s_off[:, None] * stride_cs + n_off[None, :] * stride_cd
+        cs_mask = t_mask[:, None] & n_mask[None, :]
+        cos_l = tl.load(COS + cs_off, mask=cs_mask, other=0.0).to(tl.float32)
+        cos_h = tl.load(COS + cs_off + half_size * stride_cd, mask=cs_mask, other=0.0).to(tl.float32)
+        sin_l = tl.load(SIN + cs_off, mask=cs_mask, other=0.0).to(tl.float32)
+        sin_h = tl.load(SIN + cs_off + half_size * stride_cd, mask=cs_mask, other=0.0).to(tl.float32)
+
+        # key: rotate and write straight to the cache
+        mask = t_mask[:, None, None] & mask_hn[None, :, :]
+        kl_ptrs = (ks_ptr + s_off[:, None, None] * stride_kss + h_off[None, :, None] * stride_ksh +
+                   n_off[None, None, :] * stride_ksd)
+        kcl_ptrs = (kc_ptr + t_off[:, None, None] * stride_kcb + h_off[None, :, None] * stride_kch +
+                    n_off[None, None, :] * stride_kcd)
+        k_l = tl.load(kl_ptrs, mask=mask, other=0.0)
+        k_h = tl.load(kl_ptrs + half_size * stride_ksd, mask=mask, other=0.0)
+        ke_l, ke_h = _rotate_tile(k_l, k_h, cos_l, cos_h, sin_l, sin_h)
+        tl.store(kcl_ptrs, ke_l.to(KCaches.dtype.element_ty), mask=mask)
+        tl.store(kcl_ptrs + half_size * stride_kcd, ke_h.to(KCaches.dtype.element_ty), mask=mask)
+
+        # query: rotate in place
+        maskq = t_mask[:, None, None] & mask_qhn[None, :, :]
+        ql_ptrs = (q_ptr + s_off[:, None, None] * stride_qs + qh_off[None, :, None] * stride_qh +
+                   n_off[None, None, :] * stride_qd)
+        q_l = tl.load(ql_ptrs, mask=maskq, other=0.0)
+        q_h = tl.load(ql_ptrs + half_size * stride_qd, mask=maskq, other=0.0)
+        qe_l, qe_h = _rotate_tile(q_l, q_h, cos_l, cos_h, sin_l, sin_h)
+        tl.store(ql_ptrs, qe_l.to(Q.dtype.element_ty), mask=maskq)
+        tl.store(ql_ptrs + half_size * stride_qd, qe_h.to(Q.dtype.element_ty), mask=maskq)
+
+        # value: plain copy
+        if BLOCK_DV > 0:
+            maskv = t_mask[:, None, None] & mask_hdv[None, :, :]
+            v = tl.load(
+                vs_ptr + s_off[:, None, None] * stride_vss + h_off[None, :, None] * stride_vsh +
+                dv_off[None, None, :] * stride_vsd,
+                mask=maskv,
+                other=0.0,
+            )
+            tl.store(
+                vc_ptr + t_off[:, None, None] * stride_vcb + h_off[None, :, None] * stride_vch +
+                dv_off[None, None, :] * stride_vcd,
+                v,
+                mask=maskv,
+            )
+
+
+def apply_rope_fill_kv_cache(
+    q_states: Tensor,
+    k_states: Tensor,
+    v_states: Tensor,
+    cos: Tensor,
+    sin: Tensor,
+    k_caches: Tensor,
+    v_caches: Tensor,
+    q_start_loc: Tensor,
+    q_seq_length: Tensor,
+    kv_seq_length: Tensor,
+    max_q_seq_length: int,
+    block_offsets: Tensor,
+):
+    """Apply rotary positional embedding and fill key/value state to cache for paged attention.
+
+    One launch replaces `apply_rotary_pos_emb` followed by `fill_kv_cache`: the rotated key is written to the cache
+    without a round trip through `k_states`, which is left untouched.
+
+    Args:
+        q_states (Tensor): Query state (num_tokens, num_heads_q, head_dim), rotated in place.
+        k_states (Tensor): Key state (num_tokens, num_heads, head_dim).
+        v_states (Tensor): Value state (num_tokens, num_heads, head_dim_v).
+        cos (Tensor): cosine matrix (num_tokens, head_dim).
+        sin (Tensor): sine matrix (num_tokens, head_dim).
+
+    Returns:
+        Tensor: the rotated query states.
+    """
+    if is_muxi():
+        # the muxi cache layout is only handled by the unfused kernels
+        q_states, k_embed = apply_rotary_pos_emb(q_states, k_states, cos, sin, q_embed=q_states)
+        fill_kv_cache(k_embed, v_states, k_caches, v_caches, q_start_loc, q_seq_length, kv_seq_length,
+                      max_q_seq_length, block_offsets)
+        return q_states
+
+    if cos.device != q_states.device:
+        cos = cos.to(device=q_states.device)
+    if sin.device != q_states.device:
+        sin = sin.to(device=q_states.device)
+    cos = cos.flatten(0, -2)
+    sin = sin.flatten(0, -2)
+    if cos.stride() != sin.stride():
+        cos = cos.contiguous()
+        sin = sin.contiguous()
+
+    block_offsets = block_offsets.contiguous()
+    batch_size = block_offsets.size(0)
+    block_size, num_heads, head_dim = k_caches.size()[1:]
+    head_dim_v = v_states.size(-1)
+    num_heads_q = q_states.size(-2)
+    half_size = head_dim // 2
+    max_num_blocks = triton.cdiv(max_q_seq_length, block_size) + 1
+
+    BLOCK = block_size
+    BLOCK_H = next_power_of_2(num_heads)
+    BLOCK_QH = next_power_of_2(num_heads_q)
+    # a tile holds the widest of the q/k heads and the widest of a rotary half and v, same token tiling as fill_kv_cache
+    _, BLOCK_N, BLOCK_DV, BLOCK_T = _get_block_sizes(max(num_heads, num_heads_q), half_size, head_dim_v, block_size)
+    grid = [batch_size, max_num_blocks]
+    apply_rope_fill_kv_cache_kernel[grid](
+        q_states,
+        k_states,
+        v_states,
+        cos,
+        sin,
+        k_caches,
+        v_caches,
+        q_start_loc,
+        q_seq_length,
+        kv_seq_length,
+        block_offsets,
+        num_heads_q=num_heads_q,
+        num_heads=num_heads,
+        head_dim_v=head_dim_v,
+        half_size=half_size,
+        stride_qs=q_states.stride(-3),
+        stride_qh=q_states.stride(-2),
+        stride_qd=q_states.stride(-1),
+        stride_kss=k_states.stride(-3),
+        stride_ksh=k_states.stride(-2),
+        stride_ksd=k_states.stride(-1),
+        stride_vss=v_states.stride(-3),
+        stride_vsh=v_states.stride(-2),
+        stride_vsd=v_states.stride(-1),
+        stride_cs=cos.stride(0),
+        stride_cd=cos.stride(1),
+        stride_kcn=k_caches.stride(0),
+        stride_kcb=k_caches.stride(1),
+        stride_kch=k_caches.stride(2),
+        stride_kcd=k_caches.stride(3),
+        stride_vcn=v_caches.stride(0),
+        stride_vcb=v_caches.stride(1),
+        stride_vch=v_caches.stride(2),
+        stride_vcd=v_caches.stride(3),
+        stride_boff=block_offsets.stride(0),
+        BLOCK=BLOCK,
+        BLOCK_N=BLOCK_N,
+        BLOCK_DV=BLOCK_DV,
+        BLOCK_QH=BLOCK_QH,
+        BLOCK_H=BLOCK_H,
+        BLOCK_T=BLOCK_T,
+        num_warps=4,
+    )
+    return q_states
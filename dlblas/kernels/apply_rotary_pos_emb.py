@@ -5,6 +5,8 @@ import triton
 import triton.language as tl
 from torch import Tensor
 
+from dlblas.utils.rope_cache import get_cos_sin
+
 
 @triton.jit(do_not_specialize=('seq_len', ))
 def apply_rotary_pos_emb_qk_kernel(
@@ -14,6 +16,7 @@ def apply_rotary_pos_emb_qk_kernel(
     SIN,
     Q_EMB,
     K_EMB,
+    POS_IDS,
     seq_len,
     stride_qs: tl.constexpr,
     stride_qh: tl.constexpr,
@@ -31,8 +34,13 @@ def apply_rotary_pos_emb_qk_kernel(
     BLOCK: tl.constexpr,
     BLOCK_QH: tl.constexpr,
     BLOCK_N: tl.constexpr,
+    HAS_POS_IDS: tl.constexpr,
 ):
-    """apply rotary on key AND query kernel."""
+    """apply rotary on key AND query kernel.
+
+    If HAS_POS_IDS, COS/SIN are the cached tables and the row of each token is gathered with POS_IDS on the fly,
+    otherwise COS/SIN hold one row per token.
+    """
     seq_block_id = tl.program_id(0)
     head_id = tl.program_id(1)
 
@@ -46,8 +54,12 @@ def apply_rotary_pos_emb_qk_kernel(
     feat_offset_l = feat_offset_l % half_size
     feat_offset_h = half_size + feat_offset_l
     seq_mask = pos_mask[:, None] and feat_mask[None, :]
-    cs_offset_l = pos_offset[:, None] * feat_size + feat_offset_l[None, :]
-    cs_offset_h = pos_offset[:, None] * feat_size + feat_offset_h[None, :]
+    if HAS_POS_IDS:
+        cs_pos = tl.load(POS_IDS + pos_offset)
+    else:
+        cs_pos = pos_offset
+    cs_offset_l = cs_pos[:, None] * feat_size + feat_offset_l[None, :]
+    cs_offset_h = cs_pos[:, None] * feat_size + feat_offset_h[None, :]
     q_elem_type = Q.dtype.element_ty
     cos_l = tl.load(COS + cs_offset_l).to(q_elem_type)
     cos_h = tl.load(COS + cs_offset_h).to(q_elem_type)
@@ -97,24 +109,33 @@ def apply_rotary_pos_emb_qk_kernel(
 def apply_rotary_pos_emb(
     q: Tensor,
     k: Tensor,
-    cos: Tensor,
-    sin: Tensor,
+    cos: Tensor = None,
+    sin: Tensor = None,
     q_embed: Tensor = None,
     k_embed: Tensor = None,
+    position_ids: Tensor = None,
+    rope_base: float = 10000.0,
 ):
     """Apply rotary positional embedding on query and key.
 
     Args:
         q (Tensor): Query state.
         k (Tensor): Key state.
-        cos (Tensor): cosine matrix (seq_len, dim).
-        sin (Tensor): sine matrix (seq_len, dim).
+        cos (Tensor): cosine matrix (seq_len, dim), or the cached table (max_position, dim) if position_ids is given.
+        sin (Tensor): sine matrix (seq_len, dim), or the cached table (max_position, dim) if position_ids is given.
         q_embed (Tensor): output q, can be same as q
         k_embed (Tensor): output k, can be same as k
+        position_ids (Tensor): position of each token (seq_len, ). The kernel gathers the cos/sin rows itself, so
+            `cos[position_ids]` is never materialized.
+        rope_base (float): base of the rotary frequencies. Only used if cos/sin are not given, in which case the tokens
+            are at positions 0, 1, ... and the tables come from the shared rope cache.
 
     Returns:
         Tuple[Tensor, Tensor]: Embedded query and key.
     """
+    if cos is None or sin is None:
+        assert position_ids is None, 'cos/sin are required together with position_ids'
+        cos, sin = get_cos_sin(q.size(-1), rope_base, q.size(-3), q.device, q.dtype)
     if cos.device != q.device:
         cos = cos.to(device=q.device)
     if sin.device != q.device:
@@ -125,7 +146,12 @@ def apply_rotary_pos_emb(
     if k_embed is None:
         k_embed = torch.empty_like(k)
 
-    seq_len = cos.numel() // cos.size(-1)
+    if position_ids is not None:
+        seq_len = position_ids.numel()
+        cos = cos.contiguous()
+        sin = sin.contiguous()
+    else:
+        seq_len = cos.numel() // cos.size(-1)
     BLOCK = 16
     half_size = q.size(-1) // 2
     BLOCK_N = triton.next_power_of_2(half_size)
@@ -142,6 +168,7 @@ def apply_rotary_pos_emb(
         sin,
         q_embed,
         k_embed,
+        position_ids,
         seq_len=seq_len,
         stride_qs=q.stride(-3),
         stride_qh=q.stride(-2),
@@ -159,7 +186,37 @@ def apply_rotary_pos_emb(
         BLOCK=BLOCK,
         BLOCK_QH=num_heads_q,
         BLOCK_N=BLOCK_N,
+        HAS_POS_IDS=position_ids is not None,
         num_warps=num_warps,
         num_stages=num_stages,
     )
     return q_embed, k_embed
+
+
+def apply_rotary_pos_emb_contiguous(
+    q: Tensor,
+    k: Tensor,
+    cos: Tensor = None,
+    sin: Tensor = None,
+    start_pos: int = 0,
+    q_embed: Tensor = None,
+    k_embed: Tensor = None,
+    rope_base: float = 10000.0,
+):
+    """Apply rotary positional embedding on tokens at the contiguous positions start_pos, start_pos + 1, ...
+
+    This is the common prefill case: the rows of the cached tables are used through a slice, without any gather.
+
+    Args:
+        q (Tensor): Query state.
+        k (Tensor): Key state.
+        cos (Tensor): cached cosine table (max_position, dim), looked up in the shared rope cache if not given.
+        sin (Tensor): cached sine table (max_position, dim), looked up in the shared rope cache if not given.
+        start_pos (int): position of the first token.
+        rope_base (float): base of the rotary frequencies, only used if cos/sin are not given.
+    """
+    seq_len = q.size(-3)
+    if cos is None or sin is None:
+        cos, sin = get_cos_sin(q.size(-1), rope_base, start_pos + seq_len, q.device, q.dtype)
+    return apply_rotary_pos_emb(q, k, cos[start_pos:start_pos + seq_len], sin[start_pos:start_pos + seq_len], q_embed,
+                                k_embed)
@@ -1,12 +1,172 @@
+import os
 from typing import Optional
 
 import torch
+import torch.distributed as dist
 import triton
 import triton.language as tl
-from dlblas.utils.utils import get_tl_tanh
+from dlblas.utils.device_utils import get_device_props, is_cuda
+from dlblas.utils.utils import get_tl_exp, get_tl_tanh, next_power_of_2
 from dlblas.kernels.element_mul import element_mul_kernel
+from dlblas.utils.logger import get_logger
+
+logger = get_logger(__name__)
 
 tanh = get_tl_tanh()
+tl_exp = get_tl_exp()
+
+
+@triton.jit
+def _block_exp(x, HIGH_PRECISION: tl.constexpr):
+    """Exponential of a block of logits, the approximate fast exp is used unless HIGH_PRECISION."""
+    if HIGH_PRECISION:
+        return tl.exp(x)
+    else:
+        return tl_exp(x)
+
+
+@triton.jit
+def _softmax_merge(m_a, d_a, m_b, d_b):
+    """Combine two partial online softmax states (max, sum of exp) into one."""
+    m = tl.maximum(m_a, m_b)
+    # two empty states (m = -inf, d = 0) stay empty instead of e ^ (-inf - -inf) = NaN
+    m_safe = tl.where(m == float('-inf'), 0.0, m)
+    return m, d_a * tl.exp(m_a - m_safe) + d_b * tl.exp(m_b - m_safe)
+
+
+@triton.jit
+def _cross_entropy_grad_block(
+    X_block,
+    X_offsets,
+    y,
+    m,
+    d,
+    lse,
+    weight_ptr,
+    weight_y,
+    n_cols,
+    n_non_ignore,
+    sum_non_ignore_weight,
+    weight_sum,
+    softcap,
+    lse_square_scale: tl.constexpr,
+    label_smoothing: tl.constexpr,
+    reduction: tl.constexpr,
+    HAS_WEIGHT: tl.constexpr,
+    HAS_SOFTCAPPING: tl.constexpr,
+    HIGH_PRECISION: tl.constexpr = True,
+):
+    """
+    Turn a block of (float32, not yet soft-capped) logits into the gradient of the loss w.r.t. them.
+
+    For 'mean' reduction, gradients are normalized by number of non-ignored elements (N)
+    dx_y = (softmax(x_y) - 1) / N
+    dx_i = softmax(x_i) / N, i != y
+    For label smoothing:
+    dx_i = (softmax(x_i) - label_smoothing / V) / N, V = n_cols, i != y
+    dx_y = (softmax(x_y) - label_smoothing / V - (1 - label_smoothing)) / N
+         = dx_i - (1 - label_smoothing) / N
+    With Z loss:
+    dx_i = ((1 + 2 * lse_square_scale * lse) * softmax(x_i) - label_smoothing / V) / N, i != y
+    dx_y = dx_i - (1 - label_smoothing) / N
+    For 'sum' reduction, no normalization is applied:
+    dx_y = softmax(x_y) - 1
+    dx_i = softmax(x_i), for i != y
+    """
+    eps = label_smoothing / n_cols
+    if HAS_SOFTCAPPING:
+        intermediate = tanh(X_block / softcap)
+        X_block = softcap * intermediate
+
+    if not HAS_WEIGHT:
+        # softmax(x_i)
+        X_block = _block_exp(X_block - m, HIGH_PRECISION) / d
+        # derivative of z-loss: 2 * lse_square_scale * lse * softmax(x_i)
+        X_block += 2 * lse_square_scale * lse * X_block
+        # smoothing term
+        X_block += -eps
+        # special handle dx_y
+        X_block = tl.where(X_offsets != y, X_block, X_block - (1 - label_smoothing))
+        # reduction scale
+        if reduction == 'mean':
+            X_block = X_block / n_non_ignore
+    else:
+        weight_block = tl.load(weight_ptr + X_offsets, mask=X_offsets < n_cols)
+        softmax_X = _block_exp(X_block - m, HIGH_PRECISION) / d
+        # derivative of original_loss
+        dloss_ori = (1 - label_smoothing) * softmax_X
+        # specially handle dx_y
+        dloss_ori = tl.where(X_offsets != y, dloss_ori, dloss_ori - (1 - label_smoothing))
+        dloss_ori = dloss_ori * weight_y
+        # derivative of smooth_loss
+        dloss_smooth = eps * (-weight_block + softmax_X * weight_sum)
+        # derivative of z-loss
+        dz_loss = 2 * lse_square_scale * lse * softmax_X
+        # reduction scale
+        if reduction == 'mean':
+            dloss_ori = dloss_ori / sum_non_ignore_weight
+            dloss_smooth = dloss_smooth / sum_non_ignore_weight
+            # TODO: Implement weighted z_loss. Currently, z_loss is not scaled by weight.
+            dz_loss = dz_loss / n_non_ignore
+        # derivative of total_loss
+        X_block = dloss_ori + dloss_smooth + dz_loss
+
+    # chain rule softcapping
+    # d(softcap * tanh(x / softcap)) = (1 - tanh^2(x / softcap))
+    if HAS_SOFTCAPPING:
+        X_block = X_block * (1 - intermediate * intermediate)
+    return X_block
+
+
+@triton.jit
+def _cross_entropy_loss(
+    lse,
+    ori_X_y,
+    scaled_x_sum,
+    weight_y,
+    n_cols,
+    n_non_ignore,
+    sum_non_ignore_weight,
+    weight_sum,
+    lse_square_scale: tl.constexpr,
+    label_smoothing: tl.constexpr,
+    reduction: tl.constexpr,
+    HAS_WEIGHT: tl.constexpr,
+):
+    """
+    Compute the loss and the z loss of one row from its logsumexp.
+
+    loss = log (softmax(X_y)) = log ((e ^ (X_y - max(X)) / sum(e ^ (X - max(X))))
+         = (X_y - max(X)) - log(sum(e ^ (X - max(X))))
+         = X_y - m - log d = X_y - lse
+    sum(e ^ (X - max(X))) must >= 1 because the max term is e ^ 0 = 1
+    So we can safely calculate log (softmax(X_y)) without overflow
+    """
+    loss = lse - ori_X_y
+    if HAS_WEIGHT:
+        loss = weight_y * loss
+
+    if label_smoothing > 0:
+        eps = label_smoothing / n_cols
+        if HAS_WEIGHT:
+            smooth_loss = scaled_x_sum + eps * lse * weight_sum
+        else:
+            smooth_loss = scaled_x_sum + label_smoothing * lse
+        loss = loss * (1 - label_smoothing) + smooth_loss
+
+    # An auxiliary loss, z_loss
+    # Refer to Page14 Loss function section in the paper PaLM: https://www.jmlr.org/papers/v24/22-1144.html
+    z_loss = lse_square_scale * lse * lse
+    # Normalize the loss by the number of non-ignored elements if reduction is "mean"
+    if reduction == 'mean':
+        if HAS_WEIGHT:
+            loss = loss / sum_non_ignore_weight
+        else:
+            loss = loss / n_non_ignore
+        # TODO: Implement weighted z_loss. Currently, z_loss is not scaled by weight.
+        z_loss = z_loss / n_non_ignore
+    loss += z_loss
+    return loss, z_loss
 
 
 @triton.jit
@@ -20,9 +180,9 @@ def liger_cross_entropy_kernel(
     z_loss_ptr,
     loss_stride,
     n_cols,
-    n_non_ignore,
-    sum_non_ignore_weight,
-    weight_sum,
+    n_non_ignore_ptr,
+    sum_non_ignore_weight_ptr,
+    weight_sum_ptr,
     ignore_index,
     lse_square_scale: tl.constexpr,
     label_smoothing: tl.constexpr,
@@ -32,6 +192,10 @@ def liger_cross_entropy_kernel(
     BLOCK_SIZE: tl.constexpr,
     HAS_WEIGHT: tl.constexpr,
     HAS_SOFTCAPPING: tl.constexpr,
+    HIGH_PRECISION: tl.constexpr = True,
+    SINGLE_TILE: tl.constexpr = False,
+    HAS_IGNORE: tl.constexpr = True,
+    LANE_REDUCE: tl.constexpr = False,
 ):
     """
     This kernel computes both cross entropy loss and the gradient of the input.
@@ -48,9 +212,10 @@ def liger_cross_entropy_kernel(
     z_loss_ptr: Pointer to tensor to store the z loss. No operation if RETURN_Z_LOSS is 0.
     loss_stride (int): The stride of the loss tensor.
     n_cols (int): The number of columns in the input tensor.
-    n_non_ignore (float): The number of non-ignored elements in the batch.
-    sum_non_ignore_weight (float): The sum of non-ignored target's weights in the batch.
-    weight_sum (float): The sum of weight tensor.
+    n_non_ignore_ptr: Pointer to the number of non-ignored elements in the batch (float32 scalar).
+    sum_non_ignore_weight_ptr: Pointer to the sum of non-ignored target's weights in the batch (float32 scalar).
+    Only read if HAS_WEIGHT.
+    weight_sum_ptr: Pointer to the sum of weight tensor (float32 scalar). Only read if HAS_WEIGHT.
     ignore_index (int): The index to ignore in the target.
     label_smoothing (float): The amount of smoothing when computing the loss, where 0.0 means no smoothing.
     lse_square_scale (float): The scaler of (logsumexp(_input)) ^ 2 adding to the loss for the stability of training.
@@ -60,6 +225,12 @@ def liger_cross_entropy_kernel(
     BLOCK_SIZE (int): The block size for Triton operations.
     HAS_WEIGHT (bool): The boolean value to determine whether assigning weight to each of the classes.
     HAS_SOFTCAPPING (bool): The boolean value to determine whether applying soft-capping or not.
+    HIGH_PRECISION (bool): If False, the per-element exponentials use the fast approximate exp. The running max,
+    sum and lse are always kept in float32.
+    SINGLE_TILE (bool): Whether n_cols <= BLOCK_SIZE, so the row is read from global memory only once.
+    HAS_IGNORE (bool): Whether the targets may contain ignore_index. If False the ignore branch is not compiled.
+    LANE_REDUCE (bool): Keep a running (max, sum) per lane over the blocks of a long row and combine the lanes with
+    one tree reduction at the end, instead of a cross-lane max and sum on every block.
     """
 
     # https://github.com/triton-lang/triton/issues/1058
@@ -73,167 +244,596 @@ def liger_cross_entropy_kernel(
     # 2. locate the start index
     X_ptr += program_id * X_stride
 
-    if y == ignore_index:
-        # set all X_ptr as 0
-        for i in range(0, n_cols, BLOCK_SIZE):
-            X_offsets = i + tl.arange(0, BLOCK_SIZE)
-            tl.store(X_ptr + X_offsets, 0.0, mask=X_offsets < n_cols)
-        return
+    if HAS_IGNORE:
+        if y == ignore_index:
+            # set all X_ptr as 0
+            for i in range(0, n_cols, BLOCK_SIZE):
+                X_offsets = i + tl.arange(0, BLOCK_SIZE)
+                tl.store(X_ptr + X_offsets, 0.0, mask=X_offsets < n_cols)
+            return
 
     loss_ptr += program_id * loss_stride
     if RETURN_Z_LOSS:
         z_loss_ptr += program_id * loss_stride
 
+    n_non_ignore = tl.load(n_non_ignore_ptr)
+    sum_non_ignore_weight = n_non_ignore
+    weight_sum = 0.0
+    weight_y = 1.0
     if HAS_WEIGHT:
+        sum_non_ignore_weight = tl.load(sum_non_ignore_weight_ptr)
+        weight_sum = tl.load(weight_sum_ptr)
         weight_y = tl.load(weight_ptr + y).cast(tl.float32)
 
     # Online softmax: 2 loads + 1 store (compared with 3 loads + 1 store for the safe softmax)
     # Refer to Algorithm 3 in the paper: https://arxiv.org/pdf/1805.02867
+    # When the whole row fits in one block (SINGLE_TILE), the row is loaded once and kept in registers,
+    # which turns it into 1 load + 1 store.
 
     # 3. [Online softmax] first pass: find max + sum
     m = float('-inf')  # m is the max value. use the notation from the paper
     d = 0.0  # d is the sum. use the notation from the paper
-    ori_X_y = tl.load(X_ptr + y).cast(tl.float32)  # we need to store the original value of X_y for the loss calculation
-    if HAS_SOFTCAPPING:
-        ori_X_y = softcap * tanh(ori_X_y / softcap)
 
     # Label smoothing is a general case of normal cross entropy
     # See the full derivation at https://github.com/linkedin/Liger-Kernel/pull/198#issue-2503665310
     scaled_x_sum = 0.0
     eps = label_smoothing / n_cols
 
-    for i in range(0, n_cols, BLOCK_SIZE):
-        X_offsets = i + tl.arange(0, BLOCK_SIZE)
-        X_block = tl.load(
+    if SINGLE_TILE:
+        X_offsets = tl.arange(0, BLOCK_SIZE)
+        X_row = tl.load(
             X_ptr + X_offsets,
             mask=X_offsets < n_cols,
             other=float('-inf'),
             # Ensure float32 precision for softmax calculation
         ).cast(tl.float32)
+        X_block = X_row
         if HAS_SOFTCAPPING:
             X_block = softcap * tanh(X_block / softcap)
-        block_max = tl.max(X_block)
+        # we need to store the original value of X_y for the loss calculation, the row is already in registers so
+        # it is picked from there instead of a second scattered load
+        ori_X_y = tl.sum(tl.where(X_offsets == y, X_block, 0.0))
         if label_smoothing > 0:
-            # scale X beforehand to avoid overflow
             if HAS_WEIGHT:
                 weight_block = tl.load(weight_ptr + X_offsets, mask=X_offsets < n_cols)
                 scaled_x_sum += tl.sum(tl.where(X_offsets < n_cols, -eps * X_block * weight_block, 0.0))
             else:
                 scaled_x_sum += tl.sum(tl.where(X_offsets < n_cols, -eps * X_block, 0.0))
-        m_new = tl.maximum(m, block_max)
-        d = d * tl.exp(m - m_new) + tl.sum(tl.exp(X_block - m_new))
-        m = m_new
+        m = tl.max(X_block)
+        d = tl.sum(_block_exp(X_block - m, HIGH_PRECISION))
+    else:
+        # we need to store the original value of X_y for the loss calculation
+        ori_X_y = tl.load(X_ptr + y).cast(tl.float32)
+        if HAS_SOFTCAPPING:
+            ori_X_y = softcap * tanh(ori_X_y / softcap)
+        if LANE_REDUCE:
+            m_lane = tl.full((BLOCK_SIZE, ), float('-inf'), dtype=tl.float32)
+            d_lane = tl.zeros((BLOCK_SIZE, ), dtype=tl.float32)
+        for i in range(0, n_cols, BLOCK_SIZE):
+            X_offsets = i + tl.arange(0, BLOCK_SIZE)
+            X_block = tl.load(
+                X_ptr + X_offsets,
+                mask=X_offsets < n_cols,
+                other=float('-inf'),
+                # Ensure float32 precision for softmax calculation
+            ).cast(tl.float32)
+            if HAS_SOFTCAPPING:
+                X_block = softcap * tanh(X_block / softcap)
+            if label_smoothing > 0:
+                # scale X beforehand to avoid overflow
+                if HAS_WEIGHT:
+                    weight_block = tl.load(weight_ptr + X_offsets, mask=X_offsets < n_cols)
+                    scaled_x_sum += tl.sum(tl.where(X_offsets < n_cols, -eps * X_block * weight_block, 0.0))
+                else:
+                    scaled_x_sum += tl.sum(tl.where(X_offsets < n_cols, -eps * X_block, 0.0))
+            if LANE_REDUCE:
+                # a lane that has only seen -inf logits (masked vocab, padding) keeps d = 0, the shift by a finite
+                # m_safe avoids e ^ (-inf - -inf) = NaN
+                m_new = tl.maximum(m_lane, X_block)
+                m_safe = tl.where(m_new == float('-inf'), 0.0, m_new)
+                d_lane = d_lane * tl.exp(m_lane - m_safe) + _block_exp(X_block - m_safe, HIGH_PRECISION)
+                m_lane = m_new
+            else:
+                block_max = tl.max(X_block)
+                m_new = tl.maximum(m, block_max)
+                d = d * tl.exp(m - m_new) + tl.sum(_block_exp(X_block - m_new, HIGH_PRECISION))
+                m = m_new
+        if LANE_REDUCE:
+            m, d = tl.reduce((m_lane, d_lane), 0, _softmax_merge)
 
     # log (sum(e^(X_i))) = log (sum(e ^ (max(X) * e ^ (X_i - max(X)))))
     #                    = log (e^(max(X)) * sum(e ^ (X_i - max(X))))
     #                    = max(X) + log (sum(e ^ (X_i - max(X)))) = m + log d
     lse = m + tl.log(d)
 
-    # 4. [Online Softmax] Second pass: compute gradients
-    # For 'mean' reduction, gradients are normalized by number of non-ignored elements (N)
-    # dx_y = (softmax(x_y) - 1) / N
-    # dx_i = softmax(x_i) / N, i != y
-    # For label smoothing:
-    # dx_i = (softmax(x_i) - label_smoothing / V) / N, V = n_cols, i != y
-    # dx_y = (softmax(x_y) - label_smoothing / V - (1 - label_smoothing)) / N
-    #      = dx_i - (1 - label_smoothing) / N
-    # With Z loss:
-    # dx_i = ((1 + 2 * lse_square_scale * lse) * softmax(x_i) - label_smoothing / V) / N, i != y
-    # dx_y = dx_i - (1 - label_smoothing) / N
-    # For 'sum' reduction, no normalization is applied:
-    # dx_y = softmax(x_y) - 1
-    # dx_i = softmax(x_i), for i ≠ y
-
-    for i in range(0, n_cols, BLOCK_SIZE):
-        X_offsets = i + tl.arange(0, BLOCK_SIZE)
-        X_block = tl.load(
-            X_ptr + X_offsets,
-            mask=X_offsets < n_cols,
-            other=float('-inf'),
-            # Ensure float32 precision for softmax calculation
-        ).cast(tl.float32)
-        if HAS_SOFTCAPPING:
-            intermediate = tanh(X_block / softcap)
-            X_block = softcap * intermediate
-
-        if not HAS_WEIGHT:
-            # softmax(x_i)
-            X_block = tl.exp(X_block - m) / d
-            # derivative of z-loss: 2 * lse_square_scale * lse * softmax(x_i)
-            X_block += 2 * lse_square_scale * lse * X_block
-            # smoothing term
-            X_block += -eps
-            # special handle dx_y
-            X_block = tl.where(X_offsets != y, X_block, X_block - (1 - label_smoothing))
-            # reduction scale
-            if reduction == 'mean':
-                X_block = X_block / n_non_ignore
-        else:
-            weight_block = tl.load(weight_ptr + X_offsets, mask=X_offsets < n_cols)
-            softmax_X = tl.exp(X_block - m) / d
-            # derivative of original_loss
-            dloss_ori = (1 - label_smoothing) * softmax_X
-            # specially handle dx_y
-            dloss_ori = tl.where(X_offsets != y, dloss_ori, dloss_ori - (1 - label_smoothing))
-            dloss_ori = dloss_ori * weight_y
-            # derivative of smooth_loss
-            dloss_smooth = eps * (-weight_block + softmax_X * weight_sum)
-            # derivative of z-loss
-            dz_loss = 2 * lse_square_scale * lse * softmax_X
-            # reduction scale
-            if reduction == 'mean':
-                dloss_ori = dloss_ori / sum_non_ignore_weight
-                dloss_smooth = dloss_smooth / sum_non_ignore_weight
-                # TODO: Implement weighted z_loss. Currently, z_loss is not scaled by weight.
-                dz_loss = dz_loss / n_non_ignore
-            # derivative of total_loss
-            X_block = dloss_ori + dloss_smooth + dz_loss
-
-        # chain rule softcapping
-        # d(softcap * tanh(x / softcap)) = (1 - tanh^2(x / softcap))
-        if HAS_SOFTCAPPING:
-            X_block = X_block * (1 - intermediate * intermediate)
-
+    # 4. [Online Softmax] Second pass: compute gradients, see _cross_entropy_grad_block for the math
+    if SINGLE_TILE:
+        X_offsets = tl.arange(0, BLOCK_SIZE)
+        X_block = _cross_entropy_grad_block(
+            X_row,
+            X_offsets,
+            y,
+            m,
+            d,
+            lse,
+            weight_ptr,
+            weight_y,
+            n_cols,
+            n_non_ignore,
+            sum_non_ignore_weight,
+            weight_sum,
+            softcap,
+            lse_square_scale,
+            label_smoothing,
+            reduction,
+            HAS_WEIGHT,
+            HAS_SOFTCAPPING,
+            HIGH_PRECISION,
+        )
         tl.store(X_ptr + X_offsets, X_block, mask=X_offsets < n_cols)
+    else:
+        for i in range(0, n_cols, BLOCK_SIZE):
+            X_offsets = i + tl.arange(0, BLOCK_SIZE)
+            X_block = tl.load(
+                X_ptr + X_offsets,
+                mask=X_offsets < n_cols,
+                other=float('-inf'),
+                # Ensure float32 precision for softmax calculation
+            ).cast(tl.float32)
+            X_block = _cross_entropy_grad_block(
+                X_block,
+                X_offsets,
+                y,
+                m,
+                d,
+                lse,
+                weight_ptr,
+                weight_y,
+                n_cols,
+                n_non_ignore,
+                sum_non_ignore_weight,
+                weight_sum,
+                softcap,
+                lse_square_scale,
+                label_smoothing,
+                reduction,
+                HAS_WEIGHT,
+                HAS_SOFTCAPPING,
+                HIGH_PRECISION,
+            )
+            tl.store(X_ptr + X_offsets, X_block, mask=X_offsets < n_cols)
 
     # We need tl.debug_barrier() to ensure the new result of X_ptr is written as mentioned in
     # https://github.com/triton-lang/triton/blob/ba42a5c68fd0505f8c42f4202d53be0f8d9a5fe0/python/triton/ops/cross_entropy.py#L34
     tl.debug_barrier()
 
     # 5. Calculate the loss
+    loss, z_loss = _cross_entropy_loss(
+        lse,
+        ori_X_y,
+        scaled_x_sum,
+        weight_y,
+        n_cols,
+        n_non_ignore,
+        sum_non_ignore_weight,
+        weight_sum,
+        lse_square_scale,
+        label_smoothing,
+        reduction,
+        HAS_WEIGHT,
+    )
 
-    # loss = log (softmax(X_y)) = log ((e ^ (X_y - max(X)) / sum(e ^ (X - max(X))))
-    #      = (X_y - max(X)) - log(sum(e ^ (X - max(X))))
-    #      = X_y - m - log d = X_y - lse
-    # sum(e ^ (X - max(X))) must >= 1 because the max term is e ^ 0 = 1
-    # So we can safely calculate log (softmax(X_y)) without overflow
-    loss = lse - ori_X_y
-    if HAS_WEIGHT:
-        loss = weight_y * loss
+    tl.store(loss_ptr, loss)
+    if RETURN_Z_LOSS:
+        tl.store(z_loss_ptr, z_loss)
 
-    if label_smoothing > 0:
-        if HAS_WEIGHT:
-            smooth_loss = scaled_x_sum + eps * lse * weight_sum
-        else:
-            smooth_loss = scaled_x_sum + label_smoothing * lse
-        loss = loss * (1 - label_smoothing) + smooth_loss
 
-    # An auxiliary loss, z_loss
-    # Refer to Page14 Loss function section in the paper PaLM: https://www.jmlr.org/papers/v24/22-1144.html
-    z_loss = lse_square_scale * lse * lse
-    # Normalize the loss by the number of non-ignored elements if reduction is "mean"
-    if reduction == 'mean':
-        if HAS_WEIGHT:
-            loss = loss / sum_non_ignore_weight
+@triton.jit
+def liger_cross_entropy_kernel_basic(
+    X_ptr,
+    X_stride,
+    Y_ptr,
+    Y_stride,
+    loss_ptr,
+    loss_stride,
+    n_cols,
+    n_non_ignore_ptr,
+    ignore_index,
+    BLOCK_SIZE: tl.constexpr,
+    HIGH_PRECISION: tl.constexpr = True,
+    SINGLE_TILE: tl.constexpr = False,
+    HAS_IGNORE: tl.constexpr = True,
+    LANE_REDUCE: tl.constexpr = False,
+):
+    """
+    Lean variant of liger_cross_entropy_kernel for the common case: no class weight, no label smoothing, no
+    soft-capping, no z loss and 'mean' reduction.
+
+    The math is the same as in liger_cross_entropy_kernel with all the optional terms dropped:
+    loss = (lse - X_y) / N, dx_i = (softmax(x_i) - (i == y)) / N.
+    Keeping the hot loop free of the unused features lowers the register pressure on large vocabularies.
+    """
+    program_id = tl.program_id(0).to(tl.int64)
+
+    y = tl.load(Y_ptr + program_id * Y_stride)
+    X_ptr += program_id * X_stride
+
+    if HAS_IGNORE:
+        if y == ignore_index:
+            for i in range(0, n_cols, BLOCK_SIZE):
+                X_offsets = i + tl.arange(0, BLOCK_SIZE)
+                tl.store(X_ptr + X_offsets, 0.0, mask=X_offsets < n_cols)
+            return
+
+    n_non_ignore = tl.load(n_non_ignore_ptr)
+
+    # [Online softmax] first pass: find max + sum
+    m = float('-inf')
+    d = 0.0
+    if SINGLE_TILE:
+        X_offsets = tl.arange(0, BLOCK_SIZE)
+        X_row = tl.load(X_ptr + X_offsets, mask=X_offsets < n_cols, other=float('-inf')).cast(tl.float32)
+        ori_X_y = tl.sum(tl.where(X_offsets == y, X_row, 0.0))
+        m = tl.max(X_row)
+        d = tl.sum(_block_exp(X_row - m, HIGH_PRECISION))
+    else:
+        ori_X_y = tl.load(X_ptr + y).cast(tl.float32)
+        if LANE_REDUCE:
+            # see liger_cross_entropy_kernel
+            m_lane = tl.full((BLOCK_SIZE, ), float('-inf'), dtype=tl.float32)
+            d_lane = tl.zeros((BLOCK_SIZE, ), dtype=tl.float32)
+            for i in range(0, n_cols, BLOCK_SIZE):
+                X_offsets = i + tl.arange(0, BLOCK_SIZE)
+                X_block = tl.load(X_ptr + X_offsets, mask=X_offsets < n_cols, other=float('-inf')).cast(tl.float32)
+                m_new = tl.maximum(m_lane, X_block)
+                m_safe = tl.where(m_new == float('-inf'), 0.0, m_new)
+                d_lane = d_lane * tl.exp(m_lane - m_safe) + _block_exp(X_block - m_safe, HIGH_PRECISION)
+                m_lane = m_new
+            m, d = tl.reduce((m_lane, d_lane), 0, _softmax_merge)
         else:
-            loss = loss / n_non_ignore
-        # TODO: Implement weighted z_loss. Currently, z_loss is not scaled by weight.
-        z_loss = z_loss / n_non_ignore
-    loss += z_loss
+            for i in range(0, n_cols, BLOCK_SIZE):
+                X_offsets = i + tl.arange(0, BLOCK_SIZE)
+                X_block = tl.load(X_ptr + X_offsets, mask=X_offsets < n_cols, other=float('-inf')).cast(tl.float32)
+                m_new = tl.maximum(m, tl.max(X_block))
+                d = d * tl.exp(m - m_new) + tl.sum(_block_exp(X_block - m_new, HIGH_PRECISION))
+                m = m_new
+    lse = m + tl.log(d)
 
-    tl.store(loss_ptr, loss)
-    if RETURN_Z_LOSS:
-        tl.store(z_loss_ptr, z_loss)
+    # [Online softmax] second pass: compute gradients
+    if SINGLE_TILE:
+        X_offsets = tl.arange(0, BLOCK_SIZE)
+        X_block = _block_exp(X_row - m, HIGH_PRECISION) / d
+        X_block = tl.where(X_offsets != y, X_block, X_block - 1.0) / n_non_ignore
+        tl.store(X_ptr + X_offsets, X_block, mask=X_offsets < n_cols)
+    else:
+        for i in range(0, n_cols, BLOCK_SIZE):
+            X_offsets = i + tl.arange(0, BLOCK_SIZE)
+            X_block = tl.load(X_ptr + X_offsets, mask=X_offsets < n_cols, other=float('-inf')).cast(tl.float32)
+            X_block = _block_exp(X_block - m, HIGH_PRECISION) / d
+            X_block = tl.where(X_offsets != y, X_block, X_block - 1.0) / n_non_ignore
+            tl.store(X_ptr + X_offsets, X_block, mask=X_offsets < n_cols)
+
+    # see liger_cross_entropy_kernel
+    tl.debug_barrier()
+
+    tl.store(loss_ptr + program_id * loss_stride, (lse - ori_X_y) / n_non_ignore)
+
+
+@triton.jit
+def liger_cross_entropy_tp_stats_kernel(
+    X_ptr,
+    X_stride,
+    Y_ptr,
+    Y_stride,
+    stats_ptr,
+    n_cols,
+    vocab_start,
+    ignore_index,
+    BLOCK_SIZE: tl.constexpr,
+    HIGH_PRECISION: tl.constexpr = True,
+):
+    """
+    First stage of the vocab parallel cross entropy.
+
+    X_ptr holds the columns [vocab_start, vocab_start + n_cols) of the logits. Every program runs the online softmax
+    on its row of the local shard and writes (m, d, X_y) to stats_ptr of shape [n_rows, 3]. X_y is 0 on the ranks that
+    do not own the target column, so a SUM all-reduce recovers it.
+    """
+    program_id = tl.program_id(0).to(tl.int64)
+
+    y = tl.load(Y_ptr + program_id * Y_stride)
+    if y == ignore_index:
+        return
+
+    X_ptr += program_id * X_stride
+    y_local = y - vocab_start
+    ori_X_y = 0.0
+    if (y_local >= 0) & (y_local < n_cols):
+        ori_X_y = tl.load(X_ptr + y_local).cast(tl.float32)
+
+    m = float('-inf')
+    d = 0.0
+    for i in range(0, n_cols, BLOCK_SIZE):
+        X_offsets = i + tl.arange(0, BLOCK_SIZE)
+        X_block = tl.load(X_ptr + X_offsets, mask=X_offsets < n_cols, other=float('-inf')).cast(tl.float32)
+        m_new = tl.maximum(m, tl.max(X_block))
+        d = d * tl.exp(m - m_new) + tl.sum(_block_exp(X_block - m_new, HIGH_PRECISION))
+        m = m_new
+
+    stats_ptr += program_id * 3
+    tl.store(stats_ptr, m)
+    tl.store(stats_ptr + 1, d)
+    tl.store(stats_ptr + 2, ori_X_y)
+
+
+@triton.jit
+def liger_cross_entropy_tp_grad_kernel(
+    X_ptr,
+    X_stride,
+    Y_ptr,
+    Y_stride,
+    lse_ptr,
+    n_cols,
+    vocab_start,
+    n_non_ignore_ptr,
+    ignore_index,
+    reduction: tl.constexpr,
+    BLOCK_SIZE: tl.constexpr,
+    HIGH_PRECISION: tl.constexpr = True,
+):
+    """
+    Second stage of the vocab parallel cross entropy: overwrite the local logits with their gradients, given the
+    global lse of the row. softmax(x_i) = e ^ (x_i - lse), so the gradient is _cross_entropy_grad_block with m = lse
+    and d = 1.
+    """
+    program_id = tl.program_id(0).to(tl.int64)
+
+    y = tl.load(Y_ptr + program_id * Y_stride)
+    X_ptr += program_id * X_stride
+
+    if y == ignore_index:
+        for i in range(0, n_cols, BLOCK_SIZE):
+            X_offsets = i + tl.arange(0, BLOCK_SIZE)
+            tl.store(X_ptr + X_offsets, 0.0, mask=X_offsets < n_cols)
+        return
+
+    # the target column is only matched on the rank that owns it
+    y_local = y - vocab_start
+    lse = tl.load(lse_ptr + program_id)
+    n_non_ignore = tl.load(n_non_ignore_ptr)
+    for i in range(0, n_cols, BLOCK_SIZE):
+        X_offsets = i + tl.arange(0, BLOCK_SIZE)
+        X_block = tl.load(X_ptr + X_offsets, mask=X_offsets < n_cols, other=float('-inf')).cast(tl.float32)
+        X_block = _cross_entropy_grad_block(
+            X_block,
+            X_offsets,
+            y_local,
+            lse,
+            1.0,
+            lse,
+            None,
+            1.0,
+            n_cols,
+            n_non_ignore,
+            n_non_ignore,
+            0.0,
+            None,
+            0.0,
+            0.0,
+            reduction,
+            False,
+            False,
+            HIGH_PRECISION,
+        )
+        tl.store(X_ptr + X_offsets, X_block, mask=X_offsets < n_cols)
+
+
+def get_autotune_config():
+    if not is_cuda():
+        return [triton.Config({}, num_stages=1, num_warps=32)]
+    return [triton.Config({}, num_stages=s, num_warps=w) for s in [1, 2, 3] for w in [4, 8, 16, 32]]
+
+
+# The row-wise kernels overwrite the logits with the gradients, so every trial of the autotuner starts from a copy.
+# liger_cross_entropy_kernel itself stays untuned for callers that pick their own launch config.
+liger_cross_entropy_kernel_tuned = triton.autotune(
+    configs=get_autotune_config(),
+    key=['n_cols', 'HAS_WEIGHT', 'HAS_SOFTCAPPING'],
+    restore_value=['X_ptr'],
+)(liger_cross_entropy_kernel)
+liger_cross_entropy_kernel_basic_tuned = triton.autotune(
+    configs=get_autotune_config(),
+    key=['n_cols'],
+    restore_value=['X_ptr'],
+)(liger_cross_entropy_kernel_basic)
+
+
+@triton.jit
+def liger_cross_entropy_split_stats_kernel(
+    X_ptr,
+    X_stride,
+    Y_ptr,
+    Y_stride,
+    weight_ptr,
+    stats_ptr,
+    x_y_ptr,
+    n_cols,
+    cols_per_split,
+    ignore_index,
+    softcap,
+    label_smoothing: tl.constexpr,
+    SPLIT: tl.constexpr,
+    BLOCK_SIZE: tl.constexpr,
+    HAS_WEIGHT: tl.constexpr,
+    HAS_SOFTCAPPING: tl.constexpr,
+    HIGH_PRECISION: tl.constexpr = True,
+    HAS_IGNORE: tl.constexpr = True,
+):
+    """
+    First stage of the split-V cross entropy, used when there are too few rows to fill the device.
+
+    Each row is split over SPLIT programs along the vocab axis. Every program runs the online softmax on its own
+    cols_per_split columns and writes the partial (m, d, scaled_x_sum) to stats_ptr of shape [n_rows, SPLIT, 3].
+    The program owning the first split also saves the (soft-capped) X_y to x_y_ptr, because the second stage
+    overwrites the logits with gradients.
+    """
+    program_id = tl.program_id(0).to(tl.int64)
+    split_id = tl.program_id(1)
+
+    y = tl.load(Y_ptr + program_id * Y_stride)
+    if HAS_IGNORE:
+        if y == ignore_index:
+            return
+
+    X_ptr += program_id * X_stride
+    col_start = split_id * cols_per_split
+    col_end = tl.minimum(col_start + cols_per_split, n_cols)
+
+    if split_id == 0:
+        ori_X_y = tl.load(X_ptr + y).cast(tl.float32)
+        if HAS_SOFTCAPPING:
+            ori_X_y = softcap * tanh(ori_X_y / softcap)
+        tl.store(x_y_ptr + program_id, ori_X_y)
+
+    m = float('-inf')
+    d = 0.0
+    scaled_x_sum = 0.0
+    eps = label_smoothing / n_cols
+    for i in range(col_start, col_end, BLOCK_SIZE):
+        X_offsets = i + tl.arange(0, BLOCK_SIZE)
+        X_block = tl.load(X_ptr + X_offsets, mask=X_offsets < col_end, other=float('-inf')).cast(tl.float32)
+        if HAS_SOFTCAPPING:
+            X_block = softcap * tanh(X_block / softcap)
+        if label_smoothing > 0:
+            if HAS_WEIGHT:
+                weight_block = tl.load(weight_ptr + X_offsets, mask=X_offsets < col_end)
+                scaled_x_sum += tl.sum(tl.where(X_offsets < col_end, -eps * X_block * weight_block, 0.0))
+            else:
+                scaled_x_sum += tl.sum(tl.where(X_offsets < col_end, -eps * X_block, 0.0))
+        m_new = tl.maximum(m, tl.max(X_block))
+        d = d * tl.exp(m - m_new) + tl.sum(_block_exp(X_block - m_new, HIGH_PRECISION))
+        m = m_new
+
+    stats_ptr += (program_id * SPLIT + split_id) * 3
+    tl.store(stats_ptr, m)
+    tl.store(stats_ptr + 1, d)
+    tl.store(stats_ptr + 2, scaled_x_sum)
+
+
+@triton.jit
+def liger_cross_entropy_split_grad_kernel(
+    X_ptr,
+    X_stride,
+    Y_ptr,
+    Y_stride,
+    weight_ptr,
+    stats_ptr,
+    x_y_ptr,
+    loss_ptr,
+    z_loss_ptr,
+    loss_stride,
+    n_cols,
+    cols_per_split,
+    n_non_ignore_ptr,
+    sum_non_ignore_weight_ptr,
+    weight_sum_ptr,
+    ignore_index,
+    lse_square_scale: tl.constexpr,
+    label_smoothing: tl.constexpr,
+    reduction: tl.constexpr,
+    softcap,
+    RETURN_Z_LOSS: tl.constexpr,
+    SPLIT: tl.constexpr,
+    BLOCK_SIZE: tl.constexpr,
+    HAS_WEIGHT: tl.constexpr,
+    HAS_SOFTCAPPING: tl.constexpr,
+    HIGH_PRECISION: tl.constexpr = True,
+    HAS_IGNORE: tl.constexpr = True,
+):
+    """
+    Second stage of the split-V cross entropy.
+
+    Every program combines the SPLIT partial (m, d) of its row into the global lse, then writes the gradients of
+    its own columns in place. The program owning the first split also writes the loss of the row.
+    """
+    program_id = tl.program_id(0).to(tl.int64)
+    split_id = tl.program_id(1)
+
+    y = tl.load(Y_ptr + program_id * Y_stride)
+    X_ptr += program_id * X_stride
+    col_start = split_id * cols_per_split
+    col_end = tl.minimum(col_start + cols_per_split, n_cols)
+
+    if HAS_IGNORE:
+        if y == ignore_index:
+            for i in range(col_start, col_end, BLOCK_SIZE):
+                X_offsets = i + tl.arange(0, BLOCK_SIZE)
+                tl.store(X_ptr + X_offsets, 0.0, mask=X_offsets < col_end)
+            return
+
+    # log-sum-exp combine of the partial results: m = max(m_i), d = sum(d_i * e ^ (m_i - m))
+    stats_ptr += program_id * SPLIT * 3 + tl.arange(0, SPLIT) * 3
+    m_part = tl.load(stats_ptr)
+    d_part = tl.load(stats_ptr + 1)
+    m = tl.max(m_part)
+    d = tl.sum(d_part * tl.exp(m_part - m))
+    lse = m + tl.log(d)
+
+    n_non_ignore = tl.load(n_non_ignore_ptr)
+    sum_non_ignore_weight = n_non_ignore
+    weight_sum = 0.0
+    weight_y = 1.0
+    if HAS_WEIGHT:
+        sum_non_ignore_weight = tl.load(sum_non_ignore_weight_ptr)
+        weight_sum = tl.load(weight_sum_ptr)
+        weight_y = tl.load(weight_ptr + y).cast(tl.float32)
+
+    for i in range(col_start, col_end, BLOCK_SIZE):
+        X_offsets = i + tl.arange(0, BLOCK_SIZE)
+        X_block = tl.load(X_ptr + X_offsets, mask=X_offsets < col_end, other=float('-inf')).cast(tl.float32)
+        X_block = _cross_entropy_grad_block(
+            X_block,
+            X_offsets,
+            y,
+            m,
+            d,
+            lse,
+            weight_ptr,
+            weight_y,
+            n_cols,
+            n_non_ignore,
+            sum_non_ignore_weight,
+            weight_sum,
+            softcap,
+            lse_square_scale,
+            label_smoothing,
+            reduction,
+            HAS_WEIGHT,
+            HAS_SOFTCAPPING,
+            HIGH_PRECISION,
+        )
+        tl.store(X_ptr + X_offsets, X_block, mask=X_offsets < col_end)
+
+    if split_id == 0:
+        scaled_x_sum = tl.sum(tl.load(stats_ptr + 2))
+        ori_X_y = tl.load(x_y_ptr + program_id)
+        loss, z_loss = _cross_entropy_loss(
+            lse,
+            ori_X_y,
+            scaled_x_sum,
+            weight_y,
+            n_cols,
+            n_non_ignore,
+            sum_non_ignore_weight,
+            weight_sum,
+            lse_square_scale,
+            label_smoothing,
+            reduction,
+            HAS_WEIGHT,
+        )
+        tl.store(loss_ptr + program_id * loss_stride, loss)
+        if RETURN_Z_LOSS:
+            tl.store(z_loss_ptr + program_id * loss_stride, z_loss)
 
 
 # The hard limit of TRITON_MAX_TENSOR_NUMEL is 1048576
@@ -241,6 +841,128 @@ def liger_cross_entropy_kernel(
 # However, setting limit as 65536 as in LayerNorm tutorial is faster because of less register spilling
 # The optimal maximum block size depends on your hardware, your kernel, and your dtype
 MAX_FUSED_SIZE = 65536 // 2  # the best size we found by manually tuning
+# Bounds checks on the targets need a device to host sync, so they are only run when debugging
+DLBLAS_DEBUG = os.environ.get('DLBLAS_DEBUG', '0') == '1'
+# Set DLBLAS_CE_NO_IGNORE=1 to promise that the targets never contain ignore_index, which skips the target mask on
+# the host and compiles the kernels without the ignore branch
+DLBLAS_CE_NO_IGNORE = os.environ.get('DLBLAS_CE_NO_IGNORE', '0') == '1'
+# Set DLBLAS_CE_FAST_EXP=1 to use the approximate fast exp for half precision logits. Its error is below the input
+# resolution, but it changes the numerics of the loss and gradients, so the accurate exp stays the default
+DLBLAS_CE_FAST_EXP = os.environ.get('DLBLAS_CE_FAST_EXP', '0') == '1'
+# Vocab sizes tuned by warmup_cross_entropy, and the number of rows of the warmup batch
+WARMUP_VOCAB_SIZES = (32000, 50257, 128256, 200064)
+WARMUP_NUM_ROWS = 512
+# Every split of the split-V path handles at least this many columns, smaller splits are not worth a second launch
+MIN_SPLIT_SIZE = 4096
+
+
+def _get_target_mask(target, ignore_index):
+    """Mask of the non-ignored targets and their number as a float32 device scalar.
+
+    The mask is None if DLBLAS_CE_NO_IGNORE is set, then every target counts.
+    """
+    if DLBLAS_CE_NO_IGNORE:
+        return None, torch.full((), target.numel(), dtype=torch.float32, device=target.device)
+    target_mask = target != ignore_index
+    return target_mask, target_mask.sum(dtype=torch.float32)
+
+
+def _sum_non_ignore_weight(weight, target, target_mask):
+    """Sum of the class weights of the non-ignored targets, without the host sync of masked_select."""
+    if target_mask is None:
+        return weight.gather(0, target).sum(dtype=torch.float32)
+    safe_target = target.masked_fill(~target_mask, 0)
+    return torch.where(target_mask, weight.gather(0, safe_target), 0).sum(dtype=torch.float32)
+
+
+def _get_num_splits(n_rows, n_cols):
+    """Number of programs each row is split into along the vocab axis, 1 if the rows already fill the device."""
+    if not is_cuda():
+        return 1
+    num_sms = get_device_props()['multi_processor_count']
+    if n_rows >= num_sms:
+        return 1
+    split = min(num_sms // n_rows, n_cols // MIN_SPLIT_SIZE)
+    if split < 2:
+        return 1
+    # the partial results of a row are combined with tl.arange(0, SPLIT)
+    return 1 << (split.bit_length() - 1)
+
+
+def _cross_entropy_rows_forward(
+    _input,
+    target,
+    weight,
+    loss_1d,
+    z_loss_1d,
+    target_mask,
+    n_non_ignore,
+    sum_non_ignore_weight,
+    weight_sum,
+    ignore_index,
+    lse_square_scale,
+    label_smoothing,
+    reduction,
+    softcap,
+    return_z_loss,
+    HIGH_PRECISION,
+):
+    """One program per row cross entropy, the gradient overwrites _input.
+
+    The program of an ignored row only writes zeros over its gradient, a single write pass without any read.
+    """
+    BT, V = _input.shape
+    BLOCK_SIZE = min(MAX_FUSED_SIZE, next_power_of_2(V))
+    # with only a few blocks per row the serial online softmax is cheaper than the extra per lane state
+    LANE_REDUCE = V >= 4 * BLOCK_SIZE
+
+    if (weight is None and label_smoothing == 0.0 and softcap is None and lse_square_scale == 0.0
+            and reduction == 'mean' and not return_z_loss):
+        liger_cross_entropy_kernel_basic_tuned[(BT, )](
+            X_ptr=_input,
+            X_stride=_input.stride(-2),
+            Y_ptr=target,
+            Y_stride=target.stride(-1),
+            loss_ptr=loss_1d,
+            loss_stride=loss_1d.stride(-1),
+            n_cols=V,
+            n_non_ignore_ptr=n_non_ignore,
+            ignore_index=ignore_index,
+            BLOCK_SIZE=BLOCK_SIZE,
+            HIGH_PRECISION=HIGH_PRECISION,
+            SINGLE_TILE=V <= BLOCK_SIZE,
+            HAS_IGNORE=target_mask is not None,
+            LANE_REDUCE=LANE_REDUCE,
+        )
+    else:
+        # Here we use a trick to store X_ptr gradient in X_ptr so we can save memory
+        liger_cross_entropy_kernel_tuned[(BT, )](
+            X_ptr=_input,
+            X_stride=_input.stride(-2),
+            Y_ptr=target,
+            Y_stride=target.stride(-1),  # always 1
+            weight_ptr=weight,  # dummy if None
+            loss_ptr=loss_1d,
+            z_loss_ptr=z_loss_1d,
+            loss_stride=loss_1d.stride(-1),  # always 1
+            n_cols=V,
+            n_non_ignore_ptr=n_non_ignore,
+            sum_non_ignore_weight_ptr=sum_non_ignore_weight,
+            weight_sum_ptr=weight_sum,
+            ignore_index=ignore_index,
+            lse_square_scale=lse_square_scale,
+            label_smoothing=label_smoothing,
+            reduction=reduction,
+            softcap=softcap,
+            RETURN_Z_LOSS=return_z_loss,
+            BLOCK_SIZE=BLOCK_SIZE,
+            HAS_WEIGHT=True if weight is not None else False,
+            HAS_SOFTCAPPING=True if softcap is not None else False,
+            HIGH_PRECISION=HIGH_PRECISION,
+            SINGLE_TILE=V <= BLOCK_SIZE,
+            HAS_IGNORE=target_mask is not None,
+            LANE_REDUCE=LANE_REDUCE,
+        )
 
 
 def cross_entropy_forward(
@@ -259,25 +981,26 @@ def cross_entropy_forward(
     BT, V = _input.shape
     n_rows = BT
 
-    BLOCK_SIZE = min(MAX_FUSED_SIZE, triton.next_power_of_2(V))
-
     # unreduced loss
     loss_1d = torch.zeros(n_rows, dtype=_input.dtype, device=_input.device)
     z_loss_1d = torch.zeros(n_rows, dtype=_input.dtype, device=_input.device) if return_z_loss else None
 
-    target_mask = target != ignore_index
-    n_non_ignore = target_mask.sum().item()
-    assert (target * target_mask).max() < _input.shape[-1], (
-        f"Target {target.max()} is out of bounds. Expected < {_input.shape[-1]}")
-    assert (target * target_mask).min() >= 0, f"Target {target.min()} is out of bounds. Expected >= 0"
+    # The reductions below stay on the device and are read by the kernels
+    target_mask, n_non_ignore = _get_target_mask(target, ignore_index)
+    HAS_IGNORE = target_mask is not None
+    if DLBLAS_DEBUG:
+        valid_target = target * target_mask if HAS_IGNORE else target
+        assert valid_target.max() < _input.shape[-1], (
+            f"Target {target.max()} is out of bounds. Expected < {_input.shape[-1]}")
+        assert valid_target.min() >= 0, f"Target {target.min()} is out of bounds. Expected >= 0"
     sum_non_ignore_weight = n_non_ignore
-    weight_sum = 0.0
+    weight_sum = n_non_ignore  # dummy if weight is None
     if weight is not None:
         assert weight.shape[0] == V, f"If given, weight has to be a Tensor of size V. Got: {weight.shape}"
         assert torch.is_floating_point(weight), (
             f"If given, weight has to be a Tensor of floating point dtype. Got: {weight.dtype}")
-        sum_non_ignore_weight = torch.gather(weight, dim=0, index=target.masked_select(target_mask)).sum().item()
-        weight_sum = weight.sum().item()
+        sum_non_ignore_weight = _sum_non_ignore_weight(weight, target, target_mask)
+        weight_sum = weight.sum(dtype=torch.float32)
         # ensure weight is contiguous
         if weight.stride(-1) != 1:
             weight = weight.contiguous()
@@ -288,67 +1011,204 @@ def cross_entropy_forward(
     if target.stride(-1) != 1:
         target = target.contiguous()
 
-    # Here we use a trick to store X_ptr gradient in X_ptr so we can save memory
-    liger_cross_entropy_kernel[(n_rows, )](
+    # The approximate exp is opt-in and only for half precision logits. Soft-capping and label smoothing accumulate
+    # over the whole row and keep the accurate exp.
+    HIGH_PRECISION = (not DLBLAS_CE_FAST_EXP or _input.dtype == torch.float32 or softcap is not None
+                      or label_smoothing > 0)
+
+    SPLIT = _get_num_splits(n_rows, V)
+    if SPLIT > 1:
+        # Few rows and a large vocab: split each row over SPLIT programs so that all SMs get work
+        cols_per_split = triton.cdiv(V, SPLIT)
+        SPLIT_BLOCK_SIZE = min(MAX_FUSED_SIZE, next_power_of_2(cols_per_split))
+        stats = torch.empty(n_rows, SPLIT, 3, dtype=torch.float32, device=_input.device)
+        x_y = torch.empty(n_rows, dtype=torch.float32, device=_input.device)
+        liger_cross_entropy_split_stats_kernel[(n_rows, SPLIT)](
+            X_ptr=_input,
+            X_stride=_input.stride(-2),
+            Y_ptr=target,
+            Y_stride=target.stride(-1),
+            weight_ptr=weight,
+            stats_ptr=stats,
+            x_y_ptr=x_y,
+            n_cols=V,
+            cols_per_split=cols_per_split,
+            ignore_index=ignore_index,
+            softcap=softcap,
+            label_smoothing=label_smoothing,
+            SPLIT=SPLIT,
+            BLOCK_SIZE=SPLIT_BLOCK_SIZE,
+            HAS_WEIGHT=True if weight is not None else False,
+            HAS_SOFTCAPPING=True if softcap is not None else False,
+            HIGH_PRECISION=HIGH_PRECISION,
+            HAS_IGNORE=HAS_IGNORE,
+            num_warps=16,
+        )
+        liger_cross_entropy_split_grad_kernel[(n_rows, SPLIT)](
+            X_ptr=_input,
+            X_stride=_input.stride(-2),
+            Y_ptr=target,
+            Y_stride=target.stride(-1),
+            weight_ptr=weight,
+            stats_ptr=stats,
+            x_y_ptr=x_y,
+            loss_ptr=loss_1d,
+            z_loss_ptr=z_loss_1d,
+            loss_stride=loss_1d.stride(-1),
+            n_cols=V,
+            cols_per_split=cols_per_split,
+            n_non_ignore_ptr=n_non_ignore,
+            sum_non_ignore_weight_ptr=sum_non_ignore_weight,
+            weight_sum_ptr=weight_sum,
+            ignore_index=ignore_index,
+            lse_square_scale=lse_square_scale,
+            label_smoothing=label_smoothing,
+            reduction=reduction,
+            softcap=softcap,
+            RETURN_Z_LOSS=return_z_loss,
+            SPLIT=SPLIT,
+            BLOCK_SIZE=SPLIT_BLOCK_SIZE,
+            HAS_WEIGHT=True if weight is not None else False,
+            HAS_SOFTCAPPING=True if softcap is not None else False,
+            HIGH_PRECISION=HIGH_PRECISION,
+            HAS_IGNORE=HAS_IGNORE,
+            num_warps=16,
+        )
+    else:
+        _cross_entropy_rows_forward(
+            _input,
+            target,
+            weight,
+            loss_1d,
+            z_loss_1d,
+            target_mask,
+            n_non_ignore,
+            sum_non_ignore_weight,
+            weight_sum,
+            ignore_index,
+            lse_square_scale,
+            label_smoothing,
+            reduction,
+            softcap,
+            return_z_loss,
+            HIGH_PRECISION,
+        )
+
+    if reduction == 'none':
+        loss = loss_1d
+        z_loss = z_loss_1d if return_z_loss else None
+    else:
+        loss = torch.sum(loss_1d)
+        z_loss = torch.sum(z_loss_1d) if return_z_loss else None
+
+    return loss, z_loss, _input
+
+
+def warmup_cross_entropy(dtype: torch.dtype = torch.bfloat16, device: str = 'cuda'):
+    """Autotune the row-wise kernels for the common vocab sizes ahead of time.
+
+    The tuned config is keyed on the vocab size only, so one forward per size is enough. The results live in the
+    autotuner of this process, the compiled kernels also land in the triton cache dir.
+    """
+    n_rows = max(WARMUP_NUM_ROWS, get_device_props()['multi_processor_count']) if is_cuda() else WARMUP_NUM_ROWS
+    for V in WARMUP_VOCAB_SIZES:
+        logits = torch.randn(n_rows, V, dtype=dtype, device=device)
+        target = torch.randint(0, V, (n_rows, ), device=device)
+        cross_entropy_forward(logits, target, None, -100, 0.0, 0.0, 'mean', None, False)
+        del logits, target
+    logger.debug('cross_entropy warmup done')
+
+
+def cross_entropy_tp_forward(_input, target, vocab_start_index, group, ignore_index, reduction):
+    """Vocab parallel cross entropy forward, _input (BT, V_shard) holds the local columns of the logits.
+
+    Instead of gathering the full BT x V logits, every rank reduces its shard to (m, d, X_y) per row. One MAX
+    all-reduce of m and one SUM all-reduce of (d * e ^ (m_local - m), X_y) give the global lse, which is all the
+    gradient pass needs.
+    """
+    BT, V = _input.shape
+    BLOCK_SIZE = min(MAX_FUSED_SIZE, next_power_of_2(V))
+
+    if _input.stride(-1) != 1:
+        _input = _input.contiguous()
+    if target.stride(-1) != 1:
+        target = target.contiguous()
+    target_mask = target != ignore_index
+    n_non_ignore = target_mask.sum(dtype=torch.float32)
+    HIGH_PRECISION = not DLBLAS_CE_FAST_EXP or _input.dtype == torch.float32
+
+    stats = torch.zeros(BT, 3, dtype=torch.float32, device=_input.device)
+    liger_cross_entropy_tp_stats_kernel[(BT, )](
+        X_ptr=_input,
+        X_stride=_input.stride(-2),
+        Y_ptr=target,
+        Y_stride=target.stride(-1),
+        stats_ptr=stats,
+        n_cols=V,
+        vocab_start=vocab_start_index,
+        ignore_index=ignore_index,
+        BLOCK_SIZE=BLOCK_SIZE,
+        HIGH_PRECISION=HIGH_PRECISION,
+        num_warps=32,
+    )
+
+    m_local = stats[:, 0]
+    m = m_local.clone()
+    dist.all_reduce(m, op=dist.ReduceOp.MAX, group=group)
+    # stats[:, 1:] becomes (d * e ^ (m_local - m), X_y), summed over the ranks
+    stats[:, 1].mul_(torch.exp(m_local - m))
+    d_x_y = stats[:, 1:].contiguous()
+    dist.all_reduce(d_x_y, op=dist.ReduceOp.SUM, group=group)
+    d, x_y = d_x_y.unbind(-1)
+    # ignored rows keep d = 0, their lse is never read
+    lse = m + torch.log(d)
+
+    liger_cross_entropy_tp_grad_kernel[(BT, )](
         X_ptr=_input,
         X_stride=_input.stride(-2),
         Y_ptr=target,
-        Y_stride=target.stride(-1),  # always 1
-        weight_ptr=weight,  # dummy if None
-        loss_ptr=loss_1d,
-        z_loss_ptr=z_loss_1d,
-        loss_stride=loss_1d.stride(-1),  # always 1
+        Y_stride=target.stride(-1),
+        lse_ptr=lse,
         n_cols=V,
-        n_non_ignore=n_non_ignore,
-        sum_non_ignore_weight=sum_non_ignore_weight,
+        vocab_start=vocab_start_index,
+        n_non_ignore_ptr=n_non_ignore,
         ignore_index=ignore_index,
-        weight_sum=weight_sum,
-        lse_square_scale=lse_square_scale,
-        label_smoothing=label_smoothing,
         reduction=reduction,
-        softcap=softcap,
-        RETURN_Z_LOSS=return_z_loss,
         BLOCK_SIZE=BLOCK_SIZE,
-        HAS_WEIGHT=True if weight is not None else False,
-        HAS_SOFTCAPPING=True if softcap is not None else False,
-        # TODO: 32 seems to give the best performance
-        # Performance is quite sensitive to num_warps
+        HIGH_PRECISION=HIGH_PRECISION,
         num_warps=32,
     )
 
+    loss_1d = torch.where(target_mask, lse - x_y, 0.0)
     if reduction == 'none':
         loss = loss_1d
-        z_loss = z_loss_1d if return_z_loss else None
+    elif reduction == 'sum':
+        loss = loss_1d.sum()
     else:
-        loss = torch.sum(loss_1d)
-        z_loss = torch.sum(z_loss_1d) if return_z_loss else None
-
-    return loss, z_loss, _input
+        loss = loss_1d.sum() / n_non_ignore
+    return loss.to(_input.dtype), _input
 
 
 def cross_entropy_backward(_input, grad_output):
-    # If cross entropy is the last layer, grad_output is 1.0. Skip the mul to save time
-    if torch.equal(grad_output, torch.tensor(1.0, device=grad_output.device)):
-        pass
-    # If reduction is 'none'
-    elif grad_output.ndim > 0:
-        _input = _input * grad_output.unsqueeze(dim=1)
-    # If reduction is ['mean', 'sum'], grad_output is just a scalar
+    # If reduction is ['mean', 'sum'], grad_output is just a scalar, if reduction is 'none' it holds one value per row.
+    # Both cases scale _input in place, there is no second BT x V buffer.
     # We use a Triton kernel instead of a PyTorch operation because modifying inputs in-place
     # for gradient storage and backward multiple times causes anomalies with PyTorch but not with Triton.
-    else:
-        BT, V = _input.shape
-        n_rows = BT
-        BLOCK_SIZE = min(MAX_FUSED_SIZE, triton.next_power_of_2(V))
+    # If cross entropy is the last layer, grad_output is 1.0 and the kernel skips the mul on device, which saves the
+    # host sync of comparing grad_output on the host.
+    BT, V = _input.shape
+    n_rows = BT
+    BLOCK_SIZE = min(MAX_FUSED_SIZE, next_power_of_2(V))
 
-        element_mul_kernel[(n_rows, )](
-            _input,
-            _input.stride(-2),
-            grad_output,
-            V,
-            BLOCK_SIZE=BLOCK_SIZE,
-            num_warps=32,
-        )
+    element_mul_kernel[(n_rows, )](
+        _input,
+        _input.stride(-2),
+        grad_output,
+        V,
+        BLOCK_SIZE=BLOCK_SIZE,
+        grad_output_stride=grad_output.stride(0) if grad_output.ndim > 0 else 0,
+        num_warps=32,
+    )
 
     return _input
 
@@ -440,3 +1300,56 @@ class LigerCrossEntropyFunction(torch.autograd.Function):
             None,
             None,
         )
+
+
+class LigerCrossEntropyTPFunction(torch.autograd.Function):
+    """
+    Cross entropy on logits sharded along the vocab axis over the ranks of a tensor parallel group.
+    Only hard labels without class weight, label smoothing, soft-capping or z loss are supported.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        _input: torch.Tensor,
+        target: torch.Tensor,
+        vocab_start_index: int,
+        group: Optional[dist.ProcessGroup] = None,
+        ignore_index: int = -100,
+        reduction: str = 'mean',
+    ):
+        """
+        Parameters:
+        ctx : The context object.
+        _input (tensor): The local logits of shape (BT, V_shard), the columns [vocab_start_index,
+        vocab_start_index + V_shard) of the full logits.
+        target (tensor): The target tensor of shape (BT), the same on every rank, each value is in [0, V-1].
+        vocab_start_index (int): The first vocab index held by this rank.
+        group (ProcessGroup, optional): The tensor parallel group, the default group if None.
+        ignore_index (int): The index to ignore in the target.
+        reduction (str): The reduction to apply to the output: "none" | "mean | "sum".
+
+        Returns:
+        tensor: The loss, the same on every rank.
+        """
+        loss, _input = cross_entropy_tp_forward(_input, target, vocab_start_index, group, ignore_index, reduction)
+        ctx.save_for_backward(_input.detach())
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        (_input, ) = ctx.saved_tensors
+        _input = cross_entropy_backward(_input, grad_output)
+        return _input, None, None, None, None, None
+
+
+def cross_entropy_tp(
+    _input: torch.Tensor,
+    target: torch.Tensor,
+    vocab_start_index: int,
+    group: Optional[dist.ProcessGroup] = None,
+    ignore_index: int = -100,
+    reduction: str = 'mean',
+):
+    """Vocab parallel cross entropy, see LigerCrossEntropyTPFunction."""
+    return LigerCrossEntropyTPFunction.apply(_input, target, vocab_start_index, group, ignore_index, reduction)
@@ -9,10 +9,12 @@ def element_mul_kernel(
     grad_output_ptr,
     n_cols,
     BLOCK_SIZE: tl.constexpr,
+    grad_output_stride=0,
 ):
     """
     This function multiplies each element of the tensor pointed by X_ptr with the value pointed by grad_output_ptr.
-    The multiplication is performed in-place on the tensor pointed by X_ptr.
+    The multiplication is performed in-place on the tensor pointed by X_ptr. If the value is 1.0 the tensor is left
+    untouched, so callers can launch it unconditionally instead of comparing grad_output on the host.
 
     Parameters:
     X_ptr: Pointer to the input tensor.
@@ -20,6 +22,7 @@ def element_mul_kernel(
     grad_output_ptr: Pointer to the gradient output value.
     n_cols (int): The number of columns in the input tensor.
     BLOCK_SIZE (int): The block size for Triton operations.
+    grad_output_stride (int): The stride of the gradient output between rows, 0 if it is a scalar.
     """
 
     # Get the program ID and convert it to int64 to avoid overflow
@@ -29,10 +32,11 @@ def element_mul_kernel(
     X_ptr += program_id * X_stride
 
     # Load the gradient output value
-    grad_output = tl.load(grad_output_ptr)
+    grad_output = tl.load(grad_output_ptr + program_id * grad_output_stride)
 
-    # Perform the element-wise multiplication
-    for i in range(0, n_cols, BLOCK_SIZE):
-        X_offsets = i + tl.arange(0, BLOCK_SIZE)
-        X_block = tl.load(X_ptr + X_offsets, mask=X_offsets < n_cols)
-        tl.store(X_ptr + X_offsets, X_block * grad_output, mask=X_offsets < n_cols)
+    # Perform the element-wise multiplication, skipping the read/write pass when the scale is 1.0
+    if grad_output != 1.0:
+        for i in range(0, n_cols, BLOCK_SIZE):
+            X_offsets = i + tl.arange(0, BLOCK_SIZE)
+            X_block = tl.load(X_ptr + X_offsets, mask=X_offsets < n_cols)
+            tl.store(X_ptr + X_offsets, X_block * grad_output, mask=X_offsets < n_cols)
@@ -1,16 +1,33 @@
 # Copyright (c) 2025, DeepLink.
+import functools
+import itertools
+
+import torch
 import triton
 import triton.language as tl
 from torch import Tensor
 
 from dlblas.utils.device_utils import is_mlu_592, is_muxi
+from dlblas.utils.logger import get_logger
+from dlblas.utils.utils import next_power_of_2
+
+logger = get_logger(__name__)
+
+# (num_heads, head_dim, block_size) compiled ahead of time by warmup_fill_kv_cache
+WARMUP_NUM_HEADS = (8, 16, 32, 64, 128)
+WARMUP_HEAD_DIMS = (64, 128)
+WARMUP_BLOCK_SIZES = (16, 32, 64, 128)
 
 
 def get_autotune_config():
     if is_mlu_592():
         return [triton.Config({}, num_stages=s, num_warps=w) for s in [1] for w in [1]]
     else:
-        return [triton.Config({}, num_stages=s, num_warps=w) for s in [3] for w in [4]]
+        return [triton.Config({}, num_stages=s, num_warps=w) for s in [3] for w in [4, 8]]
+
+
+# Upper bound of elements in one [BLOCK_T, BLOCK_H, BLOCK_D] copy tile, larger tiles spill registers
+MAX_TILE_NUMEL = 8192
 
 
 @triton.jit
@@ -54,14 +71,17 @@ def _fill_kv_cache_kernel(
     BLOCK_D: tl.constexpr,
     BLOCK_DV: tl.constexpr,
     BLOCK_H: tl.constexpr,
+    BLOCK_T: tl.constexpr,
 ):
     """fill kv cache kernel."""
     batch_id = tl.program_id(0)
     block_id = tl.program_id(1)
 
     # initialize
+    # head_dim is a multiple of 8 in practice (64/128/...), the hints let the copies use vectorized loads/stores.
+    # Strides divisible by 16 and the unit stride of contiguous states are specialized by triton itself.
     h_off = tl.arange(0, BLOCK_H)
-    d_off = tl.arange(0, BLOCK_D)
+    d_off = tl.max_contiguous(tl.multiple_of(tl.arange(0, BLOCK_D), BLOCK_D), BLOCK_D)
 
     q_startloc = tl.load(QStartLoc + batch_id)
     q_seqlen = tl.load(QSeqLens + batch_id)
@@ -87,35 +107,58 @@ def _fill_kv_cache_kernel(
         c_first_tokenloc *= 0
     c_last_tokenloc = tl.minimum(BLOCK, q_seqlen + block0_first_tokenloc - block_id * BLOCK)
 
-    for bidx in range(c_first_tokenloc, c_last_tokenloc):
-        sidx = bidx - c_first_tokenloc
-        mask = (h_off[:, None] < num_heads) & (d_off[None, :] < head_dim)
+    # copy BLOCK_T tokens at once with a [BLOCK_T, BLOCK_H, BLOCK_D] tile instead of one token per iteration
+    mask_hd = (h_off[:, None] < num_heads) & (d_off[None, :] < head_dim)
+    if BLOCK_DV > 0:
+        dv_off = tl.max_contiguous(tl.multiple_of(tl.arange(0, BLOCK_DV), BLOCK_DV), BLOCK_DV)
+        mask_hdv = (h_off[:, None] < num_heads) & (dv_off[None, :] < head_dim_v)
+    # only the tiles holding this program's tokens are visited: one for a decode token, none past the sequence end
+    for t_start in range(c_first_tokenloc // BLOCK_T * BLOCK_T, c_last_tokenloc, BLOCK_T):
+        t_off = t_start + tl.arange(0, BLOCK_T)
+        t_mask = (t_off >= c_first_tokenloc) & (t_off < c_last_tokenloc)
+        s_off = t_off - c_first_tokenloc
+        mask = t_mask[:, None, None] & mask_hd[None, :, :]
         k = tl.load(
-            ks_ptr + sidx * stride_kss + h_off[:, None] * stride_ksh + d_off[None, :] * stride_ksd,
+            ks_ptr + s_off[:, None, None] * stride_kss + h_off[None, :, None] * stride_ksh +
+            d_off[None, None, :] * stride_ksd,
             mask=mask,
             other=0.0,
         )
         tl.store(
-            kc_ptr + bidx * stride_kcb + h_off[:, None] * stride_kch + d_off[None, :] * stride_kcd,
+            kc_ptr + t_off[:, None, None] * stride_kcb + h_off[None, :, None] * stride_kch +
+            d_off[None, None, :] * stride_kcd,
             k,
             mask=mask,
         )
 
         if BLOCK_DV > 0:
-            dv_off = tl.arange(0, BLOCK_DV)
-            maskv = (h_off[:, None] < num_heads) & (dv_off[None, :] < head_dim_v)
+            maskv = t_mask[:, None, None] & mask_hdv[None, :, :]
             v = tl.load(
-                vs_ptr + sidx * stride_vss + h_off[:, None] * stride_vsh + dv_off[None, :] * stride_vsd,
+                vs_ptr + s_off[:, None, None] * stride_vss + h_off[None, :, None] * stride_vsh +
+                dv_off[None, None, :] * stride_vsd,
                 mask=maskv,
                 other=0.0,
             )
             tl.store(
-                vc_ptr + bidx * stride_vcb + h_off[:, None] * stride_vch + dv_off[None, :] * stride_vcd,
+                vc_ptr + t_off[:, None, None] * stride_vcb + h_off[None, :, None] * stride_vch +
+                dv_off[None, None, :] * stride_vcd,
                 v,
                 mask=maskv,
             )
 
 
+@functools.lru_cache(maxsize=64)
+def _get_block_sizes(num_heads: int, head_dim: int, head_dim_v: int, block_size: int):
+    """BLOCK_H, BLOCK_D, BLOCK_DV, BLOCK_T of the kernel, computed once per model config."""
+    BLOCK_H = next_power_of_2(num_heads)
+    BLOCK_D = next_power_of_2(head_dim)
+    BLOCK_DV = next_power_of_2(head_dim_v)
+    # tokens copied per iteration, only the token axis is tiled so heads and head_dim stay vectorized
+    BLOCK_T = min(next_power_of_2(block_size), max(1, MAX_TILE_NUMEL // (BLOCK_H * max(BLOCK_D, BLOCK_DV))))
+    BLOCK_T = 1 << (BLOCK_T.bit_length() - 1)
+    return BLOCK_H, BLOCK_D, BLOCK_DV, BLOCK_T
+
+
 def fill_kv_cache(
     k_states: Tensor,
     v_states: Tensor,
@@ -138,9 +181,7 @@ def fill_kv_cache(
     max_num_blocks = triton.cdiv(max_q_seq_length, block_size) + 1
 
     BLOCK = block_size
-    BLOCK_H = triton.next_power_of_2(num_heads)
-    BLOCK_D = triton.next_power_of_2(head_dim)
-    BLOCK_DV = triton.next_power_of_2(head_dim_v)
+    BLOCK_H, BLOCK_D, BLOCK_DV, BLOCK_T = _get_block_sizes(num_heads, head_dim, head_dim_v, block_size)
     grid = [batch_size, max_num_blocks]
     _fill_kv_cache_kernel[grid](
         k_states,
@@ -173,4 +214,23 @@ def fill_kv_cache(
         BLOCK_D=BLOCK_D,
         BLOCK_DV=BLOCK_DV,
         BLOCK_H=BLOCK_H,
+        BLOCK_T=BLOCK_T,
     )
+
+
+def warmup_fill_kv_cache(dtype: torch.dtype = torch.bfloat16, device: str = 'cuda'):
+    """Compile the kernel for the common (num_heads, head_dim, block_size) ahead of time.
+
+    The first call of every new specialization otherwise pays the JIT compile (and autotune) on the request path.
+    Compiled kernels land in the triton cache dir, so later processes start warm as well.
+    """
+    q_start_loc = torch.zeros(1, dtype=torch.long, device=device)
+    q_seq_length = torch.ones(1, dtype=torch.long, device=device)
+    kv_seq_length = torch.ones(1, dtype=torch.long, device=device)
+    block_offsets = torch.zeros(1, 1, dtype=torch.long, device=device)
+    for num_heads, head_dim, block_size in itertools.product(WARMUP_NUM_HEADS, WARMUP_HEAD_DIMS, WARMUP_BLOCK_SIZES):
+        k_states = torch.zeros(1, num_heads, head_dim, dtype=dtype, device=device)
+        k_caches = torch.zeros(1, block_size, num_heads, head_dim, dtype=dtype, device=device)
+        fill_kv_cache(k_states, k_states, k_caches, k_caches, q_start_loc, q_seq_length, kv_seq_length, 1,
+                      block_offsets)
+    logger.debug('fill_kv_cache warmup done')
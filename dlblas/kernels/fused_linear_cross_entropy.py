@@ -2,7 +2,7 @@
 import torch
 import triton
 
-from dlblas.kernels.cross_entropy import liger_cross_entropy_kernel
+from dlblas.kernels.cross_entropy import _get_target_mask, _sum_non_ignore_weight, liger_cross_entropy_kernel
 from dlblas.kernels.element_mul import element_mul_kernel
 from dlblas.utils.utils import amp_custom_bwd, amp_custom_fwd
 
@@ -51,18 +51,16 @@ def fused_linear_cross_entropy_forward(
     loss_1d = torch.zeros(BT, dtype=torch.float32, device=device)
     z_loss_1d = torch.zeros(BT, dtype=_input.dtype, device=_input.device) if return_z_loss else None
 
-    # TODO: evaluate how CUDA synchronization caused by .item() affects the speed
-    target_mask = target != ignore_index
-    total_n_non_ignore = target_mask.sum().item()
+    # keep the reductions on the device, the kernel loads them so no host sync is needed
+    target_mask, total_n_non_ignore = _get_target_mask(target, ignore_index)
     total_sum_non_ignore_ce_weight = total_n_non_ignore
-    ce_weight_sum = 0.0
+    ce_weight_sum = total_n_non_ignore  # dummy if ce_weight is None
     if ce_weight is not None:
         assert ce_weight.shape[0] == V, f"If given, weight has to be a Tensor of size V. Got: {ce_weight.shape}"
         assert torch.is_floating_point(ce_weight), (
             f"If given, weight has to be a Tensor of floating point dtype. Got: {ce_weight.dtype}")
-        total_sum_non_ignore_ce_weight = (torch.gather(ce_weight, dim=0,
-                                                       index=target.masked_select(target_mask)).sum().item())
-        ce_weight_sum = ce_weight.sum().item()
+        total_sum_non_ignore_ce_weight = _sum_non_ignore_weight(ce_weight, target, target_mask)
+        ce_weight_sum = ce_weight.sum(dtype=torch.float32)
         if ce_weight.stride(-1) != 1:
             ce_weight = ce_weight.contiguous()
 
@@ -74,7 +72,12 @@ def fused_linear_cross_entropy_forward(
         # when doing matmul, use the original precision
         logits_chunk = _input_chunk @ weight.t()  # chunk_size x V
         if bias is not None:
-            logits_chunk = logits_chunk + bias
+            if bias.dtype == logits_chunk.dtype:
+                # add in place so that no second chunk_size x V buffer is materialized
+                logits_chunk.add_(bias)
+            else:
+                # under autocast the bias promotes the logits, keep the out-of-place semantics
+                logits_chunk = logits_chunk + bias
 
         target_chunk = target[start_idx:end_idx]  # chunk_size,
 
@@ -99,9 +102,9 @@ def fused_linear_cross_entropy_forward(
             z_loss_ptr=z_loss_1d_slice,
             loss_stride=loss_1d_slice.stride(-1),  # always 1
             n_cols=V,
-            n_non_ignore=total_n_non_ignore,
-            sum_non_ignore_weight=total_sum_non_ignore_ce_weight,
-            weight_sum=ce_weight_sum,
+            n_non_ignore_ptr=total_n_non_ignore,
+            sum_non_ignore_weight_ptr=total_sum_non_ignore_ce_weight,
+            weight_sum_ptr=ce_weight_sum,
             ignore_index=ignore_index,
             lse_square_scale=lse_square_scale,
             label_smoothing=label_smoothing,
@@ -111,12 +114,12 @@ def fused_linear_cross_entropy_forward(
             HAS_WEIGHT=True if ce_weight is not None else False,
             HAS_SOFTCAPPING=True if softcap is not None else False,
             BLOCK_SIZE=BLOCK_SIZE,
+            SINGLE_TILE=V <= BLOCK_SIZE,
+            HAS_IGNORE=target_mask is not None,
             num_warps=32,
         )
 
-        loss_1d[start_idx:end_idx] = loss_1d_slice
-        if return_z_loss:
-            z_loss_1d[start_idx:end_idx] = z_loss_1d_slice
+        # loss_1d_slice / z_loss_1d_slice are views, the kernel already wrote into loss_1d / z_loss_1d
         grad_logits_chunk = logits_chunk  # chunk_size x V
 
         grad_input[start_idx:end_idx] = grad_logits_chunk @ weight
@@ -153,49 +156,49 @@ def fused_linear_cross_entropy_forward(
 
 
 def fused_linear_cross_entropy_backward(grad_output, grad_input, grad_weight, grad_bias):
-    # If cross entropy is the last layer, grad_output is 1.0. Skip the mul to save time
-    if not torch.equal(grad_output, torch.tensor(1.0, device=grad_output.device)):
-        # We use a Triton kernel instead of a PyTorch operation because modifying inputs in-place
-        # for gradient storage and backward multiple times causes anomalies with PyTorch but not with Triton.
-        BT, H = grad_input.shape
-        n_rows = BT
-        BLOCK_SIZE = min(MAX_FUSED_SIZE, triton.next_power_of_2(H))
+    # If cross entropy is the last layer, grad_output is 1.0 and element_mul_kernel leaves the grads untouched on
+    # device, so there is no host sync to compare grad_output.
+    # We use a Triton kernel instead of a PyTorch operation because modifying inputs in-place
+    # for gradient storage and backward multiple times causes anomalies with PyTorch but not with Triton.
+    BT, H = grad_input.shape
+    n_rows = BT
+    BLOCK_SIZE = min(MAX_FUSED_SIZE, triton.next_power_of_2(H))
+
+    element_mul_kernel[(n_rows, )](
+        grad_input,
+        grad_input.stride(-2),
+        grad_output,
+        H,
+        BLOCK_SIZE=BLOCK_SIZE,
+        num_warps=32,
+    )
+
+    # handle grad_weight
+    if grad_weight is not None:
+        V, H = grad_weight.shape
+        n_rows = V
 
         element_mul_kernel[(n_rows, )](
-            grad_input,
-            grad_input.stride(-2),
+            grad_weight,
+            grad_weight.stride(-2),
             grad_output,
             H,
             BLOCK_SIZE=BLOCK_SIZE,
             num_warps=32,
         )
 
-        # handle grad_weight
-        if grad_weight is not None:
-            V, H = grad_weight.shape
-            n_rows = V
-
-            element_mul_kernel[(n_rows, )](
-                grad_weight,
-                grad_weight.stride(-2),
-                grad_output,
-                H,
-                BLOCK_SIZE=BLOCK_SIZE,
-                num_warps=32,
-            )
+    if grad_bias is not None:
+        V = grad_bias.shape[0]
+        n_rows = V
 
-        if grad_bias is not None:
-            V = grad_bias.shape[0]
-            n_rows = V
-
-            element_mul_kernel[(n_rows, )](
-                grad_bias,
-                grad_bias.stride(-1),
-                grad_output,
-                1,
-                BLOCK_SIZE=BLOCK_SIZE,
-                num_warps=32,
-            )
+        element_mul_kernel[(n_rows, )](
+            grad_bias,
+            grad_bias.stride(-1),
+            grad_output,
+            1,
+            BLOCK_SIZE=BLOCK_SIZE,
+            num_warps=32,
+        )
     return grad_input, grad_weight, grad_bias
 
 
@@ -1,28 +1,144 @@
+import functools
+import itertools
+
 import torch
+import torch.distributed as dist
+import torch.nn.functional as F
 import triton
 import triton.language as tl
 
+from dlblas.utils.device_utils import get_device_props, is_cuda
 
-import triton
-import triton.language as tl
 #reference:  https://github.com/unslothai/unsloth-zoo/blob/main/unsloth_zoo/rl_replacements.py
 
+
 @triton.jit
 def _update_logsumexp(chunk, m, s):
-    chunk_m = tl.max(chunk, 0)
-    new_m = tl.maximum(m, chunk_m)
-    s_rescaled = s * tl.exp(m - new_m)
+    # 先求新的最大值再做指数, 旧的和用一次 fma 完成缩放与累加
+    new_m = tl.maximum(m, tl.max(chunk, 0))
     chunk_s = tl.sum(tl.exp(chunk - new_m), 0)
-    s = s_rescaled + chunk_s
-    m = new_m
-    return m, s
+    s = tl.fma(s, tl.exp(m - new_m), chunk_s)
+    return new_m, s
+
+
+@triton.jit
+def _load_logits(ptrs, v_mask):
+    # 按输入精度各自编译一份; fp8 (e4m3) 没有 inf, 越界位置先按 0 读入, 转成 fp32 后再填 -inf
+    if ptrs.dtype.element_ty.is_fp8():
+        x = tl.load(ptrs, mask=v_mask, other=0.0).to(tl.float32)
+        x = tl.where(v_mask, x, -float('inf'))
+    else:
+        x = tl.load(ptrs, mask=v_mask, other=-float('inf')).to(tl.float32)
+    return x
+
+
+@triton.jit
+def _logsumexp3(new_ptr, ref_ptr, old_ptr, V, inv_temperature, BLOCK_SIZE_V: tl.constexpr, HAS_TEMP: tl.constexpr):
+    # 一次遍历同时计算 new/ref/old 三个 logsumexp, 三路 load 可以互相重叠
+    m_new, s_new = -float('inf'), 0.0
+    m_ref, s_ref = -float('inf'), 0.0
+    m_old, s_old = -float('inf'), 0.0
+    for v_start in range(0, V, BLOCK_SIZE_V):
+        offsets = v_start + tl.arange(0, BLOCK_SIZE_V)
+        v_mask = offsets < V
+        new_chunk = _load_logits(new_ptr + offsets, v_mask)
+        ref_chunk = _load_logits(ref_ptr + offsets, v_mask)
+        old_chunk = _load_logits(old_ptr + offsets, v_mask)
+        if HAS_TEMP:
+            new_chunk *= inv_temperature
+            ref_chunk *= inv_temperature
+            old_chunk *= inv_temperature
+        m_new, s_new = _update_logsumexp(new_chunk, m_new, s_new)
+        m_ref, s_ref = _update_logsumexp(ref_chunk, m_ref, s_ref)
+        m_old, s_old = _update_logsumexp(old_chunk, m_old, s_old)
+    return m_new + tl.log(s_new), m_ref + tl.log(s_ref), m_old + tl.log(s_old)
+
+
+@triton.jit
+def _merge_logsumexp(m_ptr, s_ptr, SPLIT_V: tl.constexpr):
+    # 合并 SPLIT_V 个分段的 (m, s): m = max(m_i), s = sum(s_i * exp(m_i - m))
+    m_part = tl.load(m_ptr + tl.arange(0, SPLIT_V) * 6)
+    s_part = tl.load(s_ptr + tl.arange(0, SPLIT_V) * 6)
+    m = tl.max(m_part, 0)
+    s = tl.sum(s_part * tl.exp(m_part - m), 0)
+    return m + tl.log(s)
+
+
+@triton.jit
+def grpo_lse_partial_kernel(
+    new_logits_ptr, ref_logits_ptr, old_logits_ptr,
+    mask_ptr, partial_ptr,
+    V, cols_per_split,
+    inv_temperature: float,
+    SPLIT_V: tl.constexpr,
+    BLOCK_SIZE_V: tl.constexpr,
+    HAS_TEMP: tl.constexpr,
+):
+    # 词表很大而 token 很少时, 每个 token 的词表被切成 SPLIT_V 段并行计算,
+    # 每段写出 (m_new, s_new, m_ref, s_ref, m_old, s_old) 到 partial[BL, SPLIT_V, 6]
+    pid = tl.program_id(axis=0)
+    split_id = tl.program_id(axis=1)
+    mask = tl.load(mask_ptr + pid)
+    if mask == 0:
+        return
 
+    v_begin = split_id * cols_per_split
+    v_end = tl.minimum(v_begin + cols_per_split, V)
+    m_new, s_new = -float('inf'), 0.0
+    m_ref, s_ref = -float('inf'), 0.0
+    m_old, s_old = -float('inf'), 0.0
+    for v_start in range(v_begin, v_end, BLOCK_SIZE_V):
+        offsets = v_start + tl.arange(0, BLOCK_SIZE_V)
+        v_mask = offsets < v_end
+        new_chunk = _load_logits(new_logits_ptr + pid * V + offsets, v_mask)
+        ref_chunk = _load_logits(ref_logits_ptr + pid * V + offsets, v_mask)
+        old_chunk = _load_logits(old_logits_ptr + pid * V + offsets, v_mask)
+        if HAS_TEMP:
+            new_chunk *= inv_temperature
+            ref_chunk *= inv_temperature
+            old_chunk *= inv_temperature
+        m_new, s_new = _update_logsumexp(new_chunk, m_new, s_new)
+        m_ref, s_ref = _update_logsumexp(ref_chunk, m_ref, s_ref)
+        m_old, s_old = _update_logsumexp(old_chunk, m_old, s_old)
+
+    out_ptr = partial_ptr + (pid * SPLIT_V + split_id) * 6
+    tl.store(out_ptr, m_new)
+    tl.store(out_ptr + 1, s_new)
+    tl.store(out_ptr + 2, m_ref)
+    tl.store(out_ptr + 3, s_ref)
+    tl.store(out_ptr + 4, m_old)
+    tl.store(out_ptr + 5, s_old)
+
+
+def get_autotune_config():
+    return [
+        triton.Config({'BLOCK_SIZE_V': b}, num_warps=w, num_stages=st)
+        for b, w, st in itertools.product([256, 512, 1024, 2048, 4096], [2, 4, 8], [2, 3, 4])
+    ]
+
+
+def get_bwd_autotune_config():
+    # 反向只剩写回循环, 只需要调写回的块大小
+    return [
+        triton.Config({'BLOCK_SIZE_GRAD': g}, num_warps=w, num_stages=st)
+        for g, w, st in itertools.product([1024, 2048, 4096], [4, 8], [2, 3])
+    ]
+
+
+# HAS_PARTIAL 时 BLOCK_SIZE_V 不参与计算, 流式归约与多行 program 的最优配置也不同, 所以它们都进 key,
+# 否则某个 V 最先跑到的路径会决定之后所有路径的配置
+@triton.autotune(
+    configs=get_autotune_config(),
+    key=['V', 'HAS_PARTIAL', 'SPLIT_V', 'ROWS_PER_PROG'],
+    reset_to_zero=['sums_ptr'],
+)
 @triton.jit
 def grpo_kernel(
     # Pointers
     new_logits_ptr, ref_logits_ptr, old_logits_ptr,
     input_ids_ptr, advantages_ptr, mask_ptr,
     loss_i_ptr, kl_i_ptr,
+    sums_ptr,  # [3]: sum(loss_i), sum(kl_i), sum(mask), 由 atomic_add 在内核里完成归约
     # Dimensions
     BL, V,
     # Hyperparameters
@@ -30,91 +146,176 @@ def grpo_kernel(
     epsilon_low: float,
     epsilon_high: float,
     delta: float,
-    temperature: float,
+    inv_temperature: float,  # 1 / temperature, 乘法代替除法
     # Meta-parameters
     BLOCK_SIZE_V: tl.constexpr,
-    HAS_DELTA: tl.constexpr, # 使用编译时常量来处理delta的有无
+    HAS_DELTA: tl.constexpr,  # 使用编译时常量来处理delta的有无
+    HAS_TEMP: tl.constexpr,  # temperature == 1 时跳过缩放
+    partial_ptr=None,
+    SPLIT_V: tl.constexpr = 1,
+    HAS_PARTIAL: tl.constexpr = False,  # lse 由 grpo_lse_partial_kernel 的分段 (m, s) 合并得到
+    target_x_ptr=None,
+    HAS_TARGET_X: tl.constexpr = False,  # 目标 logits 由 host 给出 ([3, BL]), 张量并行时目标可能不在本分片
+    lse_lp_ptr=None,
+    SAVE_LSE_LP: tl.constexpr = False,  # 保存 [6, BL] 的 lse/lp 供反向使用, 反向不再重算
+    ROWS_PER_PROG: tl.constexpr = 1,
 ):
 
-    pid = tl.program_id(axis=0)
-    mask = tl.load(mask_ptr + pid)
-    if mask == 0:
-        tl.store(loss_i_ptr + pid, 0.0)
-        tl.store(kl_i_ptr + pid, 0.0)
-        return
-
-    new_ptr = new_logits_ptr + pid * V
-    ref_ptr = ref_logits_ptr + pid * V
-    old_ptr = old_logits_ptr + pid * V
-
-    # new_logits
-    m_val, s_val = -float('inf'), 0.0
-    for v_start in range(0, V, BLOCK_SIZE_V):
-        offsets = v_start + tl.arange(0, BLOCK_SIZE_V)
-        v_mask = offsets < V
-        chunk = tl.load(new_ptr + offsets, mask=v_mask, other=-float('inf'))
-        chunk = chunk / temperature # 应用温度
-        m_val, s_val = _update_logsumexp(chunk, m_val, s_val)
-    lse_new = m_val + tl.log(s_val)
-
-    # ref_logits
-    m_val, s_val = -float('inf'), 0.0
-    for v_start in range(0, V, BLOCK_SIZE_V):
-        offsets = v_start + tl.arange(0, BLOCK_SIZE_V)
-        v_mask = offsets < V
-        chunk = tl.load(ref_ptr + offsets, mask=v_mask, other=-float('inf'))
-        chunk = chunk / temperature # 应用温度
-        m_val, s_val = _update_logsumexp(chunk, m_val, s_val)
-    lse_ref = m_val + tl.log(s_val)
-
-    # old_logits
-    m_val, s_val = -float('inf'), 0.0
-    for v_start in range(0, V, BLOCK_SIZE_V):
-        offsets = v_start + tl.arange(0, BLOCK_SIZE_V)
-        v_mask = offsets < V
-        chunk = tl.load(old_ptr + offsets, mask=v_mask, other=-float('inf'))
-        chunk = chunk / temperature # 应用温度
-        m_val, s_val = _update_logsumexp(chunk, m_val, s_val)
-    lse_old = m_val + tl.log(s_val)
-
-    input_ids = tl.load(input_ids_ptr + pid)
-    new_x = (tl.load(new_ptr + input_ids)) / temperature
-    ref_x = (tl.load(ref_ptr + input_ids)) / temperature
-    old_x = (tl.load(old_ptr + input_ids)) / temperature
-
-    new_lp = new_x - lse_new
-    ref_lp = ref_x - lse_ref
-    old_lp = old_x - lse_old
-
-    kl_i = 0.0
-    if beta != 0.0:
-        # kl(p_ref || p_new) = sum(p_ref * (log(p_ref) - log(p_new)))
-        # 在单点采样下近似为 exp(ref_lp - new_lp) - (ref_lp - new_lp) - 1.0
-        kl_i = tl.exp(ref_lp - new_lp) - (ref_lp - new_lp) - 1.0
-
-    advantages = tl.load(advantages_ptr + pid)
-    
-    # coef1 是未裁剪的比率
-    coef1 = tl.exp(new_lp - old_lp)
-    
-    # loss1 是带 delta 裁剪的损失项
-    loss1_coef = coef1
-    if HAS_DELTA:
-        loss1_coef = tl.minimum(coef1, delta) 
-    loss1 = loss1_coef * advantages
-    
-    # loss2 是带 epsilon 裁剪的损失项
-    coef2 = tl.clamp(coef1, 1.0 - epsilon_low, 1.0 + epsilon_high)
-    loss2 = coef2 * advantages
-    
-    # 最终的 per-token loss
-    loss_i = -tl.minimum(loss1, loss2)
-    if beta != 0.0:
-        loss_i += beta * kl_i
-
-    # --- 5. 写回结果 ---
-    tl.store(loss_i_ptr + pid, loss_i)
-    tl.store(kl_i_ptr + pid, kl_i)
+    # 每个 program 处理 ROWS_PER_PROG 个相邻 token, 摊销 program 的启动和标量开销;
+    # BL 不能整除时越界的行夹到最后一行, 重复写入的值相同, 但不参与求和
+    for r in range(ROWS_PER_PROG):
+        row = tl.program_id(axis=0) * ROWS_PER_PROG + r
+        pid = tl.minimum(row, BL - 1)
+        mask = tl.load(mask_ptr + pid)
+        if mask == 0:
+            tl.store(loss_i_ptr + pid, 0.0)
+            tl.store(kl_i_ptr + pid, 0.0)
+        else:
+            new_ptr = new_logits_ptr + pid * V
+            ref_ptr = ref_logits_ptr + pid * V
+            old_ptr = old_logits_ptr + pid * V
+
+            # 三个 gather 互不依赖, 在归约循环之前一起发出, 访存延迟被 V 方向的流式归约掩盖
+            if HAS_TARGET_X:
+                new_x = tl.load(target_x_ptr + pid)
+                ref_x = tl.load(target_x_ptr + BL + pid)
+                old_x = tl.load(target_x_ptr + 2 * BL + pid)
+            else:
+                input_ids = tl.load(input_ids_ptr + pid)
+                new_x = tl.load(new_ptr + input_ids).to(tl.float32)
+                ref_x = tl.load(ref_ptr + input_ids).to(tl.float32)
+                old_x = tl.load(old_ptr + input_ids).to(tl.float32)
+            if HAS_TEMP:
+                new_x *= inv_temperature
+                ref_x *= inv_temperature
+                old_x *= inv_temperature
+
+            # new/ref/old logits, 应用温度
+            if HAS_PARTIAL:
+                part_ptr = partial_ptr + pid * SPLIT_V * 6
+                lse_new = _merge_logsumexp(part_ptr, part_ptr + 1, SPLIT_V)
+                lse_ref = _merge_logsumexp(part_ptr + 2, part_ptr + 3, SPLIT_V)
+                lse_old = _merge_logsumexp(part_ptr + 4, part_ptr + 5, SPLIT_V)
+            else:
+                lse_new, lse_ref, lse_old = _logsumexp3(new_ptr, ref_ptr, old_ptr, V, inv_temperature, BLOCK_SIZE_V,
+                                                        HAS_TEMP)
+
+            new_lp = new_x - lse_new
+            ref_lp = ref_x - lse_ref
+            old_lp = old_x - lse_old
+            if SAVE_LSE_LP:
+                tl.store(lse_lp_ptr + pid, lse_new)
+                tl.store(lse_lp_ptr + BL + pid, lse_ref)
+                tl.store(lse_lp_ptr + 2 * BL + pid, lse_old)
+                tl.store(lse_lp_ptr + 3 * BL + pid, new_lp)
+                tl.store(lse_lp_ptr + 4 * BL + pid, ref_lp)
+                tl.store(lse_lp_ptr + 5 * BL + pid, old_lp)
+
+            kl_i = 0.0
+            if beta != 0.0:
+                # kl(p_ref || p_new) = sum(p_ref * (log(p_ref) - log(p_new)))
+                # 在单点采样下近似为 exp(ref_lp - new_lp) - (ref_lp - new_lp) - 1.0
+                kl_i = tl.exp(ref_lp - new_lp) - (ref_lp - new_lp) - 1.0
+
+            advantages = tl.load(advantages_ptr + pid).to(tl.float32)
+
+            # coef1 是未裁剪的比率
+            coef1 = tl.exp(new_lp - old_lp)
+
+            # loss1 是带 delta 裁剪的损失项
+            loss1_coef = coef1
+            if HAS_DELTA:
+                loss1_coef = tl.minimum(coef1, delta)
+            loss1 = loss1_coef * advantages
+
+            # loss2 是带 epsilon 裁剪的损失项
+            coef2 = tl.clamp(coef1, 1.0 - epsilon_low, 1.0 + epsilon_high)
+            loss2 = coef2 * advantages
+
+            # 最终的 per-token loss
+            loss_i = -tl.minimum(loss1, loss2)
+            if beta != 0.0:
+                loss_i += beta * kl_i
+
+            # --- 5. 写回结果 ---
+            tl.store(loss_i_ptr + pid, loss_i)
+            tl.store(kl_i_ptr + pid, kl_i)
+            in_bounds = row < BL
+            tl.atomic_add(sums_ptr, loss_i, mask=in_bounds)
+            tl.atomic_add(sums_ptr + 1, kl_i, mask=in_bounds)
+            tl.atomic_add(sums_ptr + 2, mask.to(tl.float32), mask=in_bounds)
+
+
+# 每段至少处理这么多列, 更小的分段不值得多一次 launch
+MIN_SPLIT_SIZE = 4096
+
+
+def _get_num_v_splits(BL, V):
+    # token 数不足以占满所有 SM 时, 沿词表切分; 返回 2 的幂, 1 表示不切分
+    if not is_cuda():
+        return 1
+    num_sms = get_device_props()['multi_processor_count']
+    if BL >= num_sms:
+        return 1
+    split = min(num_sms // BL, V // MIN_SPLIT_SIZE)
+    if split < 2:
+        return 1
+    return 1 << (split.bit_length() - 1)
+
+
+# 每个 program 最多处理的行数, 以及合并行时每个 SM 至少保留的 program 数
+MAX_ROWS_PER_PROG = 4
+MIN_PROGS_PER_SM = 8
+
+
+def _get_rows_per_prog(BL, V):
+    # 词表较小时单行的工作量小, program 的固定开销占比高, 让一个 program 处理多行;
+    # 词表大时单行已足够重, 保持每行一个 program. 返回 2 的幂
+    if not is_cuda() or V > MIN_SPLIT_SIZE * 4:
+        return 1
+    num_sms = get_device_props()['multi_processor_count']
+    rows = 1
+    while rows < MAX_ROWS_PER_PROG and BL >= rows * 2 * num_sms * MIN_PROGS_PER_SM:
+        rows *= 2
+    return rows
+
+
+@functools.lru_cache(maxsize=256)
+def _get_launch_config(BL, V):
+    # 训练时 (BL, V) 基本不变, 每个形状只算一次 (SPLIT_V, ROWS_PER_PROG), 之后的调用直接查表
+    return _get_num_v_splits(BL, V), _get_rows_per_prog(BL, V)
+
+
+def _grpo_tp_reduce(new_logits, ref_logits, old_logits, input_ids, mask, SPLIT_V, temperature, tp_group,
+                    vocab_start_index):
+    # 本分片的分段 (m, s), 再在 rank 间合并: m = max(m_r), s = sum(s_r * exp(m_r - m))
+    BL, V = new_logits.shape
+    partial = torch.empty((BL, SPLIT_V, 6), dtype=torch.float32, device=new_logits.device)
+    grpo_lse_partial_kernel[(BL, SPLIT_V)](
+        new_logits, ref_logits, old_logits,
+        mask, partial,
+        V, triton.cdiv(V, SPLIT_V),
+        inv_temperature=1.0 / temperature,
+        SPLIT_V=SPLIT_V,
+        BLOCK_SIZE_V=1024,
+        HAS_TEMP=temperature != 1.0,
+    )
+    m_local, s_local = partial[..., 0::2], partial[..., 1::2]
+    m_global = m_local.clone()
+    dist.all_reduce(m_global, op=dist.ReduceOp.MAX, group=tp_group)
+    s_global = s_local * torch.exp(m_local - m_global)
+    dist.all_reduce(s_global, op=dist.ReduceOp.SUM, group=tp_group)
+    partial[..., 0::2] = m_global
+    partial[..., 1::2] = s_global
+
+    # 目标 logits 只由持有该 token 的分片贡献, 其余分片贡献 0
+    local_ids = input_ids - vocab_start_index
+    in_shard = (local_ids >= 0) & (local_ids < V)
+    index = torch.where(in_shard, local_ids, 0).unsqueeze(-1)
+    target_x = torch.stack([logits.gather(-1, index).squeeze(-1) for logits in (new_logits, ref_logits, old_logits)])
+    target_x = torch.where(in_shard, target_x.to(torch.float32), 0.0)
+    dist.all_reduce(target_x, op=dist.ReduceOp.SUM, group=tp_group)
+    return partial, target_x
 
 
 def grpo_loss_triton_optimized(
@@ -131,68 +332,106 @@ def grpo_loss_triton_optimized(
     max_completion_length: int = 8192,
     delta: float = None,
     temperature: float = 1.0,
+    lse_lp: torch.Tensor = None,
+    tp_group=None,
+    vocab_start_index: int = 0,
 ):
 
     # 确保输入在正确的设备上
     device = new_logits.device
     
    
-    new_logits, ref_logits, old_logits, advantages = new_logits.to(torch.float32), ref_logits.to(torch.float32), old_logits.to(torch.float32), advantages.to(torch.float32)
-
+    # logits/advantages 保持原始精度 (bf16/fp16), 由内核在 load 时转成 fp32 计算, 不再生成 fp32 副本
     BL, V = new_logits.shape
     
-    loss_i = torch.empty_like(advantages, device=device)
-    kl_i = torch.empty_like(advantages, device=device)
+    loss_i = torch.empty(BL, dtype=torch.float32, device=device)
+    kl_i = torch.empty(BL, dtype=torch.float32, device=device)
+    sums = torch.zeros(3, dtype=torch.float32, device=device)
 
-    grid = (BL,)
-    BLOCK_SIZE_V = 1024 # 可调超参数
+    SPLIT_V, ROWS_PER_PROG = _get_launch_config(BL, V)
+    grid = (triton.cdiv(BL, ROWS_PER_PROG),)
 
     HAS_DELTA = (delta is not None)
     # 如果delta为None，传递一个虚拟值，但内核不会使用它
     delta_val = delta if HAS_DELTA else 0.0 
+
+    partial = None
+    target_x = None
+    if tp_group is not None:
+        # 张量并行: 每个 rank 只有 [vocab_start_index, vocab_start_index + V) 的词表分片,
+        # 只在 rank 间归约每个 token 的 (m, s) 和目标 logits, 不 all-gather 整个词表
+        partial, target_x = _grpo_tp_reduce(new_logits, ref_logits, old_logits, input_ids, mask, SPLIT_V,
+                                            temperature, tp_group, vocab_start_index)
+    elif SPLIT_V > 1:
+        cols_per_split = triton.cdiv(V, SPLIT_V)
+        partial = torch.empty((BL, SPLIT_V, 6), dtype=torch.float32, device=device)
+        grpo_lse_partial_kernel[(BL, SPLIT_V)](
+            new_logits, ref_logits, old_logits,
+            mask, partial,
+            V, cols_per_split,
+            inv_temperature=1.0 / temperature,
+            SPLIT_V=SPLIT_V,
+            BLOCK_SIZE_V=1024,
+            HAS_TEMP=temperature != 1.0,
+        )
+
     grpo_kernel[grid](
         new_logits, ref_logits, old_logits,
         input_ids, advantages, mask,
         loss_i, kl_i,
+        sums,
         BL, V,
         beta=beta,
         epsilon_low=epsilon_low,
         epsilon_high=epsilon_high,
         delta=delta_val,
-        temperature=temperature,
-        BLOCK_SIZE_V=BLOCK_SIZE_V,
+        inv_temperature=1.0 / temperature,
         HAS_DELTA=HAS_DELTA,
+        HAS_TEMP=temperature != 1.0,
+        partial_ptr=partial,
+        SPLIT_V=SPLIT_V,
+        HAS_PARTIAL=partial is not None,
+        target_x_ptr=target_x,
+        HAS_TARGET_X=target_x is not None,
+        lse_lp_ptr=lse_lp,
+        SAVE_LSE_LP=lse_lp is not None,
+        ROWS_PER_PROG=ROWS_PER_PROG,
     )
 
-    mask_float = mask.to(torch.float32)
-    masked_loss_i = loss_i * mask_float
-    masked_kl_i = kl_i * mask_float # PyTorch版本返回的是掩码后的KL
+    # 内核对 mask == 0 的 token 已经写 0, 输出本身就是掩码后的结果, 不必再乘一次 mask
+    masked_loss_i = loss_i
+    masked_kl_i = kl_i  # PyTorch版本返回的是掩码后的KL
+    # 三个求和已在内核里用 atomic_add 完成
+    loss_sum, kl_sum, completion_length = sums.unbind(0)
 
     if loss_type == "grpo" or loss_type == "bnpo":
         # .clamp(min=1.0) 防止除以零
-        loss = masked_loss_i.sum() / mask_float.sum().clamp(min=1.0)
+        loss = loss_sum / completion_length.clamp(min=1.0)
     elif loss_type == "dr_grpo":
         # .size(0) 是批次大小 BL
-        loss = masked_loss_i.sum() / (loss_i.size(0) * max_completion_length)
+        loss = loss_sum / (loss_i.size(0) * max_completion_length)
     else:
         raise ValueError(f"Unknown loss type: {loss_type}")
 
     # 计算统计量
-    completion_length = mask_float.sum()
-    mean_kl = masked_kl_i.sum() / completion_length.clamp(min=1.0)
+    mean_kl = kl_sum / completion_length.clamp(min=1.0)
 
     # 返回与PyTorch函数完全相同的5个值
     return loss, completion_length, mean_kl, masked_loss_i, masked_kl_i
 
 
+@triton.autotune(
+    configs=get_bwd_autotune_config(),
+    key=['V'],
+)
 @triton.jit
 def grpo_bwd_kernel(
     # Pointers
-    new_logits_ptr, ref_logits_ptr, old_logits_ptr,
+    new_logits_ptr, lse_lp_ptr,
     input_ids_ptr, advantages_ptr, mask_ptr,
-    grad_new_logits_ptr, # Output
+    grad_new_logits_ptr,  # Output
     # Upstream gradient info
-    grad_loss_scale: float,
+    grad_loss_scale_ptr,  # 设备上的标量, 避免反向时 .item() 同步
     # Dimensions
     BL, V,
     # Hyperparameters
@@ -200,54 +439,34 @@ def grpo_bwd_kernel(
     epsilon_low: float,
     epsilon_high: float,
     delta: float,
-    temperature: float,
+    inv_temperature: float,
+    vocab_start_index,  # 张量并行时本分片的起始词表下标
     # Meta-parameters
-    BLOCK_SIZE_V: tl.constexpr,
+    BLOCK_SIZE_GRAD: tl.constexpr,
     HAS_DELTA: tl.constexpr,
+    HAS_TEMP: tl.constexpr,
 ):
     pid = tl.program_id(axis=0)
+    # 行基址只算一次; mask 和 input_ids 两个标量 load 互不依赖, 一起发出
+    new_ptr = new_logits_ptr + pid * V
+    grad_ptr = grad_new_logits_ptr + pid * V
     mask = tl.load(mask_ptr + pid)
+    input_ids = tl.load(input_ids_ptr + pid)
     if mask == 0:
-        grad_ptr = grad_new_logits_ptr + pid * V
-        for v_start in range(0, V, BLOCK_SIZE_V):
-            offsets = v_start + tl.arange(0, BLOCK_SIZE_V)
+        for v_start in range(0, V, BLOCK_SIZE_GRAD):
+            offsets = v_start + tl.arange(0, BLOCK_SIZE_GRAD)
             v_mask = offsets < V
             tl.store(grad_ptr + offsets, 0.0, mask=v_mask)
         return
 
-    # --- 1. Recomputation (Correct, no changes) ---
-    # ... (code for lse, lp calculation is omitted for brevity)
-    new_ptr = new_logits_ptr + pid * V
-    ref_ptr = ref_logits_ptr + pid * V
-    old_ptr = old_logits_ptr + pid * V
-    m_val, s_val = -float('inf'), 0.0
-    for v_start in range(0, V, BLOCK_SIZE_V):
-        offsets = v_start + tl.arange(0, BLOCK_SIZE_V); v_mask = offsets < V
-        chunk = tl.load(new_ptr + offsets, mask=v_mask, other=-float('inf')) / temperature
-        m_val, s_val = _update_logsumexp(chunk, m_val, s_val)
-    lse_new = m_val + tl.log(s_val)
-    m_val, s_val = -float('inf'), 0.0
-    for v_start in range(0, V, BLOCK_SIZE_V):
-        offsets = v_start + tl.arange(0, BLOCK_SIZE_V); v_mask = offsets < V
-        chunk = tl.load(ref_ptr + offsets, mask=v_mask, other=-float('inf')) / temperature
-        m_val, s_val = _update_logsumexp(chunk, m_val, s_val)
-    lse_ref = m_val + tl.log(s_val)
-    m_val, s_val = -float('inf'), 0.0
-    for v_start in range(0, V, BLOCK_SIZE_V):
-        offsets = v_start + tl.arange(0, BLOCK_SIZE_V); v_mask = offsets < V
-        chunk = tl.load(old_ptr + offsets, mask=v_mask, other=-float('inf')) / temperature
-        m_val, s_val = _update_logsumexp(chunk, m_val, s_val)
-    lse_old = m_val + tl.log(s_val)
-    input_ids = tl.load(input_ids_ptr + pid)
-    new_x = (tl.load(new_ptr + input_ids)) / temperature
-    ref_x = (tl.load(ref_ptr + input_ids)) / temperature
-    old_x = (tl.load(old_ptr + input_ids)) / temperature
-    new_lp = new_x - lse_new
-    ref_lp = ref_x - lse_ref
-    old_lp = old_x - lse_old
+    # --- 1. 读取前向保存的 lse/lp, 不再重算三次 V 长度的归约 ---
+    lse_new = tl.load(lse_lp_ptr + pid)
+    new_lp = tl.load(lse_lp_ptr + 3 * BL + pid)
+    ref_lp = tl.load(lse_lp_ptr + 4 * BL + pid)
+    old_lp = tl.load(lse_lp_ptr + 5 * BL + pid)
 
     # --- 2. Backward Gradient Calculation ---
-    advantages = tl.load(advantages_ptr + pid)
+    advantages = tl.load(advantages_ptr + pid).to(tl.float32)
     coef1 = tl.exp(new_lp - old_lp)
     
     loss1_coef = coef1
@@ -258,19 +477,23 @@ def grpo_bwd_kernel(
     coef2 = tl.clamp(coef1, 1.0 - epsilon_low, 1.0 + epsilon_high)
     loss2 = coef2 * advantages
 
-    g_loss_i = grad_loss_scale
+    g_loss_i = tl.load(grad_loss_scale_ptr)
     g_kl_i = g_loss_i * beta
     g_ppo_loss = g_loss_i
     
     g_min = -g_ppo_loss
     
   
-    g_loss1 = tl.where(loss1 <= loss2, g_min, 0.0)
-    g_loss2 = tl.where(loss1 > loss2, g_min, 0.0)
+    # min(loss1, loss2) 的梯度只流向被选中的一项, 比较只做一次
+    pick1 = loss1 <= loss2
+    g_loss1 = tl.where(pick1, g_min, 0.0)
+    g_loss2 = tl.where(pick1, 0.0, g_min)
 
     # --- (Rest of the code is correct, no changes) ---
     g_coef2 = g_loss2 * advantages
-    g_coef1_from_loss2 = tl.where((coef1 >= 1.0 - epsilon_low) & (coef1 <= 1.0 + epsilon_high), g_coef2, 0.0)
+    # clamp 只在区间内传梯度
+    in_range = (coef1 >= 1.0 - epsilon_low) & (coef1 <= 1.0 + epsilon_high)
+    g_coef1_from_loss2 = tl.where(in_range, g_coef2, 0.0)
 
     g_loss1_coef = g_loss1 * advantages
     g_coef1_from_loss1 = g_loss1_coef
@@ -286,31 +509,47 @@ def grpo_bwd_kernel(
     
     g_new_lp = g_new_lp_from_ppo + g_new_lp_from_kl
 
+    # d(x / T) / dx = 1 / T, 在循环外乘一次
+    g_logits = g_new_lp
+    if HAS_TEMP:
+        g_logits = g_new_lp * inv_temperature
+
     # --- 3. Final Gradient Writeback (Correct, no changes) ---
-    grad_ptr = grad_new_logits_ptr + pid * V
-    for v_start in range(0, V, BLOCK_SIZE_V):
-        offsets = v_start + tl.arange(0, BLOCK_SIZE_V)
+    for v_start in range(0, V, BLOCK_SIZE_GRAD):
+        offsets = v_start + tl.arange(0, BLOCK_SIZE_GRAD)
         v_mask = offsets < V
-        chunk = tl.load(new_ptr + offsets, mask=v_mask, other=-float('inf')) / temperature
+        chunk = _load_logits(new_ptr + offsets, v_mask)
+        if HAS_TEMP:
+            chunk *= inv_temperature
         softmax_chunk = tl.exp(chunk - lse_new)
-        grad_dense = -g_new_lp * softmax_chunk
-        grad_sparse = tl.where(offsets == input_ids, g_new_lp, 0.0)
-        final_grad = (grad_dense + grad_sparse) / temperature
-        tl.store(grad_ptr + offsets, final_grad, mask=v_mask)
+        grad_dense = -g_logits * softmax_chunk
+        tl.store(grad_ptr + offsets, grad_dense, mask=v_mask)
+    # 目标位置的稀疏项不在循环里逐元素比较, 循环后单独覆盖写一次: g * (1 - p_t), p_t = exp(new_lp);
+    # barrier 保证覆盖写发生在循环里其他线程对同一位置的写之后
+    tl.debug_barrier()
+    local_id = input_ids - vocab_start_index
+    if (local_id >= 0) & (local_id < V):
+        tl.store(grad_ptr + local_id, g_logits * (1.0 - tl.exp(new_lp)))
+
 
 class GRPO_Loss_Optimized(torch.autograd.Function):
+    # 前向和反向都没有 host 同步 (.item() 等), 可以整体录进 torch.cuda.graph 以省掉每步的 python/triton 派发;
+    # 录制前需先 eager 跑一步, 让 autotune 在图外完成
     @staticmethod
     def forward(ctx, new_logits, ref_logits, old_logits, input_ids, advantages, mask,
-                beta, loss_type, epsilon_low, epsilon_high, max_completion_length, delta, temperature):
-       
+                beta, loss_type, epsilon_low, epsilon_high, max_completion_length, delta, temperature,
+                tp_group=None, vocab_start_index=0):
+        lse_lp = torch.empty((6, new_logits.size(0)), dtype=torch.float32, device=new_logits.device)
         loss, _, _, _, _ = grpo_loss_triton_optimized(
             new_logits, ref_logits, old_logits, input_ids, advantages, mask,
             beta=beta, loss_type=loss_type, epsilon_low=epsilon_low, epsilon_high=epsilon_high,
-            max_completion_length=max_completion_length, delta=delta, temperature=temperature
+            max_completion_length=max_completion_length, delta=delta, temperature=temperature,
+            lse_lp=lse_lp, tp_group=tp_group, vocab_start_index=vocab_start_index,
         )
 
-       
-        ctx.save_for_backward(new_logits, ref_logits, old_logits, input_ids, advantages, mask)
+        # 反向只用到 new_logits 和保存的 lse/lp, ref/old logits 不需要保留 (相当于 save_lse_only 的 checkpoint 策略):
+        # 额外保存的只有 6 * BL 个 fp32, new_logits 本身是求梯度的对象, 写回 softmax 梯度必须读它
+        ctx.save_for_backward(new_logits, lse_lp, input_ids, advantages, mask)
     
         ctx.beta = beta
         ctx.loss_type = loss_type
@@ -319,12 +558,13 @@ class GRPO_Loss_Optimized(torch.autograd.Function):
         ctx.max_completion_length = max_completion_length
         ctx.delta = delta
         ctx.temperature = temperature
+        ctx.vocab_start_index = vocab_start_index
         
         return loss
 
     @staticmethod
     def backward(ctx, grad_loss):
-        new_logits, ref_logits, old_logits, input_ids, advantages, mask = ctx.saved_tensors
+        new_logits, lse_lp, input_ids, advantages, mask = ctx.saved_tensors
         
         beta = ctx.beta
         loss_type = ctx.loss_type
@@ -340,55 +580,54 @@ class GRPO_Loss_Optimized(torch.autograd.Function):
         
         
         if loss_type == "grpo" or loss_type == "bnpo":
-            mask_sum = mask.sum().clamp(min=1.0)
-            grad_loss_scale_tensor = grad_loss / mask_sum
+            mask_sum = mask.sum(dtype=torch.float32).clamp(min=1.0)
+            grad_loss_scale_tensor = grad_loss.to(torch.float32) / mask_sum
         elif loss_type == "dr_grpo":
-            grad_loss_scale_tensor = grad_loss / (BL * max_completion_length)
-        
-        
-        grad_loss_scale_val = grad_loss_scale_tensor.item()
+            grad_loss_scale_tensor = grad_loss.to(torch.float32) / (BL * max_completion_length)
+        else:
+            raise ValueError(f"Unknown loss type: {loss_type}")
+        # 缩放系数留在设备上, 由内核读取, 不再 .item() 同步
         
         grid = (BL,)
-        BLOCK_SIZE_V = 1024
-        if V <= 1024: BLOCK_SIZE_V = triton.next_power_of_2(V)
 
         HAS_DELTA = (delta is not None)
         delta_val = delta if HAS_DELTA else 0.0
 
         grpo_bwd_kernel[grid](
-            new_logits, ref_logits, old_logits,
+            new_logits, lse_lp,
             input_ids, advantages, mask,
             grad_new_logits,
-            grad_loss_scale=grad_loss_scale_val,
+            grad_loss_scale_tensor,
             BL=BL, V=V,
             beta=beta,
             epsilon_low=epsilon_low,
             epsilon_high=epsilon_high,
             delta=delta_val,
-            temperature=temperature,
-            BLOCK_SIZE_V=BLOCK_SIZE_V,
+            inv_temperature=1.0 / temperature,
+            vocab_start_index=ctx.vocab_start_index,
             HAS_DELTA=HAS_DELTA,
+            HAS_TEMP=temperature != 1.0,
         )
         
-        return grad_new_logits, None, None, None, None, None, None, None, None, None, None, None, None
+        return grad_new_logits, None, None, None, None, None, None, None, None, None, None, None, None, None, None
     
+
+def _selective_log_softmax(logits, input_ids, temperature):
+    # log_softmax 一次遍历 V, 再 gather 目标位置; 温度为 1 时由 log_softmax 内部转 fp32, 不生成额外副本
+    if temperature != 1.0:
+        logits = logits.to(torch.float32) / temperature
+    log_probs = F.log_softmax(logits, dim=-1, dtype=torch.float32)
+    return log_probs.gather(-1, input_ids.unsqueeze(-1)).squeeze(-1)
+
+
 def grpo_compute_loss_torch(
     new_logits, ref_logits, old_logits, input_ids, advantages, mask,
     beta=0.1, loss_type="grpo", epsilon_low=0.2, epsilon_high=0.2,
     max_completion_length=8192, delta=None, temperature=1.0,
 ):
-    new_logits, ref_logits, old_logits = new_logits.to(torch.float32), ref_logits.to(torch.float32), old_logits.to(torch.float32)
-
-    if temperature != 1.0:
-        new_logits, ref_logits, old_logits = new_logits / temperature, ref_logits / temperature, old_logits / temperature
-
-    input_ids_expanded = input_ids.unsqueeze(-1)
-    new_x = torch.gather(new_logits, dim=-1, index=input_ids_expanded).squeeze(-1)
-    ref_x = torch.gather(ref_logits, dim=-1, index=input_ids_expanded).squeeze(-1)
-    old_x = torch.gather(old_logits, dim=-1, index=input_ids_expanded).squeeze(-1)
-
-    lse_new, lse_ref, lse_old = torch.logsumexp(new_logits, dim=-1), torch.logsumexp(ref_logits, dim=-1), torch.logsumexp(old_logits, dim=-1)
-    new_lp, ref_lp, old_lp = new_x - lse_new, ref_x - lse_ref, old_x - lse_old
+    new_lp = _selective_log_softmax(new_logits, input_ids, temperature)
+    ref_lp = _selective_log_softmax(ref_logits, input_ids, temperature)
+    old_lp = _selective_log_softmax(old_logits, input_ids, temperature)
 
     kl_i = torch.exp(ref_lp - new_lp) - (ref_lp - new_lp) - 1.0 if beta != 0.0 else torch.zeros_like(ref_lp)
 
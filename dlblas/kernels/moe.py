@@ -6,7 +6,7 @@ import torch
 import triton
 import triton.language as tl
 
-from dlblas.utils.device_utils import get_device_props
+from dlblas.utils.device_utils import device_props
 
 
 @triton.jit
@@ -435,7 +435,7 @@ def _quant_fp8_launcher(A: torch.Tensor, group_size: int, out: torch.Tensor, sca
     num_warps = 1
     num_stages = 1
 
-    props = get_device_props(A.device.index)
+    props = device_props(A.device.index)
     num_sm = props['multi_processor_count']
     warps_per_sm = props['warps_per_sm']
     max_ctas = num_sm * warps_per_sm // num_warps
@@ -474,7 +474,7 @@ def quant_fp8(A: torch.Tensor, group_size: int, dtype: torch.dtype = torch.float
     return _quant_fp8_launcher(A, group_size, out, scales)
 
 
-def biased_grouped_topk(
+def biased_grouped_topk_torch(
     hidden_states: torch.Tensor,
     gating_output: torch.Tensor,
     correction_bias: torch.Tensor,
@@ -521,6 +521,143 @@ def biased_grouped_topk(
     return topk_weights.to(torch.float32), topk_ids.to(torch.int32)
 
 
+@triton.jit
+def _biased_grouped_topk_kernel(
+    gating_ptr,
+    bias_ptr,
+    weights_ptr,
+    ids_ptr,
+    num_tokens,
+    stride_gm,
+    stride_ge: tl.constexpr,
+    stride_wm,
+    stride_im,
+    num_groups: tl.constexpr,
+    group_size: tl.constexpr,
+    topk_group: tl.constexpr,
+    topk: tl.constexpr,
+    RENORMALIZE: tl.constexpr,
+    BLOCK_M: tl.constexpr,
+    BLOCK_G: tl.constexpr,
+    BLOCK_E: tl.constexpr,
+    BLOCK_K: tl.constexpr,
+):
+    """biased grouped topk kernel.
+
+    Every top-k is an argmax-and-mask loop over registers, which is cheaper than a sort for the few groups and the
+    small k of the moe gates.
+    """
+    m_off = tl.program_id(0) * BLOCK_M + tl.arange(0, BLOCK_M)
+    g_off = tl.arange(0, BLOCK_G)
+    e_off = tl.arange(0, BLOCK_E)
+    k_off = tl.arange(0, BLOCK_K)
+    m_mask = m_off < num_tokens
+
+    expert_off = g_off[:, None] * group_size + e_off[None, :]
+    expert_mask = (g_off[:, None] < num_groups) & (e_off[None, :] < group_size)
+    mask = m_mask[:, None, None] & expert_mask[None, :, :]
+    gating = tl.load(gating_ptr + m_off[:, None, None] * stride_gm + expert_off[None, :, :] * stride_ge,
+                     mask=mask,
+                     other=0.0).to(tl.float32)
+    bias = tl.load(bias_ptr + expert_off, mask=expert_mask, other=0.0).to(tl.float32)
+    scores = tl.sigmoid(gating)
+    scores_for_choice = tl.where(mask, scores + bias[None, :, :], float('-inf'))
+
+    # group score: sum of the top 2 scores of the group
+    top1_idx = tl.argmax(scores_for_choice, axis=2)
+    top1 = tl.max(scores_for_choice, axis=2)
+    top2 = tl.max(tl.where(e_off[None, None, :] == top1_idx[:, :, None], float('-inf'), scores_for_choice), axis=2)
+    group_scores = tl.where(g_off[None, :] < num_groups, top1 + top2, float('-inf'))
+
+    # keep the topk_group best groups
+    group_mask = tl.zeros((BLOCK_M, BLOCK_G), dtype=tl.int1)
+    for _ in tl.static_range(topk_group):
+        group_idx = tl.argmax(group_scores, axis=1)
+        hit = g_off[None, :] == group_idx[:, None]
+        group_mask = group_mask | hit
+        group_scores = tl.where(hit, float('-inf'), group_scores)
+    scores_for_choice = tl.where(group_mask[:, :, None], scores_for_choice, float('-inf'))
+
+    # topk experts of the kept groups
+    flat_scores_for_choice = tl.reshape(scores_for_choice, (BLOCK_M, BLOCK_G * BLOCK_E))
+    flat_scores = tl.reshape(scores, (BLOCK_M, BLOCK_G * BLOCK_E))
+    flat_off = tl.arange(0, BLOCK_G * BLOCK_E)
+    topk_weights = tl.zeros((BLOCK_M, BLOCK_K), dtype=tl.float32)
+    topk_ids = tl.zeros((BLOCK_M, BLOCK_K), dtype=tl.int32)
+    for k in tl.static_range(topk):
+        idx = tl.argmax(flat_scores_for_choice, axis=1)
+        hit = flat_off[None, :] == idx[:, None]
+        weight = tl.sum(tl.where(hit, flat_scores, 0.0), axis=1)
+        expert_id = (idx // BLOCK_E) * group_size + idx % BLOCK_E
+        topk_weights = tl.where(k_off[None, :] == k, weight[:, None], topk_weights)
+        topk_ids = tl.where(k_off[None, :] == k, expert_id[:, None].to(tl.int32), topk_ids)
+        flat_scores_for_choice = tl.where(hit, float('-inf'), flat_scores_for_choice)
+
+    if RENORMALIZE:
+        topk_weights = topk_weights / tl.sum(topk_weights, axis=1)[:, None]
+
+    out_mask = m_mask[:, None] & (k_off[None, :] < topk)
+    tl.store(weights_ptr + m_off[:, None] * stride_wm + k_off[None, :], topk_weights, mask=out_mask)
+    tl.store(ids_ptr + m_off[:, None] * stride_im + k_off[None, :], topk_ids, mask=out_mask)
+
+
+def biased_grouped_topk(
+    hidden_states: torch.Tensor,
+    gating_output: torch.Tensor,
+    correction_bias: torch.Tensor,
+    topk: int,
+    renormalize: bool,
+    num_expert_group: int = 0,
+    topk_group: int = 0,
+    n_share_experts_fusion: int = 0,
+    routed_scaling_factor: Optional[float] = None,
+):
+    """Biased grouped topk of the moe gate, same results as `biased_grouped_topk_torch`.
+
+    The sigmoid, the group selection and the expert selection are done in one kernel launch instead of a chain of
+    torch sort/topk/scatter ops. The shared expert fusion draws random ids and stays on the torch path.
+    """
+    assert hidden_states.shape[0] == gating_output.shape[0], 'Number of tokens mismatch'
+    if n_share_experts_fusion or not gating_output.is_cuda:
+        return biased_grouped_topk_torch(hidden_states, gating_output, correction_bias, topk, renormalize,
+                                         num_expert_group, topk_group, n_share_experts_fusion, routed_scaling_factor)
+
+    num_tokens, num_experts = gating_output.shape
+    assert num_experts % num_expert_group == 0
+    group_size = num_experts // num_expert_group
+    correction_bias = correction_bias.contiguous()
+    topk_weights = gating_output.new_empty((num_tokens, topk), dtype=torch.float32)
+    topk_ids = gating_output.new_empty((num_tokens, topk), dtype=torch.int32)
+
+    BLOCK_G = triton.next_power_of_2(num_expert_group)
+    BLOCK_E = triton.next_power_of_2(group_size)
+    BLOCK_K = triton.next_power_of_2(topk)
+    BLOCK_M = max(1, min(triton.next_power_of_2(num_tokens), 4096 // (BLOCK_G * BLOCK_E)))
+    grid = (triton.cdiv(num_tokens, BLOCK_M), )
+    _biased_grouped_topk_kernel[grid](
+        gating_output,
+        correction_bias,
+        topk_weights,
+        topk_ids,
+        num_tokens,
+        stride_gm=gating_output.stride(0),
+        stride_ge=gating_output.stride(1),
+        stride_wm=topk_weights.stride(0),
+        stride_im=topk_ids.stride(0),
+        num_groups=num_expert_group,
+        group_size=group_size,
+        topk_group=topk_group,
+        topk=topk,
+        RENORMALIZE=renormalize,
+        BLOCK_M=BLOCK_M,
+        BLOCK_G=BLOCK_G,
+        BLOCK_E=BLOCK_E,
+        BLOCK_K=BLOCK_K,
+        num_warps=4,
+    )
+    return topk_weights, topk_ids
+
+
 @triton.jit
 def kernel_map_logic_to_physical_hash(topk_idx_ptr, physical_idx_ptr, log2phy_ptr, logcnt_ptr, seed, num_tokens,
                                       num_topk, num_logical_experts, max_replica, BLOCK: tl.constexpr):
@@ -31,7 +31,20 @@ enable_moe_load_stats = (
 )
 
 
-class FusedMoENormal:
+class _MoELoadStatsMixin:
+    """Expert load statistics shared by the normal and low latency deepep moe.
+
+    Subclasses provide a class level ``recorder`` and set ``layer_index`` / ``num_experts`` / ``_log_stats``, the
+    latter is resolved once in ``__init__`` so forward only tests an instance attribute.
+    """
+
+    recorder: ExpertsDistributionRecorder = None
+
+    def record_load_stats(self, topk_ids: torch.Tensor):
+        type(self).recorder.record(topk_ids, self.layer_index, self.num_experts)
+
+
+class FusedMoENormal(_MoELoadStatsMixin):
     recorder = ExpertsDistributionRecorder(output_dir="/tmp/dlblas/prefill_moe_stats")
 
     def __init__(
@@ -48,6 +61,7 @@ class FusedMoENormal:
         expert_alignment: int = 128,
     ):
         self.layer_index = layer_index
+        self._log_stats = enable_moe_load_stats
         self.top_k = top_k
         self.num_experts = num_experts
         self.block_size = block_size
@@ -63,7 +77,7 @@ class FusedMoENormal:
 
     def forward(
         self,
-        hidden_states: torch.Tensor,
+        hidden_states: Union[Tuple[torch.Tensor, torch.Tensor], torch.Tensor],
         topk_weights: torch.Tensor,
         topk_ids: torch.LongTensor,
         up_weights: torch.Tensor,
@@ -73,10 +87,10 @@ class FusedMoENormal:
         expert_list: List[int] = None,
     ):
         """forward."""
-        if enable_moe_load_stats:
-            FusedMoENormal.recorder.record(topk_ids, self.layer_index, self.num_experts)
-        hs_quant, hs_scale = per_token_group_quant_fp8(hidden_states, self.block_size)
-        hidden_states = None
+        if self._log_stats:
+            self.record_load_stats(topk_ids)
+        hs_quant, hs_scale = self._quant_input(hidden_states)
+        del hidden_states
         x, recv_topk_ids, recv_topk_weights, recv_tokens_per_expert = (
             self.token_dispatcher.dispatch(
                 (hs_quant, hs_scale),
@@ -85,7 +99,7 @@ class FusedMoENormal:
                 expert_list,
             )
         )
-        topk_ids, topk_weights = None, None
+        del topk_ids, topk_weights
         out_states = fused_moe_v3(
             x,
             recv_topk_ids,
@@ -113,12 +127,8 @@ class FusedMoENormal:
         previous_event=None,
         async_finish=True,
     ):
-        if isinstance(x, torch.Tensor):
-            hs_quant, hs_scale = per_token_group_quant_fp8(x, self.block_size)
-            x = None
-        else:
-            hs_quant = x[0]
-            hs_scale = x[1]
+        hs_quant, hs_scale = self._quant_input(x)
+        del x
         return self.token_dispatcher.dispatch_normal_async(
             (hs_quant, hs_scale),
             topk_idx,
@@ -151,9 +161,43 @@ class FusedMoENormal:
     def per_token_group_quant_fp8(self, x: torch.Tensor):
         return per_token_group_quant_fp8(x, self.block_size)
 
+    def _quant_input(self, x: Union[Tuple[torch.Tensor, torch.Tensor], torch.Tensor]):
+        """(hs_quant, hs_scale) of the dispatch input, a tuple is taken as already quantized."""
+        if not isinstance(x, torch.Tensor):
+            return x[0], x[1]
+        if x.dtype in (torch.float8_e4m3fn, torch.float8_e5m2):
+            raise RuntimeError(
+                "hidden states are already fp8, pass them as a (hs_quant, hs_scale) tuple"
+            )
+        return per_token_group_quant_fp8(x, self.block_size)
+
 
-class FusedMoELowLatency:
+class FusedMoELowLatency(_MoELoadStatsMixin):
     recorder = ExpertsDistributionRecorder(output_dir="/tmp/dlblas/decode_moe_stats")
+    # intermediate buffers of experts(), shared by all layers: they are dead once experts() returns and the
+    # layers run one after another on the compute stream
+    _buffers = {}
+    # keys of buffers baked into a captured cuda graph, and the buffers they outgrew: a graph replays on the
+    # addresses it was captured with, so that memory must never go back to the allocator
+    _captured_keys = set()
+    _retired_buffers = []
+
+    @classmethod
+    def _get_buf(cls, name: str, shape: Tuple[int, ...], dtype: torch.dtype, device: torch.device):
+        """contiguous view of a reusable buffer, which only ever grows."""
+        numel = 1
+        for size in shape:
+            numel *= size
+        key = (name, dtype, device)
+        buf = cls._buffers.get(key)
+        if buf is None or buf.numel() < numel:
+            if buf is not None and key in cls._captured_keys:
+                cls._retired_buffers.append(buf)
+            buf = torch.empty(numel, dtype=dtype, device=device)
+            cls._buffers[key] = buf
+        if torch.cuda.is_current_stream_capturing():
+            cls._captured_keys.add(key)
+        return buf[:numel].view(shape)
 
     def __init__(
         self,
@@ -167,6 +211,7 @@ class FusedMoELowLatency:
     ):
         self.num_experts = num_experts
         self.layer_index = layer_index
+        self._log_stats = enable_moe_load_stats
         self.block_size = block_size
         self.out_dtype = out_dtype
         self.token_dispatcher = DeepEPTokenDispatcherLowLatency(
@@ -209,39 +254,46 @@ class FusedMoELowLatency:
         # modify from sglang
         gate_up_weight_fp8 = (gate_up_weight, gate_up_scale)
         gate_down_weight_fp8 = (gate_down_weight, gate_down_scale)
-        num_groups, m, k = hidden_states_fp8[0].shape
+        hs_quant, hs_scale = hidden_states_fp8
+        num_groups, m, k = hs_quant.shape
         n = gate_up_weight.size(1)
         expected_m = min(expected_m, m)
-        gateup_output = torch.empty(
-            (num_groups, m, n), device=hidden_states_fp8[0].device, dtype=self.out_dtype
+        gateup_output = self._get_buf(
+            "gateup_output", (num_groups, m, n), self.out_dtype, hs_quant.device
         )
         self.deepgemm_grouped_fp8_nt_masked(
-            [DisposibleTensor.maybe_unwrap(x) for x in hidden_states_fp8],
+            # unwrapped inline: a local reference to the tensors would trip the refcount check of dispose
+            (DisposibleTensor.maybe_unwrap(hs_quant), DisposibleTensor.maybe_unwrap(hs_scale)),
             gate_up_weight_fp8,
             gateup_output,
             masked_m,
             expected_m,
         )
-        DisposibleTensor.maybe_dispose(hidden_states_fp8[0])
-        DisposibleTensor.maybe_dispose(hidden_states_fp8[1])
-        down_input = torch.empty(
+        DisposibleTensor.maybe_dispose(hs_quant)
+        DisposibleTensor.maybe_dispose(hs_scale)
+        down_input = self._get_buf(
+            "down_input",
             (
                 gateup_output.shape[0],
                 gateup_output.shape[1],
                 gateup_output.shape[2] // 2,
             ),
-            device=gateup_output.device,
-            dtype=gate_down_weight.dtype,
+            gate_down_weight.dtype,
+            gateup_output.device,
         )
-        down_input_scale = torch.empty(
+        # the kernel writes the scales straight into the column-major, TMA-aligned layout deep_gemm expects, so
+        # deep_gemm does not make a transposed copy of them before the second gemm
+        aligned_m = (m + 3) // 4 * 4
+        down_input_scale = self._get_buf(
+            "down_input_scale",
             (
                 gateup_output.shape[0],
-                gateup_output.shape[1],
                 gateup_output.shape[2] // 2 // self.block_size,
+                aligned_m,
             ),
-            device=gateup_output.device,
-            dtype=torch.float32,
-        )
+            torch.float32,
+            gateup_output.device,
+        ).transpose(1, 2)[:, :m, :]
         silu_and_mul_masked_post_quant_fwd(
             gateup_output,
             down_input,
@@ -249,9 +301,9 @@ class FusedMoELowLatency:
             self.block_size,
             masked_m,
         )
-        del gateup_output
         n = gate_down_weight.size(1)
         down_input_fp8 = (down_input, down_input_scale)
+        # the output is handed to combine and outlives this call, so it is not taken from the shared buffers
         down_output = torch.empty(
             (num_groups, m, n), device=down_input.device, dtype=self.out_dtype
         )
@@ -272,11 +324,8 @@ class FusedMoELowLatency:
         expert_list: List[int] = None,
     ):
         """forward."""
-        if enable_moe_load_stats:
-            FusedMoELowLatency.recorder.record(
-                topk_ids, self.layer_index, self.num_experts
-            )
-
+        if self._log_stats:
+            self.record_load_stats(topk_ids)
         recv_hidden_states, topk_idx, topk_weights, masked_m, expected_m = (
             self.token_dispatcher.dispatch(
                 hidden_states,
@@ -285,7 +334,7 @@ class FusedMoELowLatency:
                 self.num_experts,
             )
         )
-        hidden_states = None
+        del hidden_states
         out_states = self.experts(
             recv_hidden_states,
             up_weights,
@@ -428,6 +477,7 @@ class DlblasTritonFusedMoEBlockedF8Impl(FusedMoEBlockedF8Impl):
         self.block_size = block_size
         self.out_dtype = out_dtype
         self.ep_size = ep_size
+        self._expert_list_cache = {}
 
     def support_ep(self):
         """support expert parallelism."""
@@ -435,11 +485,16 @@ class DlblasTritonFusedMoEBlockedF8Impl(FusedMoEBlockedF8Impl):
 
     def ep_expert_list(self, world_size: int, rank: int):
         """experts list of current rank."""
-        num_experts = self.num_experts
-        expert_per_rank = (num_experts + world_size - 1) // world_size
-        first_expert = rank * expert_per_rank
-        last_expert = min(first_expert + expert_per_rank, num_experts)
-        return list(range(first_expert, last_expert))
+        expert_list = self._expert_list_cache.get((world_size, rank))
+        if expert_list is None:
+            num_experts = self.num_experts
+            expert_per_rank = (num_experts + world_size - 1) // world_size
+            first_expert = rank * expert_per_rank
+            last_expert = min(first_expert + expert_per_rank, num_experts)
+            # a tuple, so callers can not mutate the cached list
+            expert_list = tuple(range(first_expert, last_expert))
+            self._expert_list_cache[(world_size, rank)] = expert_list
+        return expert_list
 
     def forward(
         self,
@@ -454,10 +509,17 @@ class DlblasTritonFusedMoEBlockedF8Impl(FusedMoEBlockedF8Impl):
     ):
         """forward."""
         input_size = hidden_states.shape
-        hidden_states = hidden_states.flatten(0, -2)
-        input_quant, input_scale = quant_fp8(
-            hidden_states, self.block_size, dtype=gate_up_weights.dtype
-        )
+        # a [tokens, hidden] input (the decode case) needs neither the flatten nor the unflatten
+        is_2d = len(input_size) == 2
+        if not is_2d:
+            hidden_states = hidden_states.flatten(0, -2)
+        if hidden_states.size(-1) // gate_up_scale.size(-1) == self.block_size:
+            # the quant groups match the weight blocks, the gate/up gemm quantizes the input tiles itself
+            input_quant, input_scale = hidden_states, None
+        else:
+            input_quant, input_scale = quant_fp8(
+                hidden_states, self.block_size, dtype=gate_up_weights.dtype
+            )
 
         expert_offset = 0
         num_experts = None
@@ -480,5 +542,6 @@ class DlblasTritonFusedMoEBlockedF8Impl(FusedMoEBlockedF8Impl):
             renormalize=self.renormalize,
             ep_size=self.ep_size,
         )
-        output = output.unflatten(0, input_size[:-1])
+        if not is_2d:
+            output = output.unflatten(0, input_size[:-1])
         return output
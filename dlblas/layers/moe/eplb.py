@@ -1,12 +1,47 @@
 # modify from deepseek and sglang
+import functools
+import heapq
+import json
+import os
 import random
 from dataclasses import dataclass
 from os import getenv
 from typing import List, Optional, Tuple
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 
+try:
+    from numba import njit
+
+    use_numba = True
+except ImportError:
+    use_numba = False
+
+
+def _balanced_packing_impl(indices: np.ndarray, weight: np.ndarray, num_packs: int, groups_per_pack: int,
+                           pack_index: np.ndarray, rank_in_pack: np.ndarray):
+    """Greedily put the groups, heaviest first, into the lightest pack that is not full yet."""
+    num_layers, num_groups = indices.shape
+    for i in range(num_layers):
+        pack_weights = np.zeros(num_packs, dtype=weight.dtype)
+        pack_items = np.zeros(num_packs, dtype=np.int64)
+        for j in range(num_groups):
+            group = indices[i, j]
+            pack = -1
+            for p in range(num_packs):
+                if pack_items[p] < groups_per_pack and (pack == -1 or pack_weights[p] < pack_weights[pack]):
+                    pack = p
+            pack_index[i, group] = pack
+            rank_in_pack[i, group] = pack_items[pack]
+            pack_weights[pack] += weight[i, group]
+            pack_items[pack] += 1
+
+
+# the packing is scalar, branchy host code: compile it with numba when available, otherwise run it on numpy arrays
+_balanced_packing_kernel = njit(cache=True)(_balanced_packing_impl) if use_numba else _balanced_packing_impl
+
 
 def balanced_packing(weight: torch.Tensor, num_packs: int) -> Tuple[torch.Tensor, torch.Tensor]:
     num_layers, num_groups = weight.shape
@@ -17,20 +52,35 @@ def balanced_packing(weight: torch.Tensor, num_packs: int) -> Tuple[torch.Tensor
         rank_in_pack = torch.zeros_like(weight, dtype=torch.int64)
         return pack_index, rank_in_pack
 
-    indices = weight.float().sort(-1, descending=True).indices
-    pack_index = torch.full_like(weight, fill_value=-1, dtype=torch.int64)
-    rank_in_pack = torch.full_like(pack_index, fill_value=-1)
-    for i in range(num_layers):
-        pack_weights = [0] * num_packs
-        pack_items = [0] * num_packs
-        for group in indices[i]:
-            pack = min((i for i in range(num_packs) if pack_items[i] < groups_per_pack), key=pack_weights.__getitem__)
-            assert pack_items[pack] < groups_per_pack
-            pack_index[i, group] = pack
-            rank_in_pack[i, group] = pack_items[pack]
-            pack_weights[pack] += weight[i, group]
-            pack_items[pack] += 1
-    return pack_index, rank_in_pack
+    # one device to host copy, instead of a sync for every indexed element
+    weight_np = weight.float().cpu().numpy()
+    indices_np = np.argsort(-weight_np, axis=-1, kind='stable')
+    pack_index = np.full((num_layers, num_groups), -1, dtype=np.int64)
+    rank_in_pack = np.full((num_layers, num_groups), -1, dtype=np.int64)
+    _balanced_packing_kernel(indices_np, weight_np, num_packs, groups_per_pack, pack_index, rank_in_pack)
+    return torch.from_numpy(pack_index).to(weight.device), torch.from_numpy(rank_in_pack).to(weight.device)
+
+
+def _replicate_experts_impl(weight: np.ndarray, num_phy: int, phy2log: np.ndarray, rank: np.ndarray,
+                            logcnt: np.ndarray):
+    """Give every redundant slot to the expert with the highest load per replica.
+
+    Only the chosen expert's load per replica changes after each step, so a max-heap per row replaces the full
+    ``(weight / logcnt).max()`` scan.
+    """
+    n, num_log = weight.shape
+    for r in range(n):
+        heap = [(-weight[r, j], j) for j in range(num_log)]
+        heapq.heapify(heap)
+        for i in range(num_log, num_phy):
+            _, j = heapq.heappop(heap)
+            phy2log[r, i] = j
+            rank[r, i] = logcnt[r, j]
+            logcnt[r, j] += 1
+            heapq.heappush(heap, (-weight[r, j] / logcnt[r, j], j))
+
+
+_replicate_experts_kernel = njit(cache=True)(_replicate_experts_impl) if use_numba else _replicate_experts_impl
 
 
 def replicate_experts(weight: torch.Tensor, num_phy: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
@@ -38,16 +88,40 @@ def replicate_experts(weight: torch.Tensor, num_phy: int) -> Tuple[torch.Tensor,
     num_redundant = num_phy - num_log
     assert num_redundant >= 0
     device = weight.device
-    phy2log = torch.arange(num_phy, dtype=torch.int64, device=device).repeat(n, 1)
-    rank = torch.zeros(n, num_phy, dtype=torch.int64, device=device)
-    logcnt = torch.ones(n, num_log, dtype=torch.int64, device=device)
-    arangen = torch.arange(n, dtype=torch.int64, device=device)
-    for i in range(num_log, num_phy):
-        redundant_indices = (weight / logcnt).max(dim=-1).indices
-        phy2log[:, i] = redundant_indices
-        rank[:, i] = logcnt[arangen, redundant_indices]
-        logcnt[arangen, redundant_indices] += 1
-    return phy2log, rank, logcnt
+    weight_np = weight.double().cpu().numpy()
+    phy2log = np.tile(np.arange(num_phy, dtype=np.int64), (n, 1))
+    rank = np.zeros((n, num_phy), dtype=np.int64)
+    logcnt = np.ones((n, num_log), dtype=np.int64)
+    _replicate_experts_kernel(weight_np, num_phy, phy2log, rank, logcnt)
+    return torch.from_numpy(phy2log).to(device), torch.from_numpy(rank).to(device), torch.from_numpy(logcnt).to(device)
+
+
+def warmup_eplb():
+    """Compile the numba rebalance kernels ahead of the first rebalance.
+
+    ``cache=True`` keeps the compiled code in ``__pycache__``, so only the first process after an install pays the
+    JIT; this moves that compile off the serving path. A no-op without numba.
+    """
+    if not use_numba:
+        return
+    weight = np.ones((1, 4), dtype=np.float32)
+    indices = np.argsort(-weight, axis=-1, kind='stable')
+    pack_index = np.full((1, 4), -1, dtype=np.int64)
+    rank_in_pack = np.full((1, 4), -1, dtype=np.int64)
+    _balanced_packing_kernel(indices, weight, 2, 2, pack_index, rank_in_pack)
+    phy2log = np.tile(np.arange(6, dtype=np.int64), (1, 1))
+    rank = np.zeros((1, 6), dtype=np.int64)
+    logcnt = np.ones((1, 4), dtype=np.int64)
+    _replicate_experts_kernel(weight.astype(np.float64), 6, phy2log, rank, logcnt)
+
+
+def _inverse(perm: torch.Tensor) -> torch.Tensor:
+    """inverse of each row permutation of ``perm``."""
+    inv = torch.empty_like(perm)
+    # the 0-stride view broadcasts one row of indices, it is never materialized as [num_rows, num_cols]
+    src = torch.arange(perm.size(1), dtype=torch.int64, device=perm.device)
+    inv.scatter_(1, perm, src.unsqueeze(0).expand_as(perm))
+    return inv
 
 
 def rebalance_experts_hierarchical(weight: torch.Tensor, num_physical_experts: int, num_groups: int, num_nodes: int,
@@ -61,22 +135,17 @@ def rebalance_experts_hierarchical(weight: torch.Tensor, num_physical_experts: i
     assert num_physical_experts % num_gpus == 0
     phy_experts_per_gpu = num_physical_experts // num_gpus
 
-    def inverse(perm: torch.Tensor) -> torch.Tensor:
-        inv = torch.empty_like(perm)
-        inv.scatter_(1, perm, torch.arange(perm.size(1), dtype=torch.int64, device=perm.device).expand(perm.shape))
-        return inv
-
     tokens_per_group = weight.unflatten(-1, (num_groups, group_size)).sum(-1)
     group_pack_index, group_rank_in_pack = balanced_packing(tokens_per_group, num_nodes)
     log2mlog = (((group_pack_index * groups_per_node + group_rank_in_pack) * group_size).unsqueeze(-1) +
                 torch.arange(group_size, dtype=torch.int64, device=group_pack_index.device)).flatten(-2)
-    mlog2log = inverse(log2mlog)
+    mlog2log = _inverse(log2mlog)
     tokens_per_mlog = weight.gather(-1, mlog2log).view(-1, num_logical_experts // num_nodes)
     phy2mlog, phyrank, mlogcnt = replicate_experts(tokens_per_mlog, num_physical_experts // num_nodes)
     tokens_per_phy = (tokens_per_mlog / mlogcnt).gather(-1, phy2mlog)
     pack_index, rank_in_pack = balanced_packing(tokens_per_phy, num_gpus // num_nodes)
     phy2pphy = pack_index * phy_experts_per_gpu + rank_in_pack
-    pphy2phy = inverse(phy2pphy)
+    pphy2phy = _inverse(phy2pphy)
     pphy2mlog = phy2mlog.gather(-1, pphy2phy)  # [num_layers * num_nodes, num_log_per_nodes]
     pphy2mlog = (
         pphy2mlog.view(num_layers, num_nodes, -1) +
@@ -87,8 +156,12 @@ def rebalance_experts_hierarchical(weight: torch.Tensor, num_physical_experts: i
     return pphy2log, pphyrank, logcnt
 
 
-def rebalance_experts(weight: torch.Tensor, num_replicas: int, num_groups: int, num_nodes: int,
-                      num_gpus: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+def rebalance_experts(weight: torch.Tensor,
+                      num_replicas: int,
+                      num_groups: int,
+                      num_nodes: int,
+                      num_gpus: int,
+                      log2phy_width: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     num_layers, num_logical_experts = weight.shape
     weight = weight.float()
     if num_groups % num_nodes == 0:
@@ -97,13 +170,20 @@ def rebalance_experts(weight: torch.Tensor, num_replicas: int, num_groups: int,
     else:
         # use global load-balance policy
         phy2log, phyrank, logcnt = replicate_experts(weight, num_replicas)
-    maxlogcnt = logcnt.max().item()
+    # upper bound of logcnt (all redundant replicas on one expert), so no device to host sync for logcnt.max();
+    # the unused slots stay -1 and callers pad the last dim to num_replicas anyway
+    maxlogcnt = num_replicas - num_logical_experts + 1
+    # callers that pad the table anyway ask for the padded width, so it is allocated once instead of padded after
+    if log2phy_width is not None:
+        assert log2phy_width >= maxlogcnt
+        maxlogcnt = log2phy_width
     log2phy: torch.Tensor = torch.full((num_layers, num_logical_experts, maxlogcnt),
                                        -1,
                                        dtype=torch.int64,
                                        device=logcnt.device)
+    # one fused multiply-add for the flat index instead of a product temporary plus a sum
     log2phy.view(num_layers, -1).scatter_(
-        -1, phy2log * maxlogcnt + phyrank,
+        -1, torch.add(phyrank, phy2log, alpha=maxlogcnt),
         torch.arange(num_replicas, dtype=torch.int64, device=log2phy.device).expand(num_layers, -1))
     return phy2log, log2phy, logcnt
 
@@ -139,16 +219,16 @@ def compute_logical_to_rank_dispatch_physical_map(
     num_layers, num_logical_experts, _ = logical_to_all_physical_map.shape
     dtype = logical_to_all_physical_map.dtype
 
-    logical_to_rank_dispatch_physical_map = torch.full(
-        size=(num_gpus, num_layers, num_logical_experts),
-        fill_value=-1,
-        dtype=dtype,
-    )
+    # one device to host copy of the whole map, instead of a tolist() sync and a torch.tensor(list) per expert
+    all_physical_lists = logical_to_all_physical_map.tolist()
+    logical_to_rank_dispatch_physical_map = np.full((num_gpus, num_layers, num_logical_experts), -1, dtype=np.int64)
 
     for layer_id in range(num_layers):
         for logical_expert_id in range(num_logical_experts):
-            candidate_physical_expert_ids = (logical_to_all_physical_raw(logical_to_all_physical_map, layer_id,
-                                                                         logical_expert_id))
+            candidate_physical_expert_ids = [
+                physical_expert_id for physical_expert_id in all_physical_lists[layer_id][logical_expert_id]
+                if physical_expert_id != -1
+            ]
             output_partial = logical_to_rank_dispatch_physical_map[:, layer_id, logical_expert_id]
 
             for gpu_id in range(num_gpus):
@@ -159,16 +239,23 @@ def compute_logical_to_rank_dispatch_physical_map(
                 if len(same_gpu_physical_expert_ids) > 0:
                     output_partial[gpu_id] = same_gpu_physical_expert_ids[0]
 
-            num_remain = torch.sum(output_partial == -1).item()
-            output_partial[output_partial == -1] = torch.tensor(
-                _fair_choices(candidate_physical_expert_ids, k=num_remain, r=r),
-                dtype=dtype,
-            )
+            remain = output_partial == -1
+            output_partial[remain] = _fair_choices(candidate_physical_expert_ids, k=int(remain.sum()), r=r)
 
+    logical_to_rank_dispatch_physical_map = torch.from_numpy(logical_to_rank_dispatch_physical_map).to(dtype)
     assert torch.all(logical_to_rank_dispatch_physical_map != -1)
     return logical_to_rank_dispatch_physical_map
 
 
+@functools.lru_cache(maxsize=8)
+def _load_experts_statistic(path: str, mtime: float) -> torch.Tensor:
+    # keyed by mtime as well so that a rewritten statistic file is picked up
+    with open(path, 'r') as f:
+        data = json.load(f)
+    # numpy parses the nested lists in one go, much faster than the element by element torch.tensor(list) path
+    return torch.from_numpy(np.asarray(data, dtype=np.float32))
+
+
 @dataclass
 class EPLBMetadata:
     physical_to_logical_map: torch.Tensor  # (layers, num_physical_experts)
@@ -196,18 +283,23 @@ class EPLBMetadata:
         logical_to_all_physical_map: torch.Tensor,
     ):
         _, num_physical_experts = physical_to_logical_map.shape
-        logical_to_all_physical_map_padded = F.pad(
-            logical_to_all_physical_map,
-            (0, num_physical_experts - logical_to_all_physical_map.shape[-1]),
-            value=-1,
-        )
+        num_logical_experts = logical_to_all_physical_map.shape[1]
+        # no logical expert has more replicas than this, the host side walk only needs these columns
+        max_replicas = num_physical_experts - num_logical_experts + 1
+        logical_to_all_physical_map_padded = logical_to_all_physical_map
+        if logical_to_all_physical_map.shape[-1] < num_physical_experts:
+            logical_to_all_physical_map_padded = F.pad(
+                logical_to_all_physical_map,
+                (0, num_physical_experts - logical_to_all_physical_map.shape[-1]),
+                value=-1,
+            )
         logical_to_all_physical_map_num_valid = torch.count_nonzero(logical_to_all_physical_map != -1, dim=-1)
         return EPLBMetadata(
             physical_to_logical_map=physical_to_logical_map,
             logical_to_all_physical_map=logical_to_all_physical_map_padded,
             logical_to_all_physical_map_num_valid=logical_to_all_physical_map_num_valid,
             logical_to_rank_dispatch_physical_map=compute_logical_to_rank_dispatch_physical_map(
-                logical_to_all_physical_map,
+                logical_to_all_physical_map[..., :max_replicas],
                 num_gpus=ep_size,
                 num_physical_experts=num_physical_experts,
             ),
@@ -224,9 +316,8 @@ class EPLBMetadata:
                                              device='cuda').flip(dims=(0, )).expand(num_hidden_layers, -1)
         else:
             try:
-                import json
-                with open(weight_path, 'r') as f:
-                    experts_statistic = torch.tensor(json.load(f), dtype=torch.float32, device='cuda')
+                experts_statistic = _load_experts_statistic(weight_path, os.path.getmtime(weight_path))
+                experts_statistic = experts_statistic.pin_memory().to('cuda', non_blocking=True)
             except Exception:
                 raise RuntimeError(f'Load eplb experts statistic data failed, path: {weight_path}')
             target_shape = torch.Size([num_hidden_layers, num_routed_experts])
@@ -240,6 +331,7 @@ class EPLBMetadata:
             num_groups=num_groups,
             num_nodes=num_nodes,
             num_gpus=ep_size,
+            log2phy_width=num_physical_experts,
         )
         return EPLBMetadata._init_raw(
             ep_size=ep_size,
@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import torch
@@ -6,49 +7,106 @@ import torch.distributed as dist
 
 from dlblas.utils.logger import get_logger
 
+try:
+    import orjson
+
+    use_orjson = True
+except ImportError:
+    import json
+
+    use_orjson = False
+
 logger = get_logger(__name__)
 
+# dumps run on this worker so that the device to host sync and the file I/O stay off the forward path
+_dump_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dlblas-eplb-dump')
+
+
+def _dump_counts(event: torch.cuda.Event, staged_counts, filepath: str):
+    event.synchronize()
+    data = [counts.tolist() for counts in staged_counts]
+    # no indent, the dumps are read back by EPLB_EXPERTS_STATISTIC_FILE, not by humans
+    if use_orjson:
+        with open(filepath, 'wb') as f:
+            f.write(orjson.dumps(data))
+    else:
+        with open(filepath, 'w') as f:
+            json.dump(data, f)
+    logger.info(f"[EPLB] Experts distribution dumped to {filepath}")
+
 
 class ExpertsDistributionRecorder:
 
     def __init__(self, output_dir: str):
         self.output_dir = output_dir
-        self.dispatch_count = {}
-        self.accum_token_counts = {}
-        self.global_token_counts = {}
+        # one row per layer index, grown on demand: a single allocation instead of a tensor per layer
+        self.dispatch_count = []
+        self.accum_token_counts = None
+        self.global_token_counts = None
         self.last_dump_minute = -1
         self.dump_frequency = int(os.getenv('DLBLAS_EPLB_DUMP_FREQUENCY', 5))
         self.dump_rank = int(os.getenv('DLBLAS_EPLB_DUMP_RANK', 0))
+        # steps of the first recorded layer between two reductions of the counts of all layers
+        self.sync_interval = int(os.getenv('DLBLAS_EPLB_SYNC_INTERVAL', 1))
+        self.first_layer = None
+        # pinned host copy of the global counts, reused by every dump
+        self.staging_counts = None
+        # a single one, broadcast to the number of ids, shared by every layer
+        self.one = None
+
+    def _ensure_layer(self, layer_index: int, num_experts: int):
+        if self.accum_token_counts is not None:
+            assert self.accum_token_counts.size(1) == num_experts, 'all layers of a recorder share num_experts'
+            if layer_index < self.accum_token_counts.size(0):
+                return
+        num_layers = layer_index + 1
+        accum_token_counts = torch.zeros((num_layers, num_experts), dtype=torch.int64, device='cuda')
+        global_token_counts = torch.zeros_like(accum_token_counts)
+        if self.accum_token_counts is not None:
+            accum_token_counts[:self.accum_token_counts.size(0)] = self.accum_token_counts
+            global_token_counts[:self.global_token_counts.size(0)] = self.global_token_counts
+        self.accum_token_counts = accum_token_counts
+        self.global_token_counts = global_token_counts
+        self.dispatch_count.extend([0] * (num_layers - len(self.dispatch_count)))
+        self.staging_counts = None
 
-    def map_to_sorted_2d_array(self, data_map):
-        sorted_keys = sorted(data_map.keys(), key=lambda k: int(k.split('_')[0]))
-        data_2d_array = [data_map[key].cpu().tolist() for key in sorted_keys]
-        return data_2d_array
+    def stage_counts(self):
+        """Start a non blocking copy of the global counts into the pinned buffer, return the recorded rows."""
+        if self.staging_counts is None:
+            self.staging_counts = torch.empty(self.global_token_counts.shape,
+                                              dtype=self.global_token_counts.dtype,
+                                              device='cpu',
+                                              pin_memory=True)
+        self.staging_counts.copy_(self.global_token_counts, non_blocking=True)
+        return [self.staging_counts[layer] for layer, count in enumerate(self.dispatch_count) if count > 0]
 
     def record(self, topk_ids, layer_index, num_experts):
-        key = f"{layer_index}_{num_experts}"
-        if key not in self.dispatch_count:
-            self.dispatch_count[key] = 0
-        self.dispatch_count[key] += 1
-        if key not in self.accum_token_counts:
-            self.accum_token_counts[key] = torch.zeros(num_experts, dtype=torch.int64, device='cuda')
+        self._ensure_layer(layer_index, num_experts)
+        self.dispatch_count[layer_index] += 1
         topk_ids_flat = topk_ids.view(-1)
-        step_local_counts = torch.bincount(topk_ids_flat, minlength=num_experts)
-        self.accum_token_counts[key] += step_local_counts
-        global_token_counts_tmp = self.accum_token_counts[key].clone()
+        if self.one is None:
+            self.one = torch.ones(1, dtype=torch.int64, device='cuda')
+        # accumulate in place, no per step bincount output and no separate add; the 0-stride source needs no
+        # num_ids sized buffer either
+        self.accum_token_counts[layer_index].index_add_(0, topk_ids_flat, self.one.expand(topk_ids_flat.numel()))
+        if self.first_layer is None:
+            self.first_layer = layer_index
+        # every rank runs every layer, so this trigger fires on the same call everywhere and one all_reduce covers
+        # all layers, instead of a small collective per layer per step
+        if layer_index != self.first_layer or self.dispatch_count[layer_index] % self.sync_interval != 0:
+            return
+        self.global_token_counts.copy_(self.accum_token_counts)
         if dist.is_initialized():
-            dist.all_reduce(global_token_counts_tmp, op=dist.ReduceOp.SUM)
-        self.global_token_counts[key] = global_token_counts_tmp
+            dist.all_reduce(self.global_token_counts, op=dist.ReduceOp.SUM)
         rank = dist.get_rank() if dist.is_initialized() else 0
         now = datetime.now()
         if rank == self.dump_rank and now.minute % self.dump_frequency == 0 and now.minute != self.last_dump_minute:
             self.last_dump_minute = now.minute
-            global_list = self.map_to_sorted_2d_array(self.global_token_counts)
-            step = self.dispatch_count[key]
+            staged_counts = self.stage_counts()
+            event = torch.cuda.Event()
+            event.record()
+            step = self.dispatch_count[layer_index]
             os.makedirs(self.output_dir, exist_ok=True)
             token_counts_file_name = f"rank{rank}_step{step}_experts_counts.json"
             filepath = os.path.join(self.output_dir, token_counts_file_name)
-            with open(filepath, 'w') as f:
-                import json
-                json.dump(global_list, f, indent=2)
-            logger.info(f"[EPLB] Experts distribution dumped to {filepath}")
+            _dump_executor.submit(_dump_counts, event, staged_counts, filepath)
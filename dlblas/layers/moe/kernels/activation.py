@@ -3,7 +3,7 @@ import triton
 import triton.language as tl
 from packaging import version
 
-from dlblas.utils.device_utils import get_device_props
+from dlblas.utils.device_utils import device_props
 
 TRITON_VERSION = version.parse(triton.__version__)
 
@@ -73,7 +73,7 @@ def silu_and_mul(gate_up: torch.Tensor, out: torch.Tensor = None):
     num_warps = 4
     num_stages = 1
 
-    props = get_device_props(gate_up.device.index)
+    props = device_props(gate_up.device.index)
     num_sm = props['multi_processor_count']
     warps_per_sm = props['warps_per_sm']
     grid_size0 = triton.cdiv(N, BLOCK_SIZE_N)
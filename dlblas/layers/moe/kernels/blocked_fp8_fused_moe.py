@@ -1,3 +1,8 @@
+import functools
+import json
+import os
+from typing import Optional
+
 import torch
 import triton
 import triton.language as tl
@@ -5,6 +10,15 @@ import triton.language as tl
 from dlblas.kernels.moe import quant_fp8
 from dlblas.layers.moe.kernels.activation import silu_and_mul
 from dlblas.layers.moe.kernels.fused_moe import _dlblas_get_sorted_idx
+from dlblas.utils.device_utils import get_device_props
+from dlblas.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# tuned launch configs, one json file per (E, N, K, device, dtype, block shape) mapping the padded token count
+# M_NP2 to BLOCK_SIZE_M / BLOCK_SIZE_N / num_warps / num_stages, e.g.
+# "E=128,N=4096,K=7168,device_name=NVIDIA_H800,dtype=fp8_w8a8,block_shape=[128,128].json"
+MOE_CONFIG_DIR = os.getenv('DLBLAS_MOE_CONFIG_DIR', os.path.join(os.path.dirname(__file__), 'configs'))
 
 
 def get_cuda_autotune_config():
@@ -22,7 +36,8 @@ def get_cuda_autotune_config():
 
 @triton.autotune(
     configs=get_cuda_autotune_config(),
-    key=['N', 'K', 'M_NP2'],
+    # the inline quantization of A is a much heavier body, tune it separately
+    key=['N', 'K', 'M_NP2', 'QUANT_A'],
     warmup=10,
     rep=25,
 )
@@ -54,12 +69,15 @@ def fused_moe_blocked_f8_kernel(
     stride_bsn: tl.constexpr,
     stride_cm,
     stride_cn: tl.constexpr,
+    fp8_min,
+    fp8_max,
     BLOCK_SIZE_M: tl.constexpr,
     BLOCK_SIZE_N: tl.constexpr,
     BLOCK_SIZE_K: tl.constexpr,
     GROUP_SIZE_M: tl.constexpr,
     M_NP2: tl.constexpr,
     ENABLE_WEIGHTS: tl.constexpr,
+    QUANT_A: tl.constexpr,
     top_k: tl.constexpr,
     expert_offset: tl.constexpr,
     reindex_a: tl.constexpr,
@@ -111,36 +129,62 @@ def fused_moe_blocked_f8_kernel(
     b_ptrs = B + exp_off + (offs_k[:, None] * stride_bk + offs_bn[None, :] * stride_bn)
 
     offs_bsn = pid_n * BLOCK_SIZE_N // group_bn
-    as_ptrs = A_scale + offs_am * stride_asm
     bs_ptrs = B_scale + stride_bse * exp_id + offs_bsn * stride_bsn
 
-    acc_scale = tl.load(as_ptrs, mask=mask_sid, other=1.0) * tl.load(bs_ptrs)
-    acc_ratio = 1 / acc_scale
-    accumulator = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
-    for k in range(0, tl.cdiv(K, BLOCK_SIZE_K)):
-        # load scales
-        k_start = (k + 1) * BLOCK_SIZE_K
-        offs_ksa = k_start // group_ak
-        offs_ksb = k_start // group_bk
-        a_scale = tl.load(as_ptrs + offs_ksa * stride_ask, mask=mask_sid and k_start < K, other=1.0)
-        b_scale = tl.load(bs_ptrs + offs_ksb * stride_bsk, mask=k_start < K, other=1.0)
+    if QUANT_A:
+        # A is the high precision input: every [BLOCK_SIZE_M, BLOCK_SIZE_K] tile is exactly one quant group, so it
+        # is quantized in registers and the fp8 copy of A never round trips through global memory
+        acc_scale = tl.full((BLOCK_SIZE_M, ), 1.0, dtype=tl.float32)
+        accumulator = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
+        for k in range(0, tl.cdiv(K, BLOCK_SIZE_K)):
+            a = tl.load(a_ptrs, mask=mask_sid[:, None] & (offs_k[None, :] < K - k * BLOCK_SIZE_K),
+                        other=0.0).to(tl.float32)
+            b = tl.load(b_ptrs, mask=offs_k[:, None] < K - k * BLOCK_SIZE_K, other=0.0)
+            b_scale = tl.load(bs_ptrs + (k * BLOCK_SIZE_K // group_bk) * stride_bsk)
+
+            # per token group quant, same as quant_fp8
+            a_scale = tl.maximum(tl.max(tl.abs(a), axis=1), 1e-10) / fp8_max
+            a = tl.clamp(a / a_scale[:, None], fp8_min, fp8_max).to(B.dtype.element_ty)
+
+            # mma, the accumulator is kept in units of the current scale
+            new_acc_scale = a_scale * b_scale
+            accumulator = tl.dot(a, b, acc=accumulator * (acc_scale / new_acc_scale)[:, None])
+            acc_scale = new_acc_scale
+
+            a_ptrs += BLOCK_SIZE_K * stride_ak
+            b_ptrs += BLOCK_SIZE_K * stride_bk
+
+        c = accumulator * acc_scale[:, None]
+    else:
+        as_ptrs = A_scale + offs_am * stride_asm
+
+        acc_scale = tl.load(as_ptrs, mask=mask_sid, other=1.0) * tl.load(bs_ptrs)
+        acc_ratio = 1 / acc_scale
+        accumulator = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
+        for k in range(0, tl.cdiv(K, BLOCK_SIZE_K)):
+            # load scales
+            k_start = (k + 1) * BLOCK_SIZE_K
+            offs_ksa = k_start // group_ak
+            offs_ksb = k_start // group_bk
+            a_scale = tl.load(as_ptrs + offs_ksa * stride_ask, mask=mask_sid and k_start < K, other=1.0)
+            b_scale = tl.load(bs_ptrs + offs_ksb * stride_bsk, mask=k_start < K, other=1.0)
 
-        # load ab
-        a = tl.load(a_ptrs, mask=mask_sid[:, None] & (offs_k[None, :] < K - k * BLOCK_SIZE_K), other=0.0)
-        b = tl.load(b_ptrs, mask=offs_k[:, None] < K - k * BLOCK_SIZE_K, other=0.0)
+            # load ab
+            a = tl.load(a_ptrs, mask=mask_sid[:, None] & (offs_k[None, :] < K - k * BLOCK_SIZE_K), other=0.0)
+            b = tl.load(b_ptrs, mask=offs_k[:, None] < K - k * BLOCK_SIZE_K, other=0.0)
 
-        # mma
-        accumulator = tl.dot(a, b, acc=accumulator * acc_ratio[:, None])
+            # mma
+            accumulator = tl.dot(a, b, acc=accumulator * acc_ratio[:, None])
 
-        # update scales and ratio
-        new_acc_scale = a_scale * b_scale
-        acc_ratio = acc_scale / new_acc_scale
-        acc_scale = new_acc_scale
+            # update scales and ratio
+            new_acc_scale = a_scale * b_scale
+            acc_ratio = acc_scale / new_acc_scale
+            acc_scale = new_acc_scale
 
-        a_ptrs += BLOCK_SIZE_K * stride_ak
-        b_ptrs += BLOCK_SIZE_K * stride_bk
+            a_ptrs += BLOCK_SIZE_K * stride_ak
+            b_ptrs += BLOCK_SIZE_K * stride_bk
 
-    c = accumulator * (acc_ratio * acc_scale)[:, None]
+        c = accumulator * (acc_ratio * acc_scale)[:, None]
 
     if ENABLE_WEIGHTS:
         weight = tl.load(Weights + sid, mask=mask_sid)
@@ -156,6 +200,33 @@ def fused_moe_blocked_f8_kernel(
     tl.store(c_ptrs, c, mask=mask_sid[:, None])
 
 
+def get_config_file_name(E: int, N: int, K: int, device_name: str, block_shape: list) -> str:
+    block_n, block_k = block_shape
+    return f'E={E},N={N},K={K},device_name={device_name},dtype=fp8_w8a8,block_shape=[{block_n},{block_k}].json'
+
+
+@functools.lru_cache
+def _load_moe_configs(file_name: str):
+    """configs of the json file keyed by M_NP2, None if there is no file for the shape."""
+    config_file = os.path.join(MOE_CONFIG_DIR, file_name)
+    if not os.path.exists(config_file):
+        return None
+    with open(config_file) as f:
+        configs = {int(key): val for key, val in json.load(f).items()}
+    logger.info(f'using fused moe config {config_file}')
+    return configs
+
+
+@functools.lru_cache
+def get_moe_config(E: int, N: int, K: int, group_bn: int, group_bk: int, M_NP2: int, device: int):
+    """tuned launch config of the closest token count, None falls back to autotune."""
+    device_name = get_device_props(device)['device_name']
+    configs = _load_moe_configs(get_config_file_name(E, N, K, device_name, [group_bn, group_bk]))
+    if not configs:
+        return None
+    return configs[min(configs, key=lambda m: abs(m - M_NP2))]
+
+
 def fused_moe_blocked_fp8_kernel_launcher(
     A: torch.Tensor,
     A_scale: torch.Tensor,
@@ -173,7 +244,11 @@ def fused_moe_blocked_fp8_kernel_launcher(
     reindex_a: bool = True,
     reindex_c: bool = True,
 ):
-    """fused moe kernel launcher."""
+    """fused moe kernel launcher.
+
+    ``A_scale=None`` takes a high precision ``A`` and quantizes it per ``[token, K // B_scale.size(2)]`` group inside
+    the gemm.
+    """
 
     if num_tokens is None:
         num_tokens = A.size(0)
@@ -181,18 +256,20 @@ def fused_moe_blocked_fp8_kernel_launcher(
     M_NP2 = max(64, M_NP2)
     E, N, K = B.shape
 
+    quant_a = A_scale is None
     assert A.dim() == 2
-    assert A_scale.dim() == 2
+    assert quant_a or A_scale.dim() == 2
     assert B.dim() == 3
     assert B_scale.dim() == 3
 
-    assert K % A_scale.size(1) == 0
+    assert quant_a or K % A_scale.size(1) == 0
     assert K % B_scale.size(2) == 0
     assert N % B_scale.size(1) == 0
 
-    group_ak = K // A_scale.size(1)
     group_bk = K // B_scale.size(2)
+    group_ak = group_bk if quant_a else K // A_scale.size(1)
     group_bn = N // B_scale.size(1)
+    finfo = torch.finfo(B.dtype)
 
     def _grid_fn(META):
         grid = (triton.cdiv(M_NP2, META['BLOCK_SIZE_M']) * triton.cdiv(N, META['BLOCK_SIZE_N']), E)
@@ -204,7 +281,15 @@ def fused_moe_blocked_fp8_kernel_launcher(
     BLOCK_SIZE_K = group_bk
     GROUP_SIZE_M = 8
     grid = _grid_fn
-    fused_moe_blocked_f8_kernel[grid](
+    # a tuned config for the shape pins the launch params and skips the autotuner
+    config = get_moe_config(E, N, K, group_bn, group_bk, M_NP2, B.device.index)
+    if config is None:
+        kernel = fused_moe_blocked_f8_kernel
+        launch_kwargs = dict()
+    else:
+        kernel = fused_moe_blocked_f8_kernel.fn
+        launch_kwargs = dict(config)
+    kernel[grid](
         A,
         A_scale,
         B,
@@ -221,8 +306,8 @@ def fused_moe_blocked_fp8_kernel_launcher(
         group_bn=group_bn,
         stride_am=A.stride(0),
         stride_ak=A.stride(1),
-        stride_asm=A_scale.stride(0),
-        stride_ask=A_scale.stride(1),
+        stride_asm=0 if quant_a else A_scale.stride(0),
+        stride_ask=0 if quant_a else A_scale.stride(1),
         stride_be=B.stride(0),
         stride_bn=B.stride(1),
         stride_bk=B.stride(2),
@@ -231,7 +316,10 @@ def fused_moe_blocked_fp8_kernel_launcher(
         stride_bsk=B_scale.stride(2),
         stride_cm=C.stride(0),
         stride_cn=C.stride(1),
+        fp8_min=finfo.min,
+        fp8_max=finfo.max,
         ENABLE_WEIGHTS=enable_weights,
+        QUANT_A=quant_a,
         top_k=top_k,
         expert_offset=expert_offset,
         reindex_a=reindex_a,
@@ -239,6 +327,7 @@ def fused_moe_blocked_fp8_kernel_launcher(
         M_NP2=M_NP2,
         BLOCK_SIZE_K=BLOCK_SIZE_K,
         GROUP_SIZE_M=GROUP_SIZE_M,
+        **launch_kwargs,
     )
 
 
@@ -259,7 +348,7 @@ def _make_intermediate(shape: tuple, dtype: torch.dtype, device: torch.device, z
 
 
 def dlblas_fused_moe_blocked_fp8(input: torch.Tensor,
-                                 input_scale: torch.Tensor,
+                                 input_scale: Optional[torch.Tensor],
                                  w1: torch.Tensor,
                                  w1_scale: torch.Tensor,
                                  w2: torch.Tensor,
@@ -272,16 +361,22 @@ def dlblas_fused_moe_blocked_fp8(input: torch.Tensor,
                                  num_experts: int = None,
                                  renormalize: bool = False,
                                  ep_size: int = 1) -> torch.Tensor:
-    """fused moe."""
+    """fused moe.
+
+    With ``input_scale=None`` the high precision ``input`` is quantized inside the gate/up gemm.
+    """
     device = input.device
     M = input.size(0)
-    E, N, _ = w1.shape
+    E, N, K = w1.shape
     if num_experts is None:
         num_experts = E
         if ep_size > 1:
             num_experts = num_experts * ep_size
     full_exp = num_experts == E
-    group_size = input.size(-1) // input_scale.size(-1)
+    if input_scale is None:
+        group_size = K // w1_scale.size(-1)
+    else:
+        group_size = input.size(-1) // input_scale.size(-1)
 
     topk_weights = _renormalize(topk_weights, renormalize)
     # dlblas get topk_ids
@@ -312,7 +407,7 @@ def dlblas_fused_moe_blocked_fp8(input: torch.Tensor,
     intermediate_cache1 = intermediate_cache1.flatten(0, -2)
     gate_cache = silu_and_mul(intermediate_cache1)
     del intermediate_cache1
-    gate_cache, gate_scale = quant_fp8(gate_cache, group_size, dtype=input.dtype)
+    gate_cache, gate_scale = quant_fp8(gate_cache, group_size, dtype=w2.dtype)
 
     intermediate_cache2 = _make_intermediate((M, topk, w2.shape[1]), dtype=out_dtype, device=device, zeros=not full_exp)
     # down
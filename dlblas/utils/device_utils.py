@@ -5,6 +5,13 @@ from typing import Optional
 import torch
 import triton
 
+try:
+    import pynvml
+
+    use_pynvml = True
+except ImportError:
+    use_pynvml = False
+
 WARPS_PER_SM = {
     (8, 0): 64,
     (8, 6): 48,
@@ -17,17 +24,27 @@ WARPS_PER_SM = {
 }
 
 
-@functools.lru_cache
 def get_device_props(device=None):
+    # resolve the device first: caching on ``None`` would hand the props of one gpu to another after a device
+    # switch, and an int and a torch.device for the same gpu would be cached twice
     if device is None:
         device = torch.cuda.current_device()
+    elif not isinstance(device, int):
+        device = torch.device(device).index
+        if device is None:
+            device = torch.cuda.current_device()
+    return _get_device_props(device)
+
 
+@functools.lru_cache
+def _get_device_props(device: int):
     props = torch.cuda.get_device_properties(device)
 
     warps_per_sm = WARPS_PER_SM.get((props.major, props.minor), 32)
     out = dict(
         multi_processor_count=props.multi_processor_count,
         warps_per_sm=warps_per_sm,
+        device_name=props.name.replace(" ", "_"),
     )
     return out
 
@@ -45,11 +62,13 @@ def get_number_cores():
         raise RuntimeError("Please implement this function.")
 
 
+@functools.lru_cache
 def is_mlu_592():
     target = triton.runtime.driver.active.get_current_target()
     return target.backend == "mlu" and target.arch == 592
 
 
+@functools.lru_cache
 def is_muxi():
     target = triton.runtime.driver.active.get_current_target()
     return target.backend == "maca"
@@ -90,6 +109,45 @@ def is_nvidia_hopper():
         return False
 
 
+@functools.lru_cache
+def _nvml_handles():
+    """NVML handles of the torch devices, created once; None where NVML is unavailable (MLU/MACA/NPU).
+
+    NVML enumerates all devices in PCI order and ignores CUDA_VISIBLE_DEVICES, so every torch device is looked up
+    by its UUID instead of by its index.
+    """
+    if not use_pynvml:
+        return None
+    try:
+        pynvml.nvmlInit()
+        return [
+            pynvml.nvmlDeviceGetHandleByUUID(
+                f"GPU-{torch.cuda.get_device_properties(i).uuid}"
+            )
+            for i in range(torch.cuda.device_count())
+        ]
+    except (pynvml.NVMLError, AttributeError):
+        # no uuid in the device properties of older torch versions
+        return None
+
+
+def is_gpu_idle(gpu_id: int) -> bool:
+    """whether no compute process runs on the device, a direct NVML query instead of parsing nvidia-smi output."""
+    handles = _nvml_handles()
+    if handles is None:
+        # running processes can not be queried without NVML, every device counts as idle
+        return True
+    return len(pynvml.nvmlDeviceGetComputeRunningProcesses(handles[gpu_id])) == 0
+
+
+def get_idle_device():
+    """first idle device, the current one if every device is busy."""
+    for gpu_id in range(torch.cuda.device_count()):
+        if is_gpu_idle(gpu_id):
+            return f"cuda:{gpu_id}"
+    return f"cuda:{torch.cuda.current_device()}"
+
+
 def set_allocator(device_: str):
     def alloc_fn(size: int, alignment: int, stream: Optional[int]):
         return torch.empty(size, device=device_, dtype=torch.int8)
@@ -134,5 +192,27 @@ def infer_device():
         return "cpu"
 
 
+# props of every visible gpu, read on the first device_props call instead of at import
+_DEVICE_PROPS = None
+
+
+def device_props(device: int):
+    """props of a gpu by index, a plain tuple lookup for the kernel launch paths."""
+    global _DEVICE_PROPS
+    if _DEVICE_PROPS is None:
+        _DEVICE_PROPS = (
+            tuple(_get_device_props(i) for i in range(torch.cuda.device_count()))
+            if is_cuda()
+            else ()
+        )
+    if device < len(_DEVICE_PROPS):
+        return _DEVICE_PROPS[device]
+    return get_device_props(device)
+
+
+def warps_per_sm(device: int) -> int:
+    return device_props(device)["warps_per_sm"]
+
+
 NUM_CORES = get_number_cores()
 DEVICE = infer_device()
@@ -0,0 +1,38 @@
+# Copyright (c) 2025, DeepLink.
+from typing import Dict, Tuple
+
+import torch
+from torch import Tensor
+
+# (dim, base, device, dtype) -> (cos, sin), each (max_seq, dim); grown on demand and shared by every layer
+_COS_SIN_CACHE: Dict[tuple, Tuple[Tensor, Tensor]] = {}
+
+
+def _compute_cos_sin(dim: int, base: float, max_seq: int, device: torch.device, dtype: torch.dtype):
+    inv_freq = 1.0 / (base**(torch.arange(0, dim, 2, dtype=torch.float32, device=device) / dim))
+    t = torch.arange(max_seq, dtype=torch.float32, device=device)
+    freqs = torch.outer(t, inv_freq)
+    emb = torch.cat((freqs, freqs), dim=-1)
+    return emb.cos().to(dtype), emb.sin().to(dtype)
+
+
+def get_cos_sin(dim: int, base: float, max_seq: int, device, dtype: torch.dtype) -> Tuple[Tensor, Tensor]:
+    """Return the rotary (cos, sin) tables of shape (max_seq, dim).
+
+    The tables are computed once per (dim, base, device, dtype) and reused, instead of rebuilding
+    `arange * inv_freq -> cos/sin` in every layer on every step. On a request longer than the cached tables, they are
+    rebuilt at the next power of two so that growing sequence lengths do not recompute on every step.
+    """
+    device = torch.device(device)
+    key = (dim, float(base), str(device), dtype)
+    cached = _COS_SIN_CACHE.get(key)
+    if cached is None or cached[0].size(0) < max_seq:
+        cached = _compute_cos_sin(dim, base, 1 << (max_seq - 1).bit_length(), device, dtype)
+        _COS_SIN_CACHE[key] = cached
+    cos, sin = cached
+    return cos[:max_seq], sin[:max_seq]
+
+
+def clear_cos_sin_cache():
+    """Drop all cached tables, e.g. to release device memory."""
+    _COS_SIN_CACHE.clear()
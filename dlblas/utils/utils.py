@@ -56,6 +56,12 @@ def round_up(x: int, y: int) -> int:
     return ((x + y - 1) // y) * y
 
 
+@functools.lru_cache(maxsize=256)
+def next_power_of_2(n: int) -> int:
+    """Cached triton.next_power_of_2, the launchers call it with the same few sizes on every step."""
+    return triton.next_power_of_2(n)
+
+
 def _is_equal(a, b):
     if isinstance(a, torch.Tensor):
         return a is b
@@ -4,4 +4,5 @@ setup(
     name="dlblas",
     version="0.0.7",
     packages=find_packages(exclude=()),
+    package_data={"dlblas": ["layers/moe/kernels/configs/*.json"]},
 )
@@ -0,0 +1,63 @@
+# Copyright (c) 2025, DeepLink.
+import json
+import os
+
+DEFAULT_PATCH_LIST = [
+    'fill_kv_cache',
+    'apply_rotary_pos_emb',
+    'paged_attention_fwd',
+    'rms_norm',
+    'multinomial_sampling',
+    'silu_and_mul',
+]
+
+
+def patch_lmdeploy(ops=DEFAULT_PATCH_LIST):
+    """Replace the lmdeploy cuda kernels in ``ops`` with the dlblas implementations."""
+    import lmdeploy.pytorch.kernels.cuda as lmdeploy_kernels
+
+    from dlblas.kernels.activation import silu_and_mul
+    from dlblas.kernels.apply_rotary_pos_emb import apply_rotary_pos_emb
+    from dlblas.kernels.fill_kv_cache import fill_kv_cache
+    from dlblas.kernels.multinomial_sampling import multinomial_sampling
+    from dlblas.kernels.paged_attention import paged_attention_fwd
+    from dlblas.kernels.rms_norm import rms_norm
+
+    def patch_silu_and_mul():
+        import lmdeploy.pytorch.kernels.cuda.activation as activation
+
+        activation.silu_and_mul = silu_and_mul
+
+    patchers = {
+        'fill_kv_cache': lambda: setattr(lmdeploy_kernels, 'fill_kv_cache', fill_kv_cache),
+        'apply_rotary_pos_emb': lambda: setattr(lmdeploy_kernels, 'apply_rotary_pos_emb', apply_rotary_pos_emb),
+        'paged_attention_fwd': lambda: setattr(lmdeploy_kernels, 'paged_attention_fwd', paged_attention_fwd),
+        'rms_norm': lambda: setattr(lmdeploy_kernels, 'rms_norm', rms_norm),
+        'multinomial_sampling': lambda: setattr(lmdeploy_kernels, 'multinomial_sampling', multinomial_sampling),
+        'silu_and_mul': patch_silu_and_mul,
+    }
+
+    for op in ops:
+        try:
+            patchers[op]()
+            print(f"Patched dlblas implementation of {op}\n", end='')
+        except KeyError:
+            print(f"Unknown op: {op}, supported ops: {DEFAULT_PATCH_LIST}\n", end='')
+        except AttributeError:
+            print(f"Op {op} is not implemented in dlblas\n", end='')
+
+
+def load_checkpoint(checkpoint_file):
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_checkpoint(checkpoint_file, tested_models):
+    # write a temp file and rename it over the checkpoint, so a crash in the middle of the dump never leaves a half
+    # written checkpoint behind
+    tmp_file = f'{checkpoint_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(tested_models, f, indent=4)
+    os.replace(tmp_file, checkpoint_file)
@@ -2,64 +2,10 @@
 # For https://github.com/InternLM/lmdeploy/tree/v0.6.1
 import torch
 
-from dlblas.kernels.activation import silu_and_mul
-from dlblas.kernels.apply_rotary_pos_emb import apply_rotary_pos_emb
-from dlblas.kernels.fill_kv_cache import fill_kv_cache
-from dlblas.kernels.multinomial_sampling import multinomial_sampling
-from dlblas.kernels.paged_attention import paged_attention_fwd
-from dlblas.kernels.rms_norm import rms_norm
+from e2e_utils import patch_lmdeploy
 
 
-def _patch_lmdeploy():
-    import lmdeploy.pytorch.kernels.cuda as lmdeploy_kernels
-
-    DEFAULT_PATCH_LIST = [
-        'fill_kv_cache',
-        'apply_rotary_pos_emb',
-        'paged_attention_fwd',
-        'rms_norm',
-        'multinomial_sampling',
-        'silu_and_mul',
-    ]
-
-    def try_patch(op: str):
-
-        def patch_fill_kv_cache():
-            lmdeploy_kernels.fill_kv_cache = fill_kv_cache
-
-        def patch_apply_rotary_pos_emb():
-            lmdeploy_kernels.apply_rotary_pos_emb = apply_rotary_pos_emb
-
-        def patch_paged_attention_fwd():
-            lmdeploy_kernels.paged_attention_fwd = paged_attention_fwd
-
-        def patch_rms_norm():
-            lmdeploy_kernels.rms_norm = rms_norm
-
-        def patch_multinomial_sampling():
-            lmdeploy_kernels.multinomial_sampling = multinomial_sampling
-
-        def patch_silu_and_mul():
-            import lmdeploy.pytorch.kernels.cuda.activation as activation
-
-            activation.silu_and_mul = silu_and_mul
-
-        try:
-            locals()[f"patch_{op}"]()
-            print(f"patched dlblas implementation of {op}\n", end='')
-        except KeyError:
-            print(
-                f"unknow op: {op}, supported ops: {DEFAULT_PATCH_LIST}\n",
-                end='',
-            )
-        except AttributeError:
-            print(f"op {op} is not implemented in dlblas\n", end='')
-
-    for op in DEFAULT_PATCH_LIST:
-        try_patch(op)
-
-
-_patch_lmdeploy()
+patch_lmdeploy()
 
 
 def run_pipeline_chat_test(device_type, ):
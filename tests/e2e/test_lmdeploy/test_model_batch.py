@@ -1,11 +1,12 @@
 # Copyright (c) 2025, DeepLink.
-import json
 import os
 import subprocess
 
 import torch
 import yaml
 
+from e2e_utils import load_checkpoint
+
 
 def load_yaml_config(config_file):
     if os.path.exists(config_file):
@@ -14,18 +15,6 @@ def load_yaml_config(config_file):
     return {}
 
 
-def load_checkpoint(checkpoint_file):
-    if os.path.exists(checkpoint_file):
-        with open(checkpoint_file, 'r') as f:
-            return json.load(f)
-    return {}
-
-
-def save_checkpoint(checkpoint_file, tested_models):
-    with open(checkpoint_file, 'w') as f:
-        json.dump(tested_models, f, indent=4)
-
-
 common_prefix = ''
 
 
@@ -1,7 +1,5 @@
 # Copyright (c) 2025, DeepLink.
 import argparse
-import json
-import os
 import traceback
 
 import torch
@@ -9,60 +7,10 @@ import yaml
 from lmdeploy import PytorchEngineConfig, pipeline
 from lmdeploy.messages import GenerationConfig
 
-from dlblas.kernels.activation import silu_and_mul
-from dlblas.kernels.apply_rotary_pos_emb import apply_rotary_pos_emb
-from dlblas.kernels.fill_kv_cache import fill_kv_cache
-from dlblas.kernels.multinomial_sampling import multinomial_sampling
-from dlblas.kernels.paged_attention import paged_attention_fwd
-from dlblas.kernels.rms_norm import rms_norm
+from e2e_utils import load_checkpoint, patch_lmdeploy, save_checkpoint
 
 
-def _patch_lmdeploy():
-    import lmdeploy.pytorch.kernels.cuda as lmdeploy_kernels
-
-    DEFAULT_PATCH_LIST = [
-        'fill_kv_cache',
-        'apply_rotary_pos_emb',
-        'paged_attention_fwd',
-        'rms_norm',
-        'multinomial_sampling',
-        'silu_and_mul',
-    ]
-
-    def try_patch(op: str):
-
-        def patch_fill_kv_cache():
-            lmdeploy_kernels.fill_kv_cache = fill_kv_cache
-
-        def patch_apply_rotary_pos_emb():
-            lmdeploy_kernels.apply_rotary_pos_emb = apply_rotary_pos_emb
-
-        def patch_paged_attention_fwd():
-            lmdeploy_kernels.paged_attention_fwd = paged_attention_fwd
-
-        def patch_rms_norm():
-            lmdeploy_kernels.rms_norm = rms_norm
-
-        def patch_multinomial_sampling():
-            lmdeploy_kernels.multinomial_sampling = multinomial_sampling
-
-        def patch_silu_and_mul():
-            import lmdeploy.pytorch.kernels.cuda.activation as activation
-            activation.silu_and_mul = silu_and_mul
-
-        try:
-            locals()[f"patch_{op}"]()
-            print(f"Patched dlblas implementation of {op}\n", end='')
-        except KeyError:
-            print(f"Unknown op: {op}, supported ops: {DEFAULT_PATCH_LIST}\n", end='')
-        except AttributeError:
-            print(f"Op {op} is not implemented in dlblas\n", end='')
-
-    for op in DEFAULT_PATCH_LIST:
-        try_patch(op)
-
-
-_patch_lmdeploy()
+patch_lmdeploy()
 
 
 def run_pipeline_chat_test(model_name, model_path, common_prefix, device_type='cuda'):
@@ -101,18 +49,6 @@ def run_pipeline_image_test(model_name, model_path, common_prefix, device_type='
     return response
 
 
-def load_checkpoint(checkpoint_file):
-    if os.path.exists(checkpoint_file):
-        with open(checkpoint_file, 'r') as f:
-            return json.load(f)
-    return {}
-
-
-def save_checkpoint(checkpoint_file, tested_models):
-    with open(checkpoint_file, 'w') as f:
-        json.dump(tested_models, f, indent=4)
-
-
 def test_model(model_name, model_path, common_prefix, device_type='cuda', checkpoint_file='checkpoint.json'):
     tested_result = load_checkpoint(checkpoint_file)
 
@@ -1,13 +1,14 @@
 # Copyright (c) 2025, DeepLink.
 # Copyright (c) OpenMMLab. All rights reserved.
 import argparse
+import asyncio
 import csv
 import os
 import time
 from dataclasses import dataclass
-from queue import Queue
+from queue import Empty
 from threading import Thread
-from typing import List, Union
+from typing import List, Optional, Union
 
 import numpy as np
 from lmdeploy.cli.utils import ArgumentHelper, DefaultsAndTypesHelpFormatter
@@ -21,80 +22,35 @@ from tqdm import tqdm
 get_logger('lmdeploy').setLevel('ERROR')
 os.environ['TM_LOG_LEVEL'] = 'ERROR'
 
-import json
-
 import torch
 import torch_mlu
 import torch_mlu.utils.gpu_migration
 
-from dlblas.kernels.activation import silu_and_mul
-from dlblas.kernels.apply_rotary_pos_emb import apply_rotary_pos_emb
-from dlblas.kernels.fill_kv_cache import fill_kv_cache
-from dlblas.kernels.multinomial_sampling import multinomial_sampling
-from dlblas.kernels.paged_attention import paged_attention_fwd
-from dlblas.kernels.rms_norm import rms_norm
-
-
-def _patch_lmdeploy():
-    import lmdeploy.pytorch.kernels.cuda as lmdeploy_kernels
-
-    DEFAULT_PATCH_LIST = [
-        'fill_kv_cache',
-        'apply_rotary_pos_emb',
-        'paged_attention_fwd',
-        'rms_norm',
-        'multinomial_sampling',
-        'silu_and_mul',
-    ]
-
-    def try_patch(op: str):
-
-        def patch_fill_kv_cache():
-            lmdeploy_kernels.fill_kv_cache = fill_kv_cache
-
-        def patch_apply_rotary_pos_emb():
-            lmdeploy_kernels.apply_rotary_pos_emb = apply_rotary_pos_emb
-
-        def patch_paged_attention_fwd():
-            lmdeploy_kernels.paged_attention_fwd = paged_attention_fwd
-
-        def patch_rms_norm():
-            lmdeploy_kernels.rms_norm = rms_norm
-
-        def patch_multinomial_sampling():
-            lmdeploy_kernels.multinomial_sampling = multinomial_sampling
-
-        def patch_silu_and_mul():
-            import lmdeploy.pytorch.kernels.cuda.activation as activation
-
-            activation.silu_and_mul = silu_and_mul
-
-        try:
-            locals()[f"patch_{op}"]()
-            print(f"patched dlblas implementation of {op}\n", end='')
-        except KeyError:
-            print(
-                f"unknow op: {op}, supported ops: {DEFAULT_PATCH_LIST}\n",
-                end='',
-            )
-        except AttributeError:
-            print(f"op {op} is not implemented in dlblas\n", end='')
-
-    for op in DEFAULT_PATCH_LIST:
-        try_patch(op)
+from e2e_utils import load_checkpoint, patch_lmdeploy, save_checkpoint
 
 
-_patch_lmdeploy()
+patch_lmdeploy()
 
 
-def infer(model, session_id: int, input_ids: List, gen_config: GenerationConfig, test_round: int, que: Queue):
-    if session_id == 1:
-        pbar = tqdm(total=test_round)
-    chatbot = model.create_instance()
+def infer(chatbot,
+          session_id: int,
+          input_ids: List,
+          gen_config: GenerationConfig,
+          test_round: int,
+          results: List,
+          pbar: tqdm,
+          end_every_round: bool = False):
     output_seqlen = gen_config.max_new_tokens
-    stats = []
-    for _ in range(test_round):
-        token_latency_stats = [0] * (output_seqlen + 1)
+    # same for every round, built once outside the timed loop
+    stream_kwargs = dict(input_ids=input_ids,
+                         gen_config=gen_config,
+                         sequence_start=True,
+                         sequence_end=True,
+                         stream_output=True)
+    # one row per round, written in place; the latencies are rounded once at report time
+    stats = np.zeros((test_round, output_seqlen + 1), dtype=np.float64)
+    for r in range(test_round):
+        token_latency_stats = stats[r]
         prev = time.perf_counter()
         n_prev_token = 0
         """
@@ -109,29 +65,75 @@ def infer(model, session_id: int, input_ids: List, gen_config: GenerationConfig,
         The time elapsing in this iteration `now-prev` is set to the latency of first token of
         the 5 tokens, i.e. `token_latency_stats[0]`, and `token_latency_stats[1:4]` is set 0`
         """   # noqa: E501
-        for outputs in chatbot.stream_infer(session_id,
-                                            input_ids,
-                                            gen_config=gen_config,
-                                            sequence_start=True,
-                                            sequence_end=True,
-                                            stream_output=True):
+        for outputs in chatbot.stream_infer(session_id, **stream_kwargs):
             n_token = outputs.num_token
             now = time.perf_counter()
             if n_prev_token != n_token:
-                token_latency_stats[n_prev_token] = np.round(now - prev, 3)
+                token_latency_stats[n_prev_token] = now - prev
                 n_prev_token = n_token
             prev = now
-        # for pytorch engine to restart a session
-        if hasattr(chatbot, 'end'):
+        # for pytorch engine to restart a session. Every round sends the same prompt, so the session (and its
+        # prefix cache) is kept alive until the last round unless the engine needs a cleanup in between
+        if (end_every_round or r == test_round - 1) and hasattr(chatbot, 'end'):
             chatbot.end(session_id)
-        if session_id == 1:
-            pbar.update(1)
+        pbar.update(1)
 
         assert output_seqlen <= n_token <= output_seqlen + 1, \
             f'Error. session_id({session_id}) request {output_seqlen} ' \
             f'tokens, but generate {n_token} tokens'
-        stats.append(token_latency_stats[:output_seqlen])
-    que.put((session_id, stats))
+    # every session owns its slot, no lock needed
+    results[session_id - 1] = stats[:, :output_seqlen]
+
+
+async def infer_async(chatbot,
+                      session_id: int,
+                      input_ids: List,
+                      gen_config: GenerationConfig,
+                      test_round: int,
+                      results: List,
+                      pbar: tqdm,
+                      end_every_round: bool = False):
+    """`infer` on the async stream of the engine, see `infer` for how the token latencies are recorded."""
+    output_seqlen = gen_config.max_new_tokens
+    # same for every round, built once outside the timed loop
+    stream_kwargs = dict(input_ids=input_ids,
+                         gen_config=gen_config,
+                         sequence_start=True,
+                         sequence_end=True,
+                         stream_output=True)
+    # one row per round, written in place; the latencies are rounded once at report time
+    stats = np.zeros((test_round, output_seqlen + 1), dtype=np.float64)
+    for r in range(test_round):
+        token_latency_stats = stats[r]
+        prev = time.perf_counter()
+        n_prev_token = 0
+        async for outputs in chatbot.async_stream_infer(session_id, **stream_kwargs):
+            n_token = outputs.num_token
+            now = time.perf_counter()
+            if n_prev_token != n_token:
+                token_latency_stats[n_prev_token] = now - prev
+                n_prev_token = n_token
+            prev = now
+        # for pytorch engine to restart a session, kept alive until the last round as in `infer`
+        if end_every_round or r == test_round - 1:
+            if hasattr(chatbot, 'async_end'):
+                await chatbot.async_end(session_id)
+            elif hasattr(chatbot, 'end'):
+                chatbot.end(session_id)
+        pbar.update(1)
+
+        assert output_seqlen <= n_token <= output_seqlen + 1, \
+            f'Error. session_id({session_id}) request {output_seqlen} ' \
+            f'tokens, but generate {n_token} tokens'
+    results[session_id - 1] = stats[:, :output_seqlen]
+
+
+async def _infer_all_async(chatbots: List, input_ids: List, gen_config: GenerationConfig, test_round: int,
+                           results: List, pbar: tqdm, end_every_round: bool):
+    await asyncio.gather(*[
+        infer_async(chatbot, i + 1, input_ids, gen_config, test_round, results, pbar, end_every_round)
+        for i, chatbot in enumerate(chatbots)
+    ])
 
 
 def warmup(model, concurrency: int, input_ids: List[int], warmup_round: int, gen_config: GenerationConfig):
@@ -140,15 +142,16 @@ def warmup(model, concurrency: int, input_ids: List[int], warmup_round: int, gen
 
     print('start to warmup ...')
 
+    stream_kwargs = dict(input_ids=input_ids,
+                         sequence_start=True,
+                         sequence_end=True,
+                         ignore_eos=True,
+                         gen_config=gen_config)
+
     def _infer(model, session_id):
         chatbot = model.create_instance()
         for _ in range(warmup_round):
-            for _ in chatbot.stream_infer(session_id,
-                                          input_ids=input_ids,
-                                          sequence_start=True,
-                                          sequence_end=True,
-                                          ignore_eos=True,
-                                          gen_config=gen_config):
+            for _ in chatbot.stream_infer(session_id, **stream_kwargs):
                 continue
             # for pytorch engine to restart a session
             if hasattr(chatbot, 'end'):
@@ -168,65 +171,84 @@ def warmup(model, concurrency: int, input_ids: List[int], warmup_round: int, gen
     print(f'end warmup, elapsed time: {round(_end - _start, 2)}s')
 
 
-def profile_throughput(model_path: str, concurrency: int, input_seqlen: int,
-                       engine_config: Union[PytorchEngineConfig, TurbomindEngineConfig], gen_config: GenerationConfig,
-                       test_round: int, warmup_round: int):
+def create_engine(model_path: str, engine_config: Union[PytorchEngineConfig, TurbomindEngineConfig]):
+    if isinstance(engine_config, TurbomindEngineConfig):
+        from lmdeploy.turbomind import TurboMind
+        return TurboMind.from_pretrained(model_path, engine_config=engine_config)
+    elif isinstance(engine_config, PytorchEngineConfig):
+        from lmdeploy.pytorch.engine import Engine
+        return Engine(model_path, engine_config)
+
+
+def profile_throughput(model_path: str,
+                       concurrency: int,
+                       input_seqlen: int,
+                       engine_config: Union[PytorchEngineConfig, TurbomindEngineConfig],
+                       gen_config: GenerationConfig,
+                       test_round: int,
+                       warmup_round: int,
+                       input_ids: Optional[List[int]] = None,
+                       tm_model=None,
+                       end_every_round: bool = False):
     output_seqlen = gen_config.max_new_tokens
     print(f'profiling ... concurrency: {concurrency}, '
           f'n_prompt_token: {input_seqlen}, '
           f'n_completion_token: {output_seqlen}, '
           f'test_round: {test_round}, warmup_round: {warmup_round}')
-    if isinstance(engine_config, TurbomindEngineConfig):
-        from lmdeploy.turbomind import TurboMind
-        tm_model = TurboMind.from_pretrained(model_path, engine_config=engine_config)
-        print('wtf')
-
-    elif isinstance(engine_config, PytorchEngineConfig):
-        from lmdeploy.pytorch.engine import Engine
-        print('YES for sure engine')
-        tm_model = Engine(model_path, engine_config)
+    if tm_model is None:
+        tm_model = create_engine(model_path, engine_config)
 
     # make up a dummy `input_ids` with the length of `input_seqlen` exactly
     assert input_seqlen > 0, 'input_seqlen should > 0'
-    input_ids = np.random.randint(low=0, high=101, size=input_seqlen).tolist()
+    if input_ids is None:
+        input_ids = np.random.randint(low=0, high=101, size=input_seqlen).tolist()
+    assert len(input_ids) == input_seqlen
     warmup(tm_model, concurrency, input_ids, warmup_round, gen_config)
 
-    que = Queue()
+    results = [None] * concurrency
     procs = []
+    # one bar for all sessions, tqdm.update is thread safe
+    pbar = tqdm(total=concurrency * test_round)
+    # all sessions on one event loop when the engine has async streams, the python side of the sessions then does
+    # not contend for the GIL across threads; threads otherwise
+    chatbots = [tm_model.create_instance() for _ in range(concurrency)]
+    use_async = all(hasattr(chatbot, 'async_stream_infer') for chatbot in chatbots)
     _start = time.perf_counter()
 
-    for i in range(concurrency):
-        proc = Thread(target=infer, args=(tm_model, i + 1, input_ids, gen_config, test_round, que))
-        procs.append(proc)
-        proc.start()
+    if use_async:
+        asyncio.run(_infer_all_async(chatbots, input_ids, gen_config, test_round, results, pbar, end_every_round))
+    else:
+        for i in range(concurrency):
+            proc = Thread(target=infer,
+                          args=(chatbots[i], i + 1, input_ids, gen_config, test_round, results, pbar, end_every_round))
+            procs.append(proc)
+            proc.start()
 
-    for proc in procs:
-        proc.join()
+        for proc in procs:
+            proc.join()
+    pbar.close()
 
     _end = time.perf_counter()
     elapsed_time = _end - _start
 
-    token_latency_stats = []
-    while not que.empty():
-        _, _stats = que.get()
-        token_latency_stats += _stats
-
-    # The shape is [concurrency*test_round, output_seqlen]
-    token_latency_stats = np.stack(token_latency_stats, axis=0)
-
-    first_token_latency_min = np.round(np.min(token_latency_stats[:, 0], axis=0), 3)
-    first_token_latency_max = np.round(np.max(token_latency_stats[:, 0], axis=0), 3)
-    first_token_latency_ave = np.round(np.mean(token_latency_stats[:, 0], axis=0), 3)
-    token_latency_max = np.round(np.max(np.sum(token_latency_stats, axis=1)), 3)
-    token_latency_min = np.round(np.min(np.sum(token_latency_stats, axis=1)), 3)
-    token_latency_ave = np.round(np.mean(np.sum(token_latency_stats, axis=1)), 3)
+    # The shape is [concurrency*test_round, output_seqlen], ordered by session
+    token_latency_stats = np.concatenate(results, axis=0)
+
+    # the first token column is copied out once, so its three reductions walk a contiguous buffer instead of
+    # striding over whole rows each time; likewise the per request totals are summed once and shared
+    first_token_latency = np.ascontiguousarray(token_latency_stats[:, 0])
+    first_token_latency_min, first_token_latency_max, first_token_latency_ave = np.round(
+        [first_token_latency.min(), first_token_latency.max(), first_token_latency.mean()], 3)
+    total_token_latency = token_latency_stats.sum(axis=1)
+    token_latency_min, token_latency_max, token_latency_ave = np.round(
+        [total_token_latency.min(), total_token_latency.max(), total_token_latency.mean()], 3)
     if output_seqlen > 1:
-        # sort token_latency without the first token's latency
-        sorted_token_latency = np.sort(token_latency_stats[:, 1:].flatten())
-        percentiles = [
-            np.round(sorted_token_latency[int(percent * len(sorted_token_latency))], 3)
-            for percent in [0.5, 0.75, 0.95, 0.99]
-        ]
+        # token latency without the first token's latency; a partial partition at the percentile ranks selects the
+        # same elements as indexing the fully sorted array, without the O(n log n) sort
+        token_latency = token_latency_stats[:, 1:].ravel()
+        ranks = [int(percent * token_latency.size) for percent in [0.5, 0.75, 0.95, 0.99]]
+        partitioned = np.partition(token_latency, ranks)
+        percentiles = [np.round(partitioned[rank], 3) for rank in ranks]
     else:
         percentiles = [
             first_token_latency_ave,
@@ -292,21 +314,27 @@ class MemoryMonitor:
         return nvidia_dict
 
     @classmethod
-    def mem_monitor(cls):
-        info = cls.nvidia_info()
+    def mem_monitor(cls, interval: float = 0.1):
         max_mem = 0
-        mem_start = 0
-        cls.device_count.value = len(info['gpus'])
-        for used_total in info['gpus']:
-            mem_start += used_total['used']
-        while True:
-            info = cls.nvidia_info()
-            used = 0
-            for used_total in info['gpus']:
-                used += used_total['used']
-            if used > max_mem:
-                max_mem = used
-                cls.max_mem.value = (max_mem - mem_start) / (1 << 30)
+        # keep nvml initialized for the whole lifetime of the monitor and poll at a fixed interval, a busy loop would
+        # take a whole core from the benchmark it observes
+        nvmlInit()
+        try:
+            handles = [nvmlDeviceGetHandleByIndex(i) for i in range(nvmlDeviceGetCount())]
+            cls.device_count.value = len(handles)
+            mem_start = sum(nvmlDeviceGetMemoryInfo(handle).used for handle in handles)
+            while True:
+                try:
+                    used = sum(nvmlDeviceGetMemoryInfo(handle).used for handle in handles)
+                except NVMLError:
+                    # a transient driver error only loses this sample
+                    used = 0
+                if used > max_mem:
+                    max_mem = used
+                    cls.max_mem.value = (max_mem - mem_start) / (1 << 30)
+                time.sleep(interval)
+        finally:
+            nvmlShutdown()
 
     @classmethod
     def start(cls):
@@ -368,6 +396,10 @@ def parse_args():
                         default=[128, 128, 2048, 128, 2048])
     parser.add_argument('-tr', '--test-round', type=int, help='number of test rounds', default=3)
     parser.add_argument('-w', '--warmup-round', type=int, help='number of warmup rounds', default=1)
+    parser.add_argument('--end-every-round',
+                        action='store_true',
+                        help='end the session after every test round instead of only after the last one, for '
+                        'engines that need the session cleaned up between rounds')
 
     # other args
     ArgumentHelper.top_p(parser)
@@ -396,43 +428,46 @@ def parse_args():
     return args
 
 
-def __proc_cb(*args, ret_pipe, target):
-    try:
-        ret = target(*args)
-        ret_pipe[1].send(ret)
-    except Exception as e:
-        ret_pipe[1].send(e)
-
-
-def _process_map(target, iterable):
-    from multiprocessing import Pipe, get_context
-
-    pipe = Pipe(False)
-    spawn_context = get_context('spawn')
-    proc = spawn_context.Process(target=__proc_cb, args=iterable, kwargs=dict(ret_pipe=pipe, target=target))
-    proc.start()
-    proc.join(timeout=200)
-    if proc.is_alive():
-        proc.terminate()
-        raise TimeoutError(f"The process exceeded time limit.")
+def _profile_worker(model_path: str, engine_config, tasks, results):
+    tm_model = create_engine(model_path, engine_config)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        try:
+            results.put(profile_throughput(model_path, engine_config=engine_config, tm_model=tm_model, **task))
+        except Exception as e:
+            results.put(e)
 
-    ret = pipe[0].recv()
-    if isinstance(ret, Exception):
-        raise ret
 
-    return ret
+class ProfileWorker:
+    """A spawned process that loads the engine once and profiles every config of the sweep."""
 
+    def __init__(self, model_path: str, engine_config: Union[PytorchEngineConfig, TurbomindEngineConfig]):
+        from multiprocessing import get_context
 
-def load_checkpoint(checkpoint_file):
-    if os.path.exists(checkpoint_file):
-        with open(checkpoint_file, 'r') as f:
-            return json.load(f)
-    return {}
+        spawn_context = get_context('spawn')
+        self.tasks = spawn_context.Queue()
+        self.results = spawn_context.Queue()
+        self.proc = spawn_context.Process(target=_profile_worker,
+                                          args=(model_path, engine_config, self.tasks, self.results),
+                                          daemon=True)
+        self.proc.start()
 
+    def run(self, timeout: float = 200, **task):
+        self.tasks.put(task)
+        try:
+            ret = self.results.get(timeout=timeout)
+        except Empty:
+            self.proc.terminate()
+            raise TimeoutError(f"The process exceeded time limit.")
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
 
-def save_checkpoint(checkpoint_file, tested_models):
-    with open(checkpoint_file, 'w') as f:
-        json.dump(tested_models, f, indent=4)
+    def close(self):
+        self.tasks.put(None)
+        self.proc.join()
 
 
 def main():
@@ -445,57 +480,62 @@ def main():
 
     print(f"---------Testing model {args.model_name} -------------------")
 
+    # one engine serves the whole sweep, so its session must fit the longest config
+    session_len = max([args.session_len] + [p + c for p, c in zip(args.prompt_tokens, args.completion_tokens)])
+    if args.backend == 'turbomind':
+        engine_config = TurbomindEngineConfig(
+            cache_max_entry_count=args.cache_max_entry_count,
+            cache_block_seq_len=args.cache_block_seq_len,
+            model_format=args.model_format,
+            session_len=session_len,
+            rope_scaling_factor=args.rope_scaling_factor,
+            tp=args.tp,
+            enable_prefix_caching=args.enable_prefix_caching,
+        )
+    elif args.backend == 'pytorch':
+        engine_config = PytorchEngineConfig(cache_max_entry_count=args.cache_max_entry_count,
+                                            block_size=args.cache_block_seq_len,
+                                            session_len=session_len,
+                                            tp=args.tp,
+                                            thread_safe=True,
+                                            enable_prefix_caching=args.enable_prefix_caching,
+                                            download_dir=args.common_prefix)
+
+        # download model first
+        from lmdeploy.pytorch.engine import Engine
+        tm_model = Engine(args.model_name, engine_config)
+        del tm_model
+        torch.cuda.empty_cache()
+
     MemoryMonitor.init()
+    # the monitor runs for the whole sweep, so it sees the engine load; mem_per_gpu is the peak so far
+    MemoryMonitor.start()
+    # the model is loaded once in the worker instead of in a new process per config
+    worker = ProfileWorker(args.model_name, engine_config)
+    # dummy prompts, generated once per prompt length and shared by every concurrency
+    prompt_cache = {}
     for batch in args.concurrency:
         print('batch', batch)
         for prompt_tokens, completion_tokens in zip(args.prompt_tokens, args.completion_tokens):
-            MemoryMonitor.start()
-            from functools import partial
-
-            # make sure session_len >= prompt_tokens + completion_tokens
-            session_len = max(args.session_len, prompt_tokens + completion_tokens)
-            if args.backend == 'turbomind':
-                engine_config = TurbomindEngineConfig(
-                    cache_max_entry_count=args.cache_max_entry_count,
-                    cache_block_seq_len=args.cache_block_seq_len,
-                    model_format=args.model_format,
-                    session_len=session_len,
-                    rope_scaling_factor=args.rope_scaling_factor,
-                    tp=args.tp,
-                    enable_prefix_caching=args.enable_prefix_caching,
-                )
-            elif args.backend == 'pytorch':
-                engine_config = PytorchEngineConfig(cache_max_entry_count=args.cache_max_entry_count,
-                                                    block_size=args.cache_block_seq_len,
-                                                    session_len=session_len,
-                                                    tp=args.tp,
-                                                    thread_safe=True,
-                                                    enable_prefix_caching=args.enable_prefix_caching,
-                                                    download_dir=args.common_prefix)
-
-                # download model first
-                from lmdeploy.pytorch.engine import Engine
-                tm_model = Engine(args.model_name, engine_config)
+            if prompt_tokens not in prompt_cache:
+                prompt_cache[prompt_tokens] = np.random.randint(low=0, high=101, size=prompt_tokens).tolist()
             gen_config = GenerationConfig(top_k=args.top_k,
                                           top_p=args.top_p,
                                           temperature=args.temperature,
                                           max_new_tokens=completion_tokens,
                                           ignore_eos=True)
-            profile_target = partial(
-                profile_throughput,
+            output = worker.run(
                 concurrency=batch,
                 input_seqlen=prompt_tokens,
-                engine_config=engine_config,
                 gen_config=gen_config,
                 test_round=args.test_round,
                 warmup_round=args.warmup_round,
+                input_ids=prompt_cache[prompt_tokens],
+                end_every_round=args.end_every_round,
             )
-            # model_path =
-            output = _process_map(profile_target, (args.model_name, ))
             model_name, first_token_latency, percentiles, \
                 output_throughput, total_throughput, tp = output
-            time.sleep(5)  # wait a while for releasing GPU mem
-            memory = MemoryMonitor.terminate()
+            memory = MemoryMonitor.max_mem.value
             results.append(
                 ProfileResult(model_name=model_name,
                               batch=batch,
@@ -506,6 +546,8 @@ def main():
                               output_throughput=output_throughput,
                               total_throughput=total_throughput,
                               mem_per_gpu=memory / tp))
+    worker.close()
+    MemoryMonitor.terminate()
     checkpoint_file = 'checkpoint_throughput.json'
 
     tested_result = load_checkpoint(checkpoint_file)
@@ -0,0 +1,59 @@
+# Copyright (c) 2025, DeepLink.
+import pytest
+import torch
+
+from dlblas.kernels.apply_rope_fill_kv_cache import apply_rope_fill_kv_cache
+from dlblas.kernels.apply_rotary_pos_emb import apply_rotary_pos_emb
+from dlblas.kernels.fill_kv_cache import fill_kv_cache
+
+
+def _div_up(a, b):
+    return (a + b - 1) // b
+
+
+@pytest.mark.parametrize(
+    ['seq_lens', 'history_lens'],
+    [
+        ((1, 1, 1, 1), (1, 16, 31, 24)),
+        ((1, 8, 16, 24), (1, 16, 31, 24)),
+    ],
+)
+@pytest.mark.parametrize('num_heads_q', [8, 32])
+def test_apply_rope_fill_kv_cache(seq_lens, history_lens, num_heads_q):
+    num_heads, head_dim, block_size = 8, 128, 64
+    batch_size = len(seq_lens)
+    kv_lens = [s + h for s, h in zip(seq_lens, history_lens)]
+    num_blocks_per_input = [_div_up(kv_len, block_size) for kv_len in kv_lens]
+    max_num_blocks = max(num_blocks_per_input)
+    num_tokens = sum(seq_lens)
+
+    q_seq_length = torch.tensor(seq_lens).cuda()
+    q_start_loc = q_seq_length.cumsum(0) - q_seq_length
+    kv_seq_length = torch.tensor(kv_lens).cuda()
+    batch_ids = torch.arange(batch_size)
+    block_offsets = (batch_ids[:, None] + torch.arange(max_num_blocks)[None, :] * batch_size).cuda()
+
+    q_states = torch.rand(num_tokens, num_heads_q, head_dim).cuda()
+    k_states = torch.rand(num_tokens, num_heads, head_dim).cuda()
+    v_states = torch.rand_like(k_states)
+    cos = torch.rand(num_tokens, head_dim).cuda()
+    sin = torch.rand(num_tokens, head_dim).cuda()
+    cache_shape = (batch_size * max_num_blocks, block_size, num_heads, head_dim)
+    k_caches = torch.zeros(cache_shape).cuda()
+    v_caches = torch.zeros(cache_shape).cuda()
+
+    # reference: the two unfused kernels
+    gt_q, gt_k = apply_rotary_pos_emb(q_states, k_states, cos, sin)
+    gt_k_caches = k_caches.clone()
+    gt_v_caches = v_caches.clone()
+    fill_kv_cache(gt_k, v_states, gt_k_caches, gt_v_caches, q_start_loc, q_seq_length, kv_seq_length, max(seq_lens),
+                  block_offsets)
+
+    k_states_ori = k_states.clone()
+    q_embed = apply_rope_fill_kv_cache(q_states, k_states, v_states, cos, sin, k_caches, v_caches, q_start_loc,
+                                       q_seq_length, kv_seq_length, max(seq_lens), block_offsets)
+
+    torch.testing.assert_close(q_embed, gt_q)
+    torch.testing.assert_close(k_caches, gt_k_caches)
+    torch.testing.assert_close(v_caches, gt_v_caches)
+    torch.testing.assert_close(k_states, k_states_ori)
@@ -3,7 +3,7 @@
 import pytest
 import torch
 
-from dlblas.kernels.apply_rotary_pos_emb import apply_rotary_pos_emb
+from dlblas.kernels.apply_rotary_pos_emb import apply_rotary_pos_emb, apply_rotary_pos_emb_contiguous
 
 
 def _rotate_half(x):
@@ -92,3 +92,37 @@ class TestApplyRotary:
             atol = 1e-3
         torch.testing.assert_close(q_embed, q_gt, rtol=rtol, atol=atol)
         torch.testing.assert_close(k_embed, k_gt, rtol=rtol, atol=atol)
+
+    @pytest.mark.parametrize('dtype', [torch.float16, torch.float32], indirect=True)
+    @pytest.mark.parametrize(('num_heads_q', 'num_heads_k'), [(8, 4)], indirect=True)
+    def test_apply_rotary_position_ids(self, q_states, k_states, cached_cos, cached_sin, position_ids_1d, gt):
+        q_embed, k_embed = apply_rotary_pos_emb(q_states,
+                                                k_states,
+                                                cached_cos,
+                                                cached_sin,
+                                                position_ids=position_ids_1d)
+        q_gt, k_gt = gt
+
+        rtol = None
+        atol = None
+        if q_states.dtype == torch.float16:
+            rtol = 1e-5
+            atol = 1e-3
+        torch.testing.assert_close(q_embed, q_gt, rtol=rtol, atol=atol)
+        torch.testing.assert_close(k_embed, k_gt, rtol=rtol, atol=atol)
+
+    @pytest.mark.parametrize('dtype', [torch.float32], indirect=True)
+    @pytest.mark.parametrize(('num_heads_q', 'num_heads_k'), [(8, 4)], indirect=True)
+    def test_apply_rotary_contiguous(self, q_states, k_states, feature_dim, dtype):
+        start_pos = 3
+        num_tokens = q_states.size(0)
+        cached_cos = torch.rand(start_pos + num_tokens, feature_dim, dtype=dtype, device='cuda')
+        cached_sin = torch.rand(start_pos + num_tokens, feature_dim, dtype=dtype, device='cuda')
+        cos = cached_cos[start_pos:, None, :]
+        sin = cached_sin[start_pos:, None, :]
+        q_gt = q_states * cos + _rotate_half(q_states) * sin
+        k_gt = k_states * cos + _rotate_half(k_states) * sin
+
+        q_embed, k_embed = apply_rotary_pos_emb_contiguous(q_states, k_states, cached_cos, cached_sin, start_pos)
+        torch.testing.assert_close(q_embed, q_gt)
+        torch.testing.assert_close(k_embed, k_gt)
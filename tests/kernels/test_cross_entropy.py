@@ -0,0 +1,144 @@
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+
+from dlblas.kernels.cross_entropy import LigerCrossEntropyFunction, _get_num_splits, cross_entropy_tp
+from dlblas.utils.device_utils import infer_device
+from tests.utils import assert_verbose_allclose, set_seed
+
+device = infer_device()
+
+# set random seed globally
+set_seed()
+
+
+def torch_cross_entropy(logits, target, ignore_index, label_smoothing, reduction, softcap):
+    logits = logits.to(torch.float32)
+    if softcap is not None:
+        logits = softcap * torch.tanh(logits / softcap)
+    return F.cross_entropy(logits,
+                           target,
+                           ignore_index=ignore_index,
+                           reduction=reduction,
+                           label_smoothing=label_smoothing)
+
+
+@pytest.mark.parametrize(
+    'BT, V, split_v',
+    [
+        (4, 131072, True),  # fewer rows than SMs, each row is split along the vocab
+        (4096, 32000, False),
+        (37, 4097, False),  # random shape
+    ],
+)
+@pytest.mark.parametrize(
+    'dtype, atol, rtol',
+    [
+        (torch.bfloat16, 5e-3, 5e-2),
+        (torch.float32, 1e-5, 5e-4),
+    ],
+)
+@pytest.mark.parametrize('has_ignore', [False, True])
+@pytest.mark.parametrize('reduction', ['mean', 'sum', 'none'])
+@pytest.mark.parametrize('label_smoothing', [0.0, 0.1])
+@pytest.mark.parametrize('softcap', [None, 30.0])
+def test_correctness(BT, V, split_v, dtype, atol, rtol, has_ignore, reduction, label_smoothing, softcap):
+    # the path depends on the backend and the number of SMs, skip the shapes that do not hit the intended one
+    if (_get_num_splits(BT, V) > 1) != split_v:
+        pytest.skip(f'the split-V path is {"not " if split_v else ""}selected for ({BT}, {V}) on this device')
+    # on the row path, (mean, no smoothing, no softcap) runs the basic kernel and the other cases the full one
+
+    ignore_index = -100
+    _tensor = torch.randn(BT, V, device=device, dtype=dtype)
+    _input1 = _tensor.detach().clone().requires_grad_(True)
+    _input2 = _tensor.detach().clone().requires_grad_(True)
+
+    target = torch.randint(0, V, (BT, ), device=device, dtype=torch.long)
+    if has_ignore:
+        # keep at least one ignored and one active row
+        target[::4] = ignore_index
+
+    output1 = torch_cross_entropy(_input1, target, ignore_index, label_smoothing, reduction, softcap)
+    output2, _ = LigerCrossEntropyFunction.apply(_input2, target, None, ignore_index, 0.0, label_smoothing, reduction,
+                                                 softcap, False)
+
+    assert_verbose_allclose(output1.to(dtype), output2, atol=atol, rtol=rtol)
+
+    # 'none' scales every row of the gradient by its own grad_output
+    grad_output = torch.randn_like(output1)
+    output1.backward(gradient=grad_output)
+    output2.backward(gradient=grad_output.to(dtype))
+
+    assert_verbose_allclose(_input1.grad, _input2.grad, atol=atol, rtol=rtol)
+    if has_ignore:
+        assert torch.all(_input2.grad[::4] == 0)
+
+
+def _run_cross_entropy_tp(rank, world_size, port, BT, V, dtype, atol, rtol, reduction):
+    torch.cuda.set_device(rank)
+    dist.init_process_group('nccl', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    try:
+        ignore_index = -100
+        # the same full logits on every rank, generated on the host
+        generator = torch.Generator().manual_seed(0)
+        logits = torch.randn(BT, V, generator=generator).to(dtype)
+        target = torch.randint(0, V, (BT, ), generator=generator)
+        target[::4] = ignore_index
+        grad_output = torch.randn(BT if reduction == 'none' else (), generator=generator)
+        logits, target, grad_output = logits.cuda(), target.cuda(), grad_output.cuda()
+
+        V_shard = V // world_size
+        vocab_start_index = rank * V_shard
+        _input1 = logits.float().requires_grad_(True)
+        _input2 = logits[:, vocab_start_index:vocab_start_index + V_shard].clone().requires_grad_(True)
+
+        output1 = F.cross_entropy(_input1, target, ignore_index=ignore_index, reduction=reduction)
+        output2 = cross_entropy_tp(_input2, target, vocab_start_index, ignore_index=ignore_index, reduction=reduction)
+
+        assert_verbose_allclose(output1.to(dtype), output2, atol=atol, rtol=rtol)
+
+        output1.backward(gradient=grad_output)
+        output2.backward(gradient=grad_output.to(dtype))
+
+        assert_verbose_allclose(_input1.grad[:, vocab_start_index:vocab_start_index + V_shard].to(dtype),
+                                _input2.grad,
+                                atol=atol,
+                                rtol=rtol)
+    finally:
+        dist.destroy_process_group()
+
+
+def _get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.parametrize('world_size', [1, 2])
+@pytest.mark.parametrize(
+    'BT, V',
+    [
+        (64, 32000),
+        (37, 4098),  # random shape
+    ],
+)
+@pytest.mark.parametrize(
+    'dtype, atol, rtol',
+    [
+        (torch.bfloat16, 5e-3, 5e-2),
+        (torch.float32, 1e-5, 5e-4),
+    ],
+)
+@pytest.mark.parametrize('reduction', ['mean', 'sum', 'none'])
+def test_cross_entropy_tp(world_size, BT, V, dtype, atol, rtol, reduction):
+    if torch.cuda.device_count() < world_size:
+        pytest.skip(f'{world_size} ranks need {world_size} devices')
+    # every rank holds a slice of the vocab, its loss and gradient shard must match the unsharded torch result
+    mp.spawn(_run_cross_entropy_tp,
+             args=(world_size, _get_free_port(), BT, V, dtype, atol, rtol, reduction),
+             nprocs=world_size,
+             join=True)
@@ -2,6 +2,7 @@ import torch
 import triton
 import triton.language as tl
 
+from dlblas.layers.moe.eplb import balanced_packing, replicate_experts
 from dlblas.utils.device_utils import infer_device
 
 
@@ -145,5 +146,55 @@ def test_hash_random():
     bench_fn.run(show_plots=False, print_data=True)
 
 
+def reference_balanced_packing(weight: torch.Tensor, num_packs: int):
+    num_layers, num_groups = weight.shape
+    groups_per_pack = num_groups // num_packs
+    indices = weight.float().sort(-1, descending=True, stable=True).indices
+    pack_index = torch.full_like(weight, fill_value=-1, dtype=torch.int64)
+    rank_in_pack = torch.full_like(pack_index, fill_value=-1)
+    for i in range(num_layers):
+        pack_weights = [0] * num_packs
+        pack_items = [0] * num_packs
+        for group in indices[i]:
+            pack = min((i for i in range(num_packs) if pack_items[i] < groups_per_pack), key=pack_weights.__getitem__)
+            pack_index[i, group] = pack
+            rank_in_pack[i, group] = pack_items[pack]
+            pack_weights[pack] += weight[i, group]
+            pack_items[pack] += 1
+    return pack_index, rank_in_pack
+
+
+def test_balanced_packing():
+    torch.manual_seed(0)
+    weight = torch.randint(1, 1000, (4, 64)).float()
+    pack_index, rank_in_pack = balanced_packing(weight, 8)
+    ref_pack_index, ref_rank_in_pack = reference_balanced_packing(weight, 8)
+    torch.testing.assert_close(pack_index, ref_pack_index)
+    torch.testing.assert_close(rank_in_pack, ref_rank_in_pack)
+
+
+def reference_replicate_experts(weight: torch.Tensor, num_phy: int):
+    n, num_log = weight.shape
+    phy2log = torch.arange(num_phy, dtype=torch.int64).repeat(n, 1)
+    rank = torch.zeros(n, num_phy, dtype=torch.int64)
+    logcnt = torch.ones(n, num_log, dtype=torch.int64)
+    arangen = torch.arange(n, dtype=torch.int64)
+    for i in range(num_log, num_phy):
+        redundant_indices = (weight / logcnt).max(dim=-1).indices
+        phy2log[:, i] = redundant_indices
+        rank[:, i] = logcnt[arangen, redundant_indices]
+        logcnt[arangen, redundant_indices] += 1
+    return phy2log, rank, logcnt
+
+
+def test_replicate_experts():
+    torch.manual_seed(0)
+    weight = torch.randint(1, 1000, (4, 64)).double()
+    outs = replicate_experts(weight, 96)
+    ref_outs = reference_replicate_experts(weight, 96)
+    for out, ref_out in zip(outs, ref_outs):
+        torch.testing.assert_close(out, ref_out)
+
+
 if __name__ == '__main__':
     test_hash_random()
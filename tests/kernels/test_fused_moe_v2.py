@@ -1,10 +1,13 @@
 # SPDX-License-Identifier: Apache-2.0
 """Tests for the MOE layers.
 """
+import json
+
 import pytest
 import torch
 
 from dlblas.kernels.fused_moe_v2 import fused_moe
+from dlblas.kernels.moe import quant_fp8
 from dlblas.layers.moe.kernels.blocked_fp8_fused_moe import dlblas_fused_moe_blocked_fp8
 from dlblas.utils.device_utils import infer_device
 
@@ -134,3 +137,87 @@ def test_fused_moe(
                                                  ep_size=ep_size)
 
     torch.testing.assert_close(triton_output, dlblas_output, atol=0.07, rtol=0)
+
+
+@pytest.mark.parametrize('m', [80, 800])
+@pytest.mark.parametrize('n', [256])
+@pytest.mark.parametrize('k', [512])
+def test_fused_moe_blocked_fp8_quant_inline(m: int, n: int, k: int):
+    group_size = 128
+    quant_dtype = torch.float8_e4m3fn
+    e, topk = 16, 4
+    a = torch.randn(m, k, dtype=torch.bfloat16, device=DEVICE)
+    _, w1_quant, w1_scale = _make_B(e, 2 * n, k, group_size=group_size, out_dtype=quant_dtype)
+    _, w2_quant, w2_scale = _make_B(e, k, n, group_size=group_size, out_dtype=quant_dtype)
+    routing_weights = torch.softmax(torch.rand(m, e, dtype=torch.float32, device=DEVICE), dim=-1)
+    topk_weight, topk_idx = torch.topk(routing_weights, topk, dim=-1)
+
+    a_quant, a_scale = quant_fp8(a, group_size, dtype=quant_dtype)
+    # topk_ids is updated in place, every call gets its own copy
+    ref_output = dlblas_fused_moe_blocked_fp8(a_quant,
+                                              a_scale,
+                                              w1_quant,
+                                              w1_scale,
+                                              w2_quant,
+                                              w2_scale,
+                                              topk_weights=topk_weight,
+                                              topk_ids=topk_idx.clone(),
+                                              topk=topk,
+                                              out_dtype=torch.bfloat16)
+    inline_output = dlblas_fused_moe_blocked_fp8(a,
+                                                 None,
+                                                 w1_quant,
+                                                 w1_scale,
+                                                 w2_quant,
+                                                 w2_scale,
+                                                 topk_weights=topk_weight,
+                                                 topk_ids=topk_idx.clone(),
+                                                 topk=topk,
+                                                 out_dtype=torch.bfloat16)
+    torch.testing.assert_close(inline_output, ref_output, atol=0.05, rtol=0.02)
+
+
+def test_fused_moe_blocked_fp8_tuned_config(tmp_path, monkeypatch):
+    from dlblas.layers.moe.kernels import blocked_fp8_fused_moe as moe_module
+    from dlblas.utils.device_utils import get_device_props
+
+    m, n, k, e, topk = 80, 256, 512, 16, 4
+    group_size = 128
+    quant_dtype = torch.float8_e4m3fn
+    a = torch.randn(m, k, dtype=torch.bfloat16, device=DEVICE)
+    a_quant, a_scale = quant_fp8(a, group_size, dtype=quant_dtype)
+    _, w1_quant, w1_scale = _make_B(e, 2 * n, k, group_size=group_size, out_dtype=quant_dtype)
+    _, w2_quant, w2_scale = _make_B(e, k, n, group_size=group_size, out_dtype=quant_dtype)
+    routing_weights = torch.softmax(torch.rand(m, e, dtype=torch.float32, device=DEVICE), dim=-1)
+    topk_weight, topk_idx = torch.topk(routing_weights, topk, dim=-1)
+
+    def _run():
+        return dlblas_fused_moe_blocked_fp8(a_quant,
+                                            a_scale,
+                                            w1_quant,
+                                            w1_scale,
+                                            w2_quant,
+                                            w2_scale,
+                                            topk_weights=topk_weight,
+                                            topk_ids=topk_idx.clone(),
+                                            topk=topk,
+                                            out_dtype=torch.bfloat16)
+
+    ref_output = _run()
+
+    device_name = get_device_props(w1_quant.device.index)['device_name']
+    config = {'64': {'BLOCK_SIZE_M': 16, 'BLOCK_SIZE_N': 64, 'num_warps': 4, 'num_stages': 3}}
+    for N, K in [(2 * n, k), (k, n)]:
+        file_name = moe_module.get_config_file_name(e, N, K, device_name, [group_size, group_size])
+        (tmp_path / file_name).write_text(json.dumps(config))
+    monkeypatch.setattr(moe_module, 'MOE_CONFIG_DIR', str(tmp_path))
+    moe_module._load_moe_configs.cache_clear()
+    moe_module.get_moe_config.cache_clear()
+    try:
+        device = w1_quant.device.index
+        assert moe_module.get_moe_config(e, 2 * n, k, group_size, group_size, 128, device) == config['64']
+        tuned_output = _run()
+    finally:
+        moe_module._load_moe_configs.cache_clear()
+        moe_module.get_moe_config.cache_clear()
+    torch.testing.assert_close(tuned_output, ref_output, atol=0.05, rtol=0.02)
@@ -1,104 +1,146 @@
+import socket
 
-import unittest
+import pytest
 import torch
-from  dlblas.kernels.grpo_compute_loss_logits import GRPO_Loss_Optimized, grpo_compute_loss_torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from dlblas.kernels.grpo_compute_loss_logits import (GRPO_Loss_Optimized, _get_launch_config, grpo_compute_loss_torch,
+                                                     grpo_loss_triton_optimized)
 from dlblas.utils.device_utils import infer_device
 
-def run_full_verification():
-    print("="*50)
-    print("Running Full Forward & Backward Verification")
-    print("="*50)
-
-    # --- 设置测试参数 ---
-    B, S, V = 2, 64, 2048
-    BL = B * S
-    DEVICE = infer_device()
-    DTYPE = torch.float32
-    SEED = 42
-    
-   
-    kwargs = {
-        "beta": 0.1,
-        "loss_type": "grpo",
-        "epsilon_low": 0.2,
-        "epsilon_high": 0.2,
-        "max_completion_length": 8192,
-        "delta": 2.7,
-        "temperature": 0.7,
-    }
-
-   
-    def generate_inputs(requires_grad=False):
-        torch.manual_seed(SEED)
-        new_logits_3d = torch.randn((B, S, V), device=DEVICE, dtype=DTYPE)
-        ref_logits_3d = torch.randn((B, S, V), device=DEVICE, dtype=DTYPE)
-        old_logits_3d = torch.randn((B, S, V), device=DEVICE, dtype=DTYPE)
-        new_logits_2d = new_logits_3d.view(BL, V).clone()
-        ref_logits_2d = ref_logits_3d.view(BL, V).clone()
-        old_logits_2d = old_logits_3d.view(BL, V).clone()
-        if requires_grad:
-            new_logits_3d.requires_grad_(True)
-            new_logits_2d.requires_grad_(True)
-        input_ids_3d = torch.randint(0, V, (B, S), device=DEVICE)
-        mask_3d = torch.ones((B, S), device=DEVICE, dtype=torch.long)
-        mask_3d[0, -5:] = 0
-        input_ids_2d = input_ids_3d.view(BL)
-        mask_2d = mask_3d.view(BL)
-        advantages_3d = torch.randn((B,), device=DEVICE, dtype=DTYPE)
-        advantages_2d = advantages_3d.unsqueeze(1).expand(-1, S).reshape(BL)
-        return (new_logits_3d, ref_logits_3d, old_logits_3d, input_ids_3d, advantages_3d, mask_3d), \
-               (new_logits_2d, ref_logits_2d, old_logits_2d, input_ids_2d, advantages_2d, mask_2d)
-
-    # --- 运行 PyTorch 参考实现  ---
-    print("\n--- Running PyTorch Reference Implementation ---")
-    (new_logits_ref_3d, ref_logits_ref_3d, old_logits_ref_3d, ids_ref_3d, adv_ref_3d, mask_ref_3d) = \
-        generate_inputs(requires_grad=True)[0]
-    adv_ref_torch = adv_ref_3d.unsqueeze(1).expand(-1, S)
-    loss_ref, _, _, _, _ = grpo_compute_loss_torch(
-        new_logits=new_logits_ref_3d, ref_logits=ref_logits_ref_3d, old_logits=old_logits_ref_3d,
-        input_ids=ids_ref_3d, advantages=adv_ref_torch, mask=mask_ref_3d, **kwargs
-    )
+DEVICE = infer_device()
+
+KWARGS = dict(
+    beta=0.1,
+    loss_type='grpo',
+    epsilon_low=0.2,
+    epsilon_high=0.2,
+    max_completion_length=8192,
+    delta=2.7,
+)
+
+
+def generate_inputs(BL, V, dtype, device, seed=42):
+    # 在 host 上生成, 保证每个 rank 拿到同一份完整 logits
+    generator = torch.Generator().manual_seed(seed)
+    new_logits, ref_logits, old_logits = (torch.randn(BL, V, generator=generator).to(dtype) for _ in range(3))
+    input_ids = torch.randint(0, V, (BL, ), generator=generator)
+    advantages = torch.randn(BL, generator=generator)
+    mask = torch.ones(BL, dtype=torch.long)
+    mask[::4] = 0
+    return [t.to(device) for t in (new_logits, ref_logits, old_logits, input_ids, advantages, mask)]
+
+
+def grpo_loss_triton(new_logits, ref_logits, old_logits, input_ids, advantages, mask, temperature, tp_group=None,
+                     vocab_start_index=0):
+    return GRPO_Loss_Optimized.apply(new_logits, ref_logits, old_logits, input_ids, advantages, mask, KWARGS['beta'],
+                                     KWARGS['loss_type'], KWARGS['epsilon_low'], KWARGS['epsilon_high'],
+                                     KWARGS['max_completion_length'], KWARGS['delta'], temperature, tp_group,
+                                     vocab_start_index)
+
+
+@pytest.mark.parametrize(
+    'BL, V, split_v, multi_rows',
+    [
+        (128, 2048, False, False),
+        (8, 131072, True, False),  # token 少于 SM 数, 沿词表切分
+        (8192, 2048, False, True),  # 词表小, 一个 program 处理多行
+    ],
+)
+@pytest.mark.parametrize(
+    'dtype, atol, rtol',
+    [
+        (torch.float32, 1e-5, 1e-4),
+        (torch.bfloat16, 1e-5, 1.6e-2),
+    ],
+)
+@pytest.mark.parametrize('temperature', [1.0, 0.7])
+def test_grpo_loss_logits(BL, V, split_v, multi_rows, dtype, atol, rtol, temperature):
+    # 切分方式取决于后端和 SM 数, 当前设备选不到预期路径时跳过
+    SPLIT_V, ROWS_PER_PROG = _get_launch_config(BL, V)
+    if (SPLIT_V > 1) != split_v or (ROWS_PER_PROG > 1) != multi_rows:
+        pytest.skip(f'({BL}, {V}) runs SPLIT_V={SPLIT_V}, ROWS_PER_PROG={ROWS_PER_PROG} on this device')
+
+    inputs = generate_inputs(BL, V, dtype, DEVICE)
+    new_logits_ref = inputs[0].clone().requires_grad_(True)
+    new_logits_tri = inputs[0].clone().requires_grad_(True)
+
+    loss_ref, _, _, _, _ = grpo_compute_loss_torch(new_logits_ref, *inputs[1:], temperature=temperature, **KWARGS)
+    loss_tri = grpo_loss_triton(new_logits_tri, *inputs[1:], temperature)
+    torch.testing.assert_close(loss_tri, loss_ref, atol=1e-5, rtol=1e-4)
+
     loss_ref.backward()
-    grad_ref = new_logits_ref_3d.grad.clone().view(BL, V)
-    print(f"PyTorch Loss: {loss_ref.item()}")
-
-    # ---  运行 Triton 实现 (修正调用方式) ---
-    print("\n--- Running Triton Custom Kernel Implementation ---")
-    (new_logits_triton, ref_logits_triton, old_logits_triton, ids_triton, adv_triton, mask_triton) = \
-        generate_inputs(requires_grad=True)[1]
-    
-    # 3: 按位置传递所有参数给 .apply
-    loss_triton = GRPO_Loss_Optimized.apply(
-        new_logits_triton, ref_logits_triton, old_logits_triton,
-        ids_triton, adv_triton, mask_triton,
-        kwargs["beta"],
-        kwargs["loss_type"],
-        kwargs["epsilon_low"],
-        kwargs["epsilon_high"],
-        kwargs["max_completion_length"],
-        kwargs["delta"],
-        kwargs["temperature"]
-    )
-    loss_triton.backward()
-    grad_triton = new_logits_triton.grad.clone()
-    print(f"Triton Loss:  {loss_triton.item()}")
-
-    # ---  比较结果  ---
-    print("\n--- Comparing Results ---")
-    loss_check = torch.allclose(loss_ref, loss_triton, atol=1e-5, rtol=1e-4)
-    print(f"Forward Pass (Loss) Correct: {loss_check}")
-    if not loss_check:
-        print(f"  Max absolute difference: {torch.max(torch.abs(loss_ref - loss_triton))}")
-    grad_check = torch.allclose(grad_triton, grad_ref, atol=1e-5, rtol=1e-4)
-    print(f"Backward Pass (Gradient) Correct: {grad_check}")
-    if not grad_check:
-        abs_diff = torch.abs(grad_triton - grad_ref)
-        rel_diff = abs_diff / torch.abs(grad_ref).clamp(min=1e-8)
-        print(f"  Max absolute difference: {torch.max(abs_diff)}")
-        print(f"  Max relative difference: {torch.max(rel_diff)}")
-        max_diff_idx = torch.argmax(abs_diff)
-        print(f"  Location of max diff: {max_diff_idx}")
-        print(f"  Triton grad at max diff: {grad_triton.flatten()[max_diff_idx]}")
-        print(f"  PyTorch grad at max diff: {grad_ref.flatten()[max_diff_idx]}")
-
-run_full_verification()
+    loss_tri.backward()
+    torch.testing.assert_close(new_logits_tri.grad, new_logits_ref.grad, atol=atol, rtol=rtol)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available() or torch.cuda.get_device_capability() < (8, 9),
+                    reason='fp8 needs sm89 or newer')
+@pytest.mark.parametrize('BL, V', [(128, 2048), (8, 131072)])
+@pytest.mark.parametrize('temperature', [1.0, 0.7])
+def test_grpo_loss_logits_fp8(BL, V, temperature):
+    # fp8 logits 只测前向: 内核按 fp8 读入再转 fp32, 与 torch 在 fp32 副本上的结果比较
+    inputs = generate_inputs(BL, V, torch.float8_e4m3fn, DEVICE)
+    logits_fp32 = [t.to(torch.float32) for t in inputs[:3]]
+
+    outs_ref = grpo_compute_loss_torch(*logits_fp32, *inputs[3:], temperature=temperature, **KWARGS)
+    outs_tri = grpo_loss_triton_optimized(*inputs, temperature=temperature, **KWARGS)
+    # loss, completion_length, mean_kl, loss_i, kl_i
+    for out_tri, out_ref in zip(outs_tri, outs_ref):
+        torch.testing.assert_close(out_tri, out_ref.to(torch.float32), atol=1e-5, rtol=1e-4)
+
+
+def _run_grpo_tp(rank, world_size, port, BL, V, dtype, atol, rtol, temperature):
+    torch.cuda.set_device(rank)
+    dist.init_process_group('nccl', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    try:
+        inputs = generate_inputs(BL, V, dtype, torch.device('cuda', rank))
+        V_shard = V // world_size
+        vocab_start_index = rank * V_shard
+        shard = slice(vocab_start_index, vocab_start_index + V_shard)
+
+        new_logits_full = inputs[0].clone().requires_grad_(True)
+        loss_full = grpo_loss_triton(new_logits_full, *inputs[1:], temperature)
+
+        new_logits_tp = inputs[0][:, shard].clone().requires_grad_(True)
+        ref_logits_tp, old_logits_tp = (t[:, shard].contiguous() for t in inputs[1:3])
+        loss_tp = grpo_loss_triton(new_logits_tp, ref_logits_tp, old_logits_tp, *inputs[3:], temperature,
+                                   tp_group=dist.group.WORLD, vocab_start_index=vocab_start_index)
+        torch.testing.assert_close(loss_tp, loss_full, atol=1e-5, rtol=1e-4)
+
+        loss_full.backward()
+        loss_tp.backward()
+        torch.testing.assert_close(new_logits_tp.grad, new_logits_full.grad[:, shard], atol=atol, rtol=rtol)
+    finally:
+        dist.destroy_process_group()
+
+
+def _get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.parametrize('world_size', [1, 2])
+@pytest.mark.parametrize('BL, V', [(128, 32000), (8, 131072)])
+@pytest.mark.parametrize(
+    'dtype, atol, rtol',
+    [
+        (torch.float32, 1e-5, 1e-4),
+        (torch.bfloat16, 1e-5, 1.6e-2),
+    ],
+)
+@pytest.mark.parametrize('temperature', [1.0, 0.7])
+def test_grpo_loss_logits_tp(world_size, BL, V, dtype, atol, rtol, temperature):
+    if torch.cuda.device_count() < world_size:
+        pytest.skip(f'{world_size} ranks need {world_size} devices')
+    # 每个 rank 只持有一段词表, loss 和梯度分片需与不切分的结果一致
+    mp.spawn(_run_grpo_tp,
+             args=(world_size, _get_free_port(), BL, V, dtype, atol, rtol, temperature),
+             nprocs=world_size,
+             join=True)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
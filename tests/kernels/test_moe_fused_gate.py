@@ -3,7 +3,7 @@ import pytest
 import torch
 
 import dlblas
-from dlblas.kernels.moe import biased_grouped_topk
+from dlblas.kernels.moe import biased_grouped_topk, biased_grouped_topk_torch
 
 
 @pytest.mark.parametrize(
@@ -61,5 +61,53 @@ def test_moe_fused_gate_combined(seq_length, dtype, params):
                           f"params {params}")
 
 
+@pytest.mark.parametrize('seq_length', [1, 7, 64, 1000, 4096])
+@pytest.mark.parametrize('dtype', [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize(
+    'params',
+    [
+        (128, 4, 2, 4),
+        (256, 8, 4, 8),  # deepseek v3
+        (512, 16, 8, 16),
+        (160, 5, 3, 6),
+    ],
+)
+def test_biased_grouped_topk(seq_length, dtype, params):
+    num_experts, num_expert_group, topk_group, topk = params
+    torch.manual_seed(seq_length)
+    scores = torch.rand((seq_length, num_experts)).to(dtype).cuda()
+    bias = torch.rand(num_experts).to(dtype).cuda()
+    kwargs = dict(topk=topk, renormalize=True, num_expert_group=num_expert_group, topk_group=topk_group)
+
+    output, indices = biased_grouped_topk(scores, scores, bias, **kwargs)
+    ref_output, ref_indices = biased_grouped_topk_torch(scores, scores, bias, **kwargs)
+
+    if dtype == torch.float32:
+        torch.testing.assert_close(indices.sort()[0], ref_indices.sort()[0])
+    else:
+        # the kernel ranks in fp32 while the torch reference rounds sigmoid(score) + bias to bf16, so near ties may
+        # pick different experts; compare the biased scores of the selected experts instead
+        biased_scores = scores.float().sigmoid() + bias.float().unsqueeze(0)
+        torch.testing.assert_close(biased_scores.gather(1, indices.long()).sort()[0],
+                                   biased_scores.gather(1, ref_indices.long()).sort()[0],
+                                   rtol=1e-02,
+                                   atol=1e-02)
+    torch.testing.assert_close(output.sort()[0], ref_output.sort()[0], rtol=1e-02, atol=1e-03)
+
+
+@pytest.mark.parametrize('fn', [biased_grouped_topk, biased_grouped_topk_torch])
+def test_biased_grouped_topk_inputs_unchanged(fn):
+    num_experts, num_expert_group, topk_group, topk = 256, 8, 4, 8
+    scores = torch.rand((128, num_experts), dtype=torch.bfloat16).cuda()
+    bias = torch.rand(num_experts, dtype=torch.bfloat16).cuda()
+    scores_ori = scores.clone()
+    bias_ori = bias.clone()
+
+    fn(scores, scores, bias, topk=topk, renormalize=True, num_expert_group=num_expert_group, topk_group=topk_group)
+
+    torch.testing.assert_close(scores, scores_ori, rtol=0, atol=0)
+    torch.testing.assert_close(bias, bias_ori, rtol=0, atol=0)
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
@@ -0,0 +1,24 @@
+# Copyright (c) 2025, DeepLink.
+import torch
+
+from dlblas.utils.rope_cache import clear_cos_sin_cache, get_cos_sin
+
+
+def test_get_cos_sin():
+    clear_cos_sin_cache()
+    dim, base = 16, 10000.0
+    cos, sin = get_cos_sin(dim, base, 10, 'cpu', torch.float32)
+    assert cos.shape == (10, dim) and sin.shape == (10, dim)
+
+    inv_freq = 1.0 / (base**(torch.arange(0, dim, 2, dtype=torch.float32) / dim))
+    freqs = torch.outer(torch.arange(10, dtype=torch.float32), inv_freq)
+    emb = torch.cat((freqs, freqs), dim=-1)
+    torch.testing.assert_close(cos, emb.cos())
+    torch.testing.assert_close(sin, emb.sin())
+
+    # a shorter request is served from the same storage, a longer one grows the tables
+    cos_short, _ = get_cos_sin(dim, base, 4, 'cpu', torch.float32)
+    assert cos_short.data_ptr() == cos.data_ptr()
+    cos_long, _ = get_cos_sin(dim, base, 40, 'cpu', torch.float32)
+    assert cos_long.shape == (40, dim)
+    torch.testing.assert_close(cos_long[:10], cos)